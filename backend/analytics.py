@@ -0,0 +1,433 @@
+"""Instantánea columnar de adjudicaciones y licitaciones para análisis interactivo.
+
+Los hechos se exportan de PostgreSQL a ficheros Arrow IPC (uno por tabla, en un
+directorio por marca de agua) y se abren con memory-map: las columnas se leen como
+arrays de NumPy sin copiar y las agregaciones (filtros y group-by con bincount) no
+tocan la base de datos. Organismos y adjudicatarios se guardan como códigos enteros
+que indexan sus tablas de dimensión; CPV, provincia, comunidad y tipo de contrato
+como columnas diccionario.
+
+Cuando cambia la marca de agua (la del último refresco completo) se reconstruye en
+segundo plano, con una conexión propia y la conversión y escritura en hilos para no
+bloquear las peticiones, y mientras tanto se sigue sirviendo la instantánea anterior. Todo se lee
+en una transacción REPEATABLE READ junto con la marca, y no se reconstruye si hay una
+carga posterior sin refrescar. Uso para construirla fuera de la API:
+python analytics.py
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+import numpy as np
+import pyarrow as pa
+
+import cache
+import db
+from refresh import CURRENT_MARKS_SQL
+
+SNAPSHOT_DIR = Path(os.getenv("ANALYTICS_DIR", os.path.join(tempfile.gettempdir(), "licitamonitor-analytics")))
+# Filas por lote del cursor: asyncpg decodifica cada lote en el bucle de eventos
+BATCH_SIZE = 5000
+# Segundos antes de reintentar una marca de agua que no se pudo cargar (refresco en curso
+# o réplica atrasada)
+RETRY_SECONDS = float(os.getenv("ANALYTICS_RETRY_SECONDS", "30"))
+# Instantáneas antiguas que se conservan en disco (otros workers pueden tenerlas abiertas)
+KEEP_SNAPSHOTS = 2
+
+logger = logging.getLogger(__name__)
+
+AWARDS_SQL = """
+    SELECT
+        r.id_licitacion,
+        r.anio,
+        r.id_adjudicatario,
+        r.id_organo,
+        COALESCE(r.cpv, '') as cpv,
+        COALESCE(o.provincia, '') as provincia,
+        COALESCE(o.comunidad_autonoma, '') as comunidad,
+        COALESCE(r.tipo_contrato, '') as tipo_contrato,
+        COALESCE(r.importe, 0)::float8 as importe,
+        CASE WHEN r.presupuesto > 0 AND r.importe > 0
+             THEN ((r.presupuesto - r.importe) / r.presupuesto * 100)::float4 END as baja
+    FROM (
+        SELECT
+            l.id_licitacion,
+            l.id_organo,
+            l.tipo_contrato,
+            EXTRACT(YEAR FROM COALESCE(r.fecha_adjudicacion, l.fecha_publicacion))::int as anio,
+            r.id_adjudicatario,
+            COALESCE(lot.id_cpv_principal, (
+                SELECT c.codigo_cpv FROM dw.rel_licitacion_cpv c
+                WHERE c.id_licitacion = l.id_licitacion AND c.es_principal LIMIT 1
+            )) as cpv,
+            r.importe_adjudicacion_con_iva as importe,
+            COALESCE(lot.importe_lote_con_iva, l.presupuesto_base_con_iva) as presupuesto
+        FROM dw.fact_resultado_lote r
+        INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+        INNER JOIN dw.fact_licitacion l ON lot.id_licitacion = l.id_licitacion
+        WHERE r.es_exito = true
+    ) r
+    INNER JOIN dw.dim_organo o ON r.id_organo = o.id_organo
+"""
+
+TENDERS_SQL = """
+    SELECT
+        l.id_licitacion,
+        EXTRACT(YEAR FROM l.fecha_publicacion)::int as anio,
+        l.id_organo,
+        COALESCE((
+            SELECT c.codigo_cpv FROM dw.rel_licitacion_cpv c
+            WHERE c.id_licitacion = l.id_licitacion AND c.es_principal LIMIT 1
+        ), '') as cpv,
+        COALESCE(o.provincia, '') as provincia,
+        COALESCE(o.comunidad_autonoma, '') as comunidad,
+        COALESCE(l.tipo_contrato, '') as tipo_contrato,
+        COALESCE(l.presupuesto_base_con_iva, 0)::float8 as presupuesto,
+        CASE WHEN lr.adjudicada THEN 1 ELSE 0 END as adjudicada
+    FROM dw.fact_licitacion l
+    INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
+    LEFT JOIN dw.licitacion_resultado lr ON lr.id_licitacion = l.id_licitacion
+"""
+
+COMPANIES_SQL = """
+    SELECT id_adjudicatario as id, nombre, COALESCE(nif, '') as nif
+    FROM dw.dim_adjudicatario WHERE id_adjudicatario = ANY($1)
+"""
+
+ORGANISMS_SQL = """
+    SELECT
+        id_organo as id, nombre,
+        COALESCE(tipo_administracion, '') as tipo_administracion,
+        COALESCE(comunidad_autonoma, '') as comunidad,
+        COALESCE(provincia, '') as provincia
+    FROM dw.dim_organo WHERE id_organo = ANY($1)
+"""
+
+# Columnas guardadas como diccionario (pocos valores distintos); el resto de columnas
+# de texto se guardan tal cual y las numéricas con el tipo indicado
+DICTIONARY_COLUMNS = {"cpv", "provincia", "comunidad", "tipo_contrato", "tipo_administracion"}
+COLUMN_TYPES = {
+    "id": pa.int64(), "id_licitacion": pa.int64(), "anio": pa.int16(),
+    "id_adjudicatario": pa.int32(), "id_organo": pa.int32(),
+    "importe": pa.float64(), "presupuesto": pa.float64(), "baja": pa.float32(), "adjudicada": pa.int8(),
+}
+
+
+class _Codes:
+    """Asignar códigos densos 0..n-1 a claves subrogadas"""
+
+    def __init__(self):
+        self.codes: Dict[int, int] = {}
+
+    def __call__(self, key: int) -> int:
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.codes)
+        return code
+
+    def keys(self) -> List[int]:
+        return list(self.codes)
+
+
+def _to_arrow(name: str, values: list) -> pa.Array:
+    if name in DICTIONARY_COLUMNS:
+        return pa.array(values, pa.string()).dictionary_encode()
+    return pa.array(values, COLUMN_TYPES.get(name, pa.string()))
+
+
+def _write(path: Path, columns: Dict[str, list]):
+    table = pa.table({name: _to_arrow(name, values) for name, values in columns.items()})
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _write_rows(path: Path, names: List[str], rows: list):
+    _write(path, {name: [row[name] for row in rows] for name in names})
+
+
+def _append(convert: list, rows: list):
+    for row in rows:
+        for (values, encoder), value in zip(convert, row):
+            values.append(encoder(value) if encoder else value)
+
+
+async def _export(conn: asyncpg.Connection, sql: str, encoders: dict) -> Dict[str, list]:
+    """Leer una consulta por lotes; la conversión de cada lote se hace en un hilo"""
+    statement = await conn.prepare(sql)
+    names = [attribute.name for attribute in statement.get_attributes()]
+    columns: Dict[str, list] = {name: [] for name in names}
+    convert = [(columns[name], encoders.get(name)) for name in names]
+    cursor = await statement.cursor()
+    while rows := await cursor.fetch(BATCH_SIZE):
+        await asyncio.to_thread(_append, convert, rows)
+    return columns
+
+
+async def build_snapshot(conn: asyncpg.Connection, force: bool = False) -> Optional[Tuple[Path, str]]:
+    """Exportar las tablas de la instantánea y devolver su directorio y su marca de agua.
+
+    Devuelve None sin construir nada si hay hechos cargados después del último refresco
+    completo (las tablas precalculadas aún no los reflejan), salvo con force.
+    """
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        watermark = await conn.fetchval(cache.WATERMARK_SQL.sql)
+        loaded = await conn.fetchrow(CURRENT_MARKS_SQL)
+        if ":".join(str(value) for value in loaded.values()) != watermark and not force:
+            logger.info("analytics snapshot deferred until refresh completes", extra={"watermark": watermark})
+            return None
+        target = SNAPSHOT_DIR / _dirname(watermark)
+        if not target.exists():
+            await _build(conn, watermark, target)
+    return target, watermark
+
+
+async def _build(conn: asyncpg.Connection, watermark: str, target: Path):
+    started = time.monotonic()
+    staging = Path(tempfile.mkdtemp(prefix=".build-", dir=SNAPSHOT_DIR))
+    try:
+        companies, organisms = _Codes(), _Codes()
+        awards = await _export(conn, AWARDS_SQL, {"id_adjudicatario": companies, "id_organo": organisms})
+        tenders = await _export(conn, TENDERS_SQL, {"id_organo": organisms})
+        await asyncio.to_thread(_write, staging / "awards.arrow", awards)
+        await asyncio.to_thread(_write, staging / "tenders.arrow", tenders)
+        # Las dimensiones se guardan en el orden de sus códigos
+        for name, sql, codes in (("companies", COMPANIES_SQL, companies), ("organisms", ORGANISMS_SQL, organisms)):
+            statement = await conn.prepare(sql)
+            rows = {row["id"]: row for row in await statement.fetch(codes.keys())}
+            ordered = [rows[key] for key in codes.keys()]
+            names = [attribute.name for attribute in statement.get_attributes()]
+            await asyncio.to_thread(_write_rows, staging / f"{name}.arrow", names, ordered)
+        try:
+            staging.rename(target)
+        except OSError:
+            # Otro proceso ya ha construido esta misma instantánea
+            await asyncio.to_thread(shutil.rmtree, staging, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    logger.info("analytics snapshot built", extra={
+        "watermark": watermark, "awards": len(awards["anio"]),
+        "tenders": len(tenders["anio"]), "seconds": round(time.monotonic() - started, 2),
+    })
+    await asyncio.to_thread(_prune)
+
+
+def _dirname(watermark: str) -> str:
+    return "snapshot-" + watermark.replace(":", "-")
+
+
+@asynccontextmanager
+async def _build_lock():
+    """Bloqueo entre procesos: con varios workers sólo uno construye cada instantánea"""
+    with open(SNAPSHOT_DIR / ".build.lock", "w") as lock:
+        await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _prune():
+    snapshots = sorted(SNAPSHOT_DIR.glob("snapshot-*"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for old in snapshots[KEEP_SNAPSHOTS:]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+class Snapshot:
+    """Tablas de una instantánea abiertas con memory-map como arrays de NumPy"""
+
+    def __init__(self, path: Path, watermark: str):
+        self.path = path
+        self.watermark = watermark
+        self.loaded_at = time.time()
+        self.awards = self._load(path / "awards.arrow")
+        self.tenders = self._load(path / "tenders.arrow")
+        self.companies = self._load(path / "companies.arrow")
+        self.organisms = self._load(path / "organisms.arrow")
+
+    @staticmethod
+    def _load(path: Path) -> Dict[str, np.ndarray]:
+        table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+        columns = {}
+        for name in table.column_names:
+            column = table.column(name)
+            array = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+            if pa.types.is_dictionary(array.type):
+                # Códigos (sin copia) + valores del diccionario
+                columns[name] = array.indices.to_numpy(zero_copy_only=False)
+                columns[name + "__values"] = np.array(array.dictionary.to_pylist(), dtype=object)
+            elif pa.types.is_floating(array.type) or pa.types.is_integer(array.type):
+                columns[name] = array.to_numpy(zero_copy_only=False)
+            else:
+                columns[name] = np.array(array.to_pylist(), dtype=object)
+        return columns
+
+    def rows(self, table: str) -> int:
+        return len(next(iter(getattr(self, table).values()), ()))
+
+
+def _match(columns: Dict[str, np.ndarray], name: str, value: Optional[str], prefix: bool = False) -> Optional[np.ndarray]:
+    """Máscara de filas cuyo valor de diccionario coincide (comparando en el diccionario, no por fila)"""
+    if not value:
+        return None
+    values = columns[name + "__values"]
+    if prefix:
+        selected = np.fromiter((v.startswith(value) for v in values), dtype=bool, count=len(values))
+    else:
+        selected = values == value
+    return selected[columns[name]]
+
+
+def _mask(columns: Dict[str, np.ndarray], anio: Optional[int], cpv: Optional[str], provincia: Optional[str],
+          comunidad_autonoma: Optional[str], tipo_contrato: Optional[str]) -> np.ndarray:
+    mask = np.ones(len(columns["anio"]), dtype=bool)
+    if anio is not None:
+        mask &= columns["anio"] == anio
+    for selected in (
+        _match(columns, "cpv", cpv, prefix=True),
+        _match(columns, "provincia", provincia),
+        _match(columns, "comunidad", comunidad_autonoma),
+        _match(columns, "tipo_contrato", tipo_contrato),
+    ):
+        if selected is not None:
+            mask &= selected
+    return mask
+
+
+def top_companies(snapshot: Snapshot, anio: Optional[int] = None, cpv: Optional[str] = None,
+                  provincia: Optional[str] = None, comunidad_autonoma: Optional[str] = None,
+                  tipo_contrato: Optional[str] = None, limit: int = 20, order: str = "amount") -> list:
+    """Adjudicatarios con más importe (o adjudicaciones) en el filtro"""
+    awards = snapshot.awards
+    mask = _mask(awards, anio, cpv, provincia, comunidad_autonoma, tipo_contrato)
+    codes = awards["id_adjudicatario"][mask]
+    size = snapshot.rows("companies")
+    wins = np.bincount(codes, minlength=size)
+    amount = np.bincount(codes, weights=awards["importe"][mask], minlength=size)
+    baja = awards["baja"][mask]
+    valid = ~np.isnan(baja)
+    baja_sum = np.bincount(codes[valid], weights=baja[valid], minlength=size)
+    baja_num = np.bincount(codes[valid], minlength=size)
+    total_amount = amount.sum()
+
+    ranking = amount if order == "amount" else wins
+    candidates = np.flatnonzero(wins)
+    top = candidates[np.argsort(-ranking[candidates], kind="stable")[:limit]]
+    companies = snapshot.companies
+    return [
+        {
+            "id": int(companies["id"][code]),
+            "name": companies["nombre"][code],
+            "nif": companies["nif"][code] or None,
+            "wins": int(wins[code]),
+            "amount": round(float(amount[code]), 2),
+            "share": round(float(amount[code] / total_amount * 100), 2) if total_amount else 0.0,
+            "avgDiscount": round(float(baja_sum[code] / baja_num[code]), 2) if baja_num[code] else None,
+        }
+        for code in top
+    ]
+
+
+def organism_volume(snapshot: Snapshot, anio: Optional[int] = None, cpv: Optional[str] = None,
+                    provincia: Optional[str] = None, comunidad_autonoma: Optional[str] = None,
+                    tipo_contrato: Optional[str] = None, limit: int = 100, min_tenders: int = 1) -> list:
+    """Volumen licitado frente a tasa de éxito de los organismos del filtro"""
+    tenders = snapshot.tenders
+    mask = _mask(tenders, anio, cpv, provincia, comunidad_autonoma, tipo_contrato)
+    codes = tenders["id_organo"][mask]
+    size = snapshot.rows("organisms")
+    total = np.bincount(codes, minlength=size)
+    awarded = np.bincount(codes, weights=tenders["adjudicada"][mask], minlength=size)
+    volume = np.bincount(codes, weights=tenders["presupuesto"][mask], minlength=size)
+
+    candidates = np.flatnonzero(total >= max(min_tenders, 1))
+    top = candidates[np.argsort(-volume[candidates], kind="stable")[:limit]]
+    organisms = snapshot.organisms
+    return [
+        {
+            "id": int(organisms["id"][code]),
+            "name": organisms["nombre"][code],
+            "type": organisms["tipo_administracion__values"][organisms["tipo_administracion"][code]] or None,
+            "region": organisms["comunidad__values"][organisms["comunidad"][code]] or None,
+            "totalTenders": int(total[code]),
+            "awardedTenders": int(awarded[code]),
+            "successRate": round(float(awarded[code] / total[code] * 100), 1),
+            "volume": round(float(volume[code]), 2),
+        }
+        for code in top
+    ]
+
+
+class AnalyticsStore:
+    """Instantánea vigente del proceso, renovada cuando cambia la marca de agua"""
+
+    def __init__(self):
+        self.snapshot: Optional[Snapshot] = None
+        self._lock = asyncio.Lock()
+        self._refresh: Optional[asyncio.Task] = None
+        # Última marca de agua intentada y cuándo
+        self._attempted: Optional[str] = None
+        self._attempted_at = 0.0
+
+    async def _load(self, watermark: str) -> Optional[Snapshot]:
+        path = SNAPSHOT_DIR / _dirname(watermark)
+        if not path.exists():
+            async with _build_lock():
+                # Mientras se esperaba el bloqueo puede haberla construido otro worker.
+                # La réplica puede ir atrasada: se usa la marca leída en la transacción
+                if not path.exists():
+                    # Conexión propia: la exportación no ocupa una conexión del pool de la API
+                    async with db.dedicated_connection(replica=True, application_name="licitamonitor-analytics") as conn:
+                        built = await build_snapshot(conn, force=self.snapshot is None)
+                    if built is None:
+                        return None
+                    path, watermark = built
+        if self.snapshot is not None and self.snapshot.watermark == watermark:
+            return None
+        return await asyncio.to_thread(Snapshot, path, watermark)
+
+    async def _replace(self, watermark: str):
+        async with self._lock:
+            if self.snapshot is None or self.snapshot.watermark != watermark:
+                self.snapshot = await self._load(watermark) or self.snapshot
+
+    async def get(self) -> Snapshot:
+        """Instantánea para consultar: bloquea sólo si todavía no hay ninguna"""
+        watermark = await cache.current_watermark()
+        if self.snapshot is None:
+            await self._replace(watermark)
+        elif (
+            self.snapshot.watermark != watermark
+            and (self._refresh is None or self._refresh.done())
+            and (watermark != self._attempted or time.monotonic() - self._attempted_at >= RETRY_SECONDS)
+        ):
+            self._attempted, self._attempted_at = watermark, time.monotonic()
+            self._refresh = asyncio.create_task(self._replace(watermark))
+        return self.snapshot
+
+
+SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+analytics_store = AnalyticsStore()
+
+
+async def main():
+    import metrics
+    metrics.configure_logging()
+    conn = await asyncpg.connect(**db.DB_CONFIG)
+    try:
+        await build_snapshot(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,332 @@
+"""Generador de datos sintéticos para el esquema dw.
+
+Rellena dimensiones y hechos con distribuciones parecidas a las reales
+(organismos y adjudicatarios con actividad sesgada tipo Zipf, lotes, resultados,
+UTEs y jerarquía CPV) a la escala indicada. Con la misma semilla genera siempre
+los mismos datos. Las filas se vuelcan con COPY por bloques, así que la memoria
+no depende del número de licitaciones.
+
+Uso: python -m bench.generate --tenders 1000000 [--seed 42] [--truncate]
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import List, Tuple
+
+import asyncpg
+
+import db
+import metrics
+from ingest import PROCEDIMIENTOS, PROVINCIAS, TIPOS_ADMINISTRACION, TIPOS_CONTRATO, id_fecha
+
+CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+TABLES = [
+    "rel_resultado_ute_participante", "fact_resultado_lote", "rel_lote_cpv", "fact_lote",
+    "rel_licitacion_cpv", "fact_evento_licitacion", "fact_criterio_adjudicacion", "fact_licitacion",
+    "dim_adjudicatario", "dim_organo", "dim_cpv", "dim_tiempo",
+]
+
+SEQUENCES = {
+    "dim_organo_id_organo_seq": ("dim_organo", "id_organo"),
+    "dim_adjudicatario_id_adjudicatario_seq": ("dim_adjudicatario", "id_adjudicatario"),
+    "fact_licitacion_id_licitacion_seq": ("fact_licitacion", "id_licitacion"),
+    "fact_lote_id_lote_seq": ("fact_lote", "id_lote"),
+    "fact_resultado_lote_id_resultado_lote_seq": ("fact_resultado_lote", "id_resultado_lote"),
+    "rel_resultado_participante_id_seq": ("rel_resultado_ute_participante", "id_participacion"),
+    "fact_evento_licitacion_id_evento_seq": ("fact_evento_licitacion", "id_evento"),
+}
+
+# Divisiones CPV reales más habituales en la contratación pública
+CPV_DIVISIONES = {
+    "03": "Productos de la agricultura y la ganadería", "09": "Derivados del petróleo y combustibles",
+    "15": "Alimentos y bebidas", "18": "Prendas de vestir y calzado", "22": "Impresos",
+    "30": "Máquinas de oficina e informática", "31": "Máquinas y aparatos eléctricos",
+    "32": "Equipos de radio, televisión y telecomunicaciones", "33": "Equipamiento médico",
+    "34": "Equipos de transporte", "39": "Mobiliario", "42": "Maquinaria industrial",
+    "44": "Estructuras y materiales de construcción", "45": "Trabajos de construcción",
+    "48": "Paquetes de software", "50": "Servicios de reparación y mantenimiento",
+    "55": "Servicios de hostelería", "60": "Servicios de transporte", "64": "Servicios postales",
+    "66": "Servicios financieros y de seguros", "71": "Servicios de arquitectura e ingeniería",
+    "72": "Servicios TI", "73": "Servicios de investigación", "75": "Servicios de administración pública",
+    "77": "Servicios agrícolas y forestales", "79": "Servicios a empresas", "80": "Servicios de enseñanza",
+    "85": "Servicios de salud", "90": "Servicios de alcantarillado, basura y limpieza",
+    "92": "Servicios culturales y deportivos", "98": "Otros servicios comunitarios",
+}
+
+OBJETOS = [
+    "Servicio de limpieza", "Suministro de material", "Obras de urbanización", "Mantenimiento de",
+    "Servicio de vigilancia", "Redacción de proyecto", "Suministro de energía", "Servicio de transporte",
+    "Reforma de", "Asistencia técnica para", "Suministro de equipos", "Servicio de comedor",
+]
+ASUNTOS = [
+    "edificios municipales", "centros educativos", "vías públicas", "instalaciones deportivas",
+    "red de abastecimiento", "zonas verdes", "centro de salud", "sistemas informáticos",
+    "alumbrado público", "parque móvil", "dependencias administrativas", "biblioteca municipal",
+]
+EMPRESA_RAICES = [
+    "Construcciones", "Servicios", "Limpiezas", "Ingeniería", "Tecnologías", "Suministros",
+    "Obras", "Mantenimientos", "Consultoría", "Transportes", "Sistemas", "Instalaciones",
+]
+EMPRESA_NOMBRES = [
+    "Norte", "Sur", "Atlántico", "Mediterráneo", "Ibérica", "Central", "Galaica", "Levante",
+    "Cantábrico", "Meseta", "Ebro", "Duero", "Tajo", "Guadalquivir", "Miño", "Pirineo",
+]
+FORMAS = ["S.L.", "S.A.", "S.L.U.", "S.Coop."]
+MESES = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre",
+]
+
+
+def zipf_cum_weights(n: int, s: float) -> List[float]:
+    """Pesos acumulados de una distribución Zipf de exponente s sobre n elementos"""
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def cpv_hierarchy(rng: random.Random) -> List[Tuple[str, str, int, str]]:
+    """Códigos CPV de división a subcategoría con su código padre (8 dígitos)"""
+    rows = []
+    for division, descripcion in CPV_DIVISIONES.items():
+        root = division + "000000"
+        rows.append((root, descripcion, 1, None))
+        for g in rng.sample(range(1, 10), 3):
+            group = f"{division}{g}00000"
+            rows.append((group, f"{descripcion} - grupo {g}", 2, root))
+            for c in rng.sample(range(1, 10), 2):
+                clase = f"{division}{g}{c}0000"
+                rows.append((clase, f"{descripcion} - clase {g}{c}", 3, group))
+                for k in rng.sample(range(1, 10), 2):
+                    rows.append((f"{division}{g}{c}{k}000", f"{descripcion} - categoría {g}{c}{k}", 4, clase))
+    return rows
+
+
+class Generator:
+    def __init__(self, conn: asyncpg.Connection, tenders: int, seed: int, years: int):
+        self.conn = conn
+        self.tenders = tenders
+        self.rng = random.Random(seed)
+        self.today = date.today()
+        self.start = self.today - timedelta(days=365 * years)
+        self.n_organos = max(20, tenders // 500)
+        self.n_empresas = max(50, tenders // 10)
+
+    async def _next_id(self, table: str, column: str) -> int:
+        return await self.conn.fetchval(f"SELECT COALESCE(MAX({column}), 0) + 1 FROM dw.{table}")
+
+    async def _copy(self, table: str, columns: List[str], records: list):
+        if records:
+            await self.conn.copy_records_to_table(table, schema_name="dw", columns=columns, records=records)
+
+    async def dimensions(self):
+        rng = self.rng
+        days = (self.today + timedelta(days=365) - self.start).days
+        fechas = [self.start + timedelta(days=i) for i in range(days)]
+        existing = {row["id_fecha"] for row in await self.conn.fetch("SELECT id_fecha FROM dw.dim_tiempo")}
+        await self._copy("dim_tiempo", [
+            "id_fecha", "fecha", "anio", "trimestre", "mes", "dia", "nombre_mes", "semana_anio",
+        ], [
+            (id_fecha(d), d, d.year, (d.month - 1) // 3 + 1, d.month, d.day, MESES[d.month - 1], d.isocalendar()[1])
+            for d in fechas if id_fecha(d) not in existing
+        ])
+
+        existing = {row["codigo_cpv"] for row in await self.conn.fetch("SELECT codigo_cpv FROM dw.dim_cpv")}
+        cpvs = cpv_hierarchy(rng)
+        await self._copy("dim_cpv", ["codigo_cpv", "descripcion", "nivel", "codigo_padre"],
+                         [row for row in cpvs if row[0] not in existing])
+        self.cpv_leaves = [row[0] for row in cpvs if row[2] == 4]
+        self.cpv_weights = zipf_cum_weights(len(self.cpv_leaves), 0.8)
+
+        first = await self._next_id("dim_organo", "id_organo")
+        provincias = list(PROVINCIAS.items())
+        organos = []
+        for i in range(self.n_organos):
+            prefix, (provincia, comunidad) = rng.choice(provincias)
+            tipo = rng.choices(list(TIPOS_ADMINISTRACION.values()), weights=[10, 20, 55, 10, 5])[0]
+            organos.append((
+                first + i, f"GEN{first + i:08d}", f"P{prefix}{first + i:06d}",
+                f"{'Concello' if tipo == 'Administración Local' else 'Organismo'} sintético {first + i}",
+                tipo, comunidad, provincia, f"{prefix}{rng.randint(0, 999):03d}",
+                f"contratacion{first + i}@example.org",
+            ))
+        await self._copy("dim_organo", [
+            "id_organo", "cod_dir3", "nif", "nombre", "tipo_administracion", "comunidad_autonoma",
+            "provincia", "codigo_postal", "email_contacto",
+        ], organos)
+        self.organos = [row[0] for row in organos]
+        self.organo_weights = zipf_cum_weights(len(self.organos), 0.9)
+
+        first = await self._next_id("dim_adjudicatario", "id_adjudicatario")
+        empresas = []
+        for i in range(self.n_empresas):
+            nombre = f"{rng.choice(EMPRESA_RAICES)} {rng.choice(EMPRESA_NOMBRES)} {first + i} {rng.choice(FORMAS)}"
+            empresas.append((
+                first + i, f"G{first + i:08d}", nombre, rng.random() < 0.7, rng.choice(provincias)[1][0],
+            ))
+        await self._copy("dim_adjudicatario", ["id_adjudicatario", "nif", "nombre", "es_pyme", "provincia"], empresas)
+        self.empresas = [row[0] for row in empresas]
+        # Pocas empresas ganan la mayoría de los contratos
+        self.empresa_weights = zipf_cum_weights(len(self.empresas), 1.1)
+
+    def _tender(self, id_licitacion: int, ids: dict):
+        """Generar una licitación con sus lotes, resultados y UTEs"""
+        rng = self.rng
+        publicada = self.start + timedelta(days=rng.randrange((self.today - self.start).days))
+        limite = publicada + timedelta(days=rng.randint(8, 60))
+        vencida = limite < self.today
+        presupuesto = Decimal(round(rng.lognormvariate(11, 1.4), 2))
+        cpv = rng.choices(self.cpv_leaves, cum_weights=self.cpv_weights)[0]
+        n_lotes = 1 if rng.random() < 0.7 else rng.randint(2, 10)
+        tramitacion = rng.choices(["Ordinaria", "Urgente", "Emergencia"], weights=[90, 9, 1])[0]
+
+        lotes, lote_cpv, resultados, ute = [], [], [], []
+        adjudicados = 0
+        licitadores_total = 0
+        for n in range(1, n_lotes + 1):
+            ids["lote"] += 1
+            importe = (presupuesto / n_lotes).quantize(Decimal("0.01"))
+            lote_cpv_code = cpv if rng.random() < 0.8 else rng.choices(self.cpv_leaves, cum_weights=self.cpv_weights)[0]
+            lotes.append((ids["lote"], id_licitacion, str(n), f"Lote {n}", lote_cpv_code,
+                          importe, (importe * Decimal("1.21")).quantize(Decimal("0.01"))))
+            lote_cpv.append((ids["lote"], lote_cpv_code, True))
+            if not vencida or rng.random() > 0.88:
+                continue
+            licitadores = max(1, int(rng.expovariate(1 / 4)))
+            licitadores_total += licitadores
+            baja = Decimal(round(rng.betavariate(2, 8) * 0.5, 4))
+            adjudicacion = limite + timedelta(days=rng.randint(10, 90))
+            if adjudicacion > self.today:
+                adjudicacion = self.today
+            ids["resultado"] += 1
+            ganador = rng.choices(self.empresas, cum_weights=self.empresa_weights)[0]
+            es_ute = rng.random() < 0.05
+            nombre_ute = None
+            if es_ute:
+                socios = [ganador] + [s for s in rng.choices(self.empresas, cum_weights=self.empresa_weights,
+                                                             k=rng.randint(1, 2)) if s != ganador]
+                socios = list(dict.fromkeys(socios))
+                es_ute = len(socios) > 1
+                for i, socio in enumerate(socios if es_ute else []):
+                    ids["ute"] += 1
+                    ute.append((ids["ute"], ids["resultado"], socio, i == 0))
+                nombre_ute = f"UTE {ids['resultado']}" if es_ute else None
+            sin_iva = (importe * (1 - baja)).quantize(Decimal("0.01"))
+            resultados.append((
+                ids["resultado"], ids["lote"], ganador, id_fecha(adjudicacion), adjudicacion,
+                sin_iva, (sin_iva * Decimal("1.21")).quantize(Decimal("0.01")), licitadores,
+                rng.choice(["Adjudicado", "Formalizado"]), es_ute, nombre_ute, True,
+            ))
+            adjudicados += 1
+
+        if not vencida:
+            estado = "En plazo"
+        elif adjudicados:
+            estado = rng.choice(["Adjudicada", "Resuelta"])
+        else:
+            estado = rng.choices(["Desierta", "Anulada", "Pendiente de adjudicación"], weights=[60, 10, 30])[0]
+
+        licitacion = (
+            id_licitacion, f"GEN/{publicada.year}/{id_licitacion}",
+            rng.choices(self.organos, cum_weights=self.organo_weights)[0],
+            id_fecha(publicada), publicada, estado,
+            f"{rng.choice(OBJETOS)} {rng.choice(ASUNTOS)} ({id_licitacion})",
+            rng.choices(list(TIPOS_CONTRATO.values())[:3], weights=[30, 50, 20])[0],
+            (presupuesto * Decimal("1.2")).quantize(Decimal("0.01")), presupuesto,
+            (presupuesto * Decimal("1.21")).quantize(Decimal("0.01")), rng.choice([90, 180, 365, 730]),
+            rng.choices(list(PROCEDIMIENTOS.values())[:9], weights=[50, 3, 8, 4, 1, 15, 5, 1, 13])[0],
+            tramitacion, n_lotes, licitadores_total if vencida else None, limite, (limite - publicada).days,
+            tramitacion != "Ordinaria", n_lotes > 1,
+        )
+        return licitacion, (id_licitacion, cpv, True), lotes, lote_cpv, resultados, ute
+
+    async def facts(self):
+        ids = {
+            "lote": await self._next_id("fact_lote", "id_lote") - 1,
+            "resultado": await self._next_id("fact_resultado_lote", "id_resultado_lote") - 1,
+            "ute": await self._next_id("rel_resultado_ute_participante", "id_participacion") - 1,
+        }
+        first = await self._next_id("fact_licitacion", "id_licitacion")
+        started = time.monotonic()
+        for chunk_start in range(0, self.tenders, CHUNK_SIZE):
+            tables = {name: [] for name in ("licitacion", "licitacion_cpv", "lote", "lote_cpv", "resultado", "ute")}
+            for offset in range(chunk_start, min(chunk_start + CHUNK_SIZE, self.tenders)):
+                licitacion, licitacion_cpv, lotes, lote_cpv, resultados, ute = self._tender(first + offset, ids)
+                tables["licitacion"].append(licitacion)
+                tables["licitacion_cpv"].append(licitacion_cpv)
+                tables["lote"].extend(lotes)
+                tables["lote_cpv"].extend(lote_cpv)
+                tables["resultado"].extend(resultados)
+                tables["ute"].extend(ute)
+            async with self.conn.transaction():
+                await self._copy("fact_licitacion", [
+                    "id_licitacion", "contract_folder_id", "id_organo", "id_fecha_publicacion",
+                    "fecha_publicacion", "estado", "objeto_contrato", "tipo_contrato", "valor_estimado",
+                    "presupuesto_base_sin_iva", "presupuesto_base_con_iva", "plazo_ejecucion_dias",
+                    "tipo_procedimiento", "tramitacion", "num_lotes", "num_licitadores_total",
+                    "fecha_limite_ofertas", "dias_para_ofertar", "es_urgente", "es_lote_multiple",
+                ], tables["licitacion"])
+                await self._copy("rel_licitacion_cpv", ["id_licitacion", "codigo_cpv", "es_principal"],
+                                 tables["licitacion_cpv"])
+                await self._copy("fact_lote", [
+                    "id_lote", "id_licitacion", "numero_lote", "objeto_lote", "id_cpv_principal",
+                    "importe_lote_sin_iva", "importe_lote_con_iva",
+                ], tables["lote"])
+                await self._copy("rel_lote_cpv", ["id_lote", "codigo_cpv", "es_principal"], tables["lote_cpv"])
+                await self._copy("fact_resultado_lote", [
+                    "id_resultado_lote", "id_lote", "id_adjudicatario", "id_fecha_adjudicacion",
+                    "fecha_adjudicacion", "importe_adjudicacion_sin_iva", "importe_adjudicacion_con_iva",
+                    "numero_licitadores", "resultado", "es_ute", "nombre_ute_virtual", "es_exito",
+                ], tables["resultado"])
+                await self._copy("rel_resultado_ute_participante", [
+                    "id_participacion", "id_resultado_lote", "id_adjudicatario", "es_lider_ute",
+                ], tables["ute"])
+            done = min(chunk_start + CHUNK_SIZE, self.tenders)
+            rate = done / max(time.monotonic() - started, 1e-9)
+            logger.info("generated", extra={"tenders": done, "total": self.tenders, "per_second": round(rate)})
+
+    async def sync_sequences(self):
+        """Dejar las secuencias por encima de los ids generados"""
+        for sequence, (table, column) in SEQUENCES.items():
+            await self.conn.execute(
+                f"SELECT setval('dw.{sequence}', GREATEST((SELECT MAX({column}) FROM dw.{table}), 1))"
+            )
+
+
+async def generate(tenders: int, seed: int = 42, years: int = 5, truncate: bool = False, refresh: bool = True):
+    conn = await asyncpg.connect(**db.DB_CONFIG)
+    try:
+        if truncate:
+            await conn.execute(f"TRUNCATE {', '.join('dw.' + table for table in TABLES)} CASCADE")
+        generator = Generator(conn, tenders, seed, years)
+        await generator.dimensions()
+        await generator.facts()
+        await generator.sync_sequences()
+        await conn.execute(f"ANALYZE {', '.join('dw.' + table for table in TABLES)}")
+        if refresh:
+            from refresh import run_refresh
+            await run_refresh(conn, full=True)
+    finally:
+        await conn.close()
+
+
+def main():
+    metrics.configure_logging()
+    parser = argparse.ArgumentParser(description="Generar datos sintéticos en el esquema dw")
+    parser.add_argument("--tenders", type=int, default=10000, help="número de licitaciones")
+    parser.add_argument("--seed", type=int, default=42, help="semilla (misma semilla, mismos datos)")
+    parser.add_argument("--years", type=int, default=5, help="años de histórico hasta hoy")
+    parser.add_argument("--truncate", action="store_true", help="vaciar las tablas dw antes de generar")
+    parser.add_argument("--no-refresh", action="store_true", help="no recalcular las tablas precalculadas")
+    args = parser.parse_args()
+    asyncio.run(generate(args.tenders, args.seed, args.years, args.truncate, not args.no_refresh))
+
+
+if __name__ == "__main__":
+    main()
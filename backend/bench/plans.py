@@ -0,0 +1,299 @@
+"""Regresiones de planes de las sentencias de la API.
+
+Ejecuta EXPLAIN (ANALYZE, BUFFERS) de cada sentencia registrada con db.prepared (las de
+main.py y los módulos que importa) con parámetros de ejemplo tomados de la base de datos,
+dentro de una transacción que se deshace, y falla si algún plan:
+
+- recorre secuencialmente una tabla de más de --seq-scan-rows filas que no esté permitida
+  para esa sentencia (SEQ_SCAN_ALLOWED), o
+- lee más bloques compartidos (hit + read) que su presupuesto (BUFFER_BUDGETS, o
+  --buffer-budget por defecto).
+
+Pensado para ejecutarse sobre los datos de bench.generate; los presupuestos están
+calculados para --tenders 10000..100000.
+
+Uso: python -m bench.plans [--only tenders_active ...] [--skip tender_create ...] [--analyze] [--generic-plans]
+"""
+import argparse
+import asyncio
+import json
+import sys
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+
+import db
+import main as api  # registra las sentencias de la API
+from graph import GRAPH_MARKS_SQL
+from normalize import normalize_name, normalize_nif
+from subscriptions import subscription_params
+
+# Tablas que se pueden recorrer enteras sin fallar: sin filtro selectivo que indexar.
+# Las claves son sentencias o variantes concretas ("nombre[i]", ver samples)
+SEQ_SCAN_ALLOWED = {
+    # Construcción completa del grafo
+    "graph_results[0]": {"fact_resultado_lote", "fact_lote"},
+    "graph_ute[0]": {"rel_resultado_ute_participante", "fact_resultado_lote", "fact_lote"},
+    "graph_groups": {"dim_adjudicatario"},
+    # Rankings: leen todos los resultados con éxito (con el índice parcial si son pocos)
+    "competition_top": {"dim_adjudicatario", "fact_resultado_lote"},
+    "competition_top_groups": {"dim_adjudicatario", "fact_resultado_lote"},
+    "market_organisms": {"kpi_organo_mes", "dim_organo"},
+    "trends": {"agg_tendencia_mes"},
+}
+
+# Bloques compartidos (8 kB) por ejecución; None = sin límite (construcción completa)
+BUFFER_BUDGETS = {
+    "graph_results[0]": None,
+    "graph_ute[0]": None,
+    "graph_groups": None,
+    "competition_top": None,
+    "competition_top_groups": None,
+    "market_organisms": 20000,
+    "trends": 20000,
+    # Con filtro de provincia recorre la ventana de 90 días del índice de no adjudicadas
+    "tenders_deserted": 50000,
+    # Búsqueda de adjudicatarios: sólo índices, también con --generic-plans
+    "adjudicatarios_search": 1000,
+    "adjudicatarios_search_nif": 1000,
+    "adjudicatarios_search_prefix": 1000,
+}
+
+# Nodos que leen una tabla entera
+SEQ_SCAN_NODES = ("Seq Scan", "Parallel Seq Scan")
+
+
+async def sample_values(conn: asyncpg.Connection) -> dict:
+    """Identificadores reales con los que construir los parámetros de ejemplo"""
+    return {
+        "tender": await conn.fetchval("SELECT MAX(id_licitacion) FROM dw.fact_licitacion"),
+        "adjudicatario": await conn.fetchval("""
+            SELECT id_adjudicatario FROM dw.fact_resultado_lote WHERE es_exito
+            GROUP BY id_adjudicatario ORDER BY COUNT(*) DESC LIMIT 1
+        """),
+        # Empresa típica (pocas adjudicaciones): la mayor de la cola de Zipf lee media tabla
+        "adjudicatario_tipico": await conn.fetchval("""
+            SELECT id_adjudicatario FROM dw.fact_resultado_lote WHERE es_exito
+            GROUP BY id_adjudicatario HAVING COUNT(*) >= 10 ORDER BY COUNT(*), id_adjudicatario LIMIT 1
+        """),
+        "nif": await conn.fetchval("SELECT nif FROM dw.dim_adjudicatario WHERE nif IS NOT NULL LIMIT 1") or "",
+        "organo": await conn.fetchrow("""
+            SELECT id_organo, comunidad_autonoma, provincia FROM dw.dim_organo
+            WHERE provincia IS NOT NULL ORDER BY id_organo LIMIT 1
+        """),
+        "cpv": await conn.fetchval("SELECT codigo_cpv FROM dw.dim_cpv ORDER BY nivel DESC, codigo_cpv LIMIT 1"),
+        "suscripcion": await conn.fetchval("SELECT MIN(id_suscripcion) FROM dw.suscripcion") or 0,
+        "marcas": await conn.fetchrow(GRAPH_MARKS_SQL.sql),
+        "cambio": await conn.fetchval("SELECT COALESCE(MAX(id_cambio), 0) FROM dw.log_cambios"),
+    }
+
+
+def samples(v: dict) -> Dict[str, List[Tuple]]:
+    """Parámetros de ejemplo por sentencia: una tupla por variante a comprobar"""
+    organo = v["organo"] or {"id_organo": 0, "comunidad_autonoma": None, "provincia": None}
+    ccaa, provincia = organo["comunidad_autonoma"], organo["provincia"]
+    marcas = v["marcas"]
+    today = date.today()
+    subscription = subscription_params({"name": "bench", "cpvs": [v["cpv"] or "*"], "budget_min": 1000})
+    search, search_nif = normalize_name("servicios"), normalize_nif("servicios")
+    digits = normalize_nif(v["nif"])[1:6]
+    return {
+        "cache_watermark": [()],
+        "changes": [(0, None, 1000), (max(v["cambio"] - 100, 0), ["adjudicacion"], 1000)],
+        "changes_head": [()],
+        "graph_marks": [()],
+        "graph_touched": [(
+            max(marcas[0] - 100, 0), marcas[0], max(marcas[1] - 100, 0), marcas[1], max(marcas[2] - 1, 0), marcas[2]
+        )],
+        "graph_results": [(None, marcas[0]), ([v["tender"]], marcas[0])],
+        "graph_ute": [(None, marcas[1]), ([v["tender"]], marcas[1])],
+        "graph_companies": [([v["adjudicatario"]],)],
+        "graph_groups": [()],
+        "subscription_inbox": [(v["suscripcion"], 0, 100)],
+        "subscription_new_matches": [(0, [v["suscripcion"]])],
+        "subscriptions_list": [()],
+        "subscription_get": [(v["suscripcion"],)],
+        "subscription_create": [subscription],
+        "subscription_update": [(v["suscripcion"], *subscription)],
+        "subscription_delete": [(v["suscripcion"],)],
+        "subscription_last_match": [()],
+        "tenders_active": [
+            (None, None, None, None, 100),
+            (today + timedelta(days=30), 0, ccaa, provincia, 100),
+        ],
+        "tenders_deserted": [
+            (None, None, None, None, 100),
+            (today - timedelta(days=30), 0, ccaa, provincia, 100),
+        ],
+        "tenders_list": [
+            (None, None, None, None, 100),
+            (v["tender"], ccaa, provincia, today.year - 1, 100),
+        ],
+        "tender_get": [(1,)],
+        "tender_create": [("bench", "bench", "bench", 1000.0, today, "Abierta")],
+        "tender_update": [("bench", "bench", "bench", 1000.0, today, "Abierta", 1)],
+        "tender_delete": [(1,)],
+        "market_organisms": [(None, None, None, None, 20), (ccaa, None, today.replace(year=today.year - 1), today, 20)],
+        "market_cpv": [(None, 1, 100), (v["cpv"][:2].ljust(8, "0") if v["cpv"] else None, 1, 100)],
+        "market_cpv_path": [(v["cpv"],)],
+        "trends": [
+            ("month", False, False, False, None, None, None, None, None, 5000),
+            ("quarter", True, True, False, None, None, organo["id_organo"], None, None, 5000),
+        ],
+        "competition_top": [()],
+        "competition_top_groups": [()],
+        "adjudicatarios_search": [(search, search_nif, api.prefix_end(search_nif), 50)],
+        "adjudicatarios_search_nif": [(normalize_name(digits), digits, 50)],
+        "adjudicatarios_search_prefix": [
+            (search[:2], api.prefix_end(search[:2]), search_nif[:2], api.prefix_end(search_nif[:2]), 50),
+        ],
+        "adjudicatario_tenders": [(v["adjudicatario"], None, None, 100)],
+        "report_adjudicaciones": [([v["adjudicatario_tipico"]], True, today - timedelta(days=5 * 365), None)],
+    }
+
+
+def walk(plan: dict):
+    """Nodos del plan en preorden"""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+
+async def table_rows(conn: asyncpg.Connection) -> Dict[str, float]:
+    """Filas estimadas de cada tabla de dw (pg_class.reltuples)"""
+    rows = await conn.fetch("""
+        SELECT c.relname, c.reltuples
+        FROM pg_class c INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'dw' AND c.relkind IN ('r', 'm', 'p')
+    """)
+    return {row["relname"]: row["reltuples"] for row in rows}
+
+
+async def explain(conn: asyncpg.Connection, sql: str, args: Tuple, generic: bool = False) -> dict:
+    """Plan real de una ejecución, deshaciendo lo que escriba.
+
+    EXPLAIN con parámetros planifica con sus valores (plan personalizado); para ver el
+    plan genérico la sentencia se prepara con PREPARE y se ejecuta con EXECUTE, pasando
+    los valores como literales.
+    """
+    transaction = conn.transaction()
+    await transaction.start()
+    try:
+        if not generic:
+            raw = await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", *args)
+        else:
+            await conn.execute(f"PREPARE bench_plan AS {sql}")
+            types = await conn.fetchval(
+                "SELECT parameter_types::text[] FROM pg_prepared_statements WHERE name = 'bench_plan'"
+            )
+            literals = [
+                f"{await conn.fetchval(f'SELECT quote_nullable($1::{type_})', value)}::{type_}"
+                for type_, value in zip(types, args)
+            ]
+            raw = await conn.fetchval(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) EXECUTE bench_plan({', '.join(literals)})"
+                if literals else "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) EXECUTE bench_plan"
+            )
+    finally:
+        await transaction.rollback()
+        if generic:
+            await conn.execute("DEALLOCATE bench_plan")
+    return (json.loads(raw) if isinstance(raw, str) else raw)[0]
+
+
+def shared_buffers(plan: dict) -> int:
+    """Bloques compartidos leídos por el plan (en caché o de disco)"""
+    return plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+
+
+def check(
+    name: str, label: str, plan: dict, sizes: Dict[str, float], seq_scan_rows: int, budget: Optional[int]
+) -> List[str]:
+    """Problemas del plan de una variante de una sentencia"""
+    problems = []
+    allowed = SEQ_SCAN_ALLOWED.get(label, SEQ_SCAN_ALLOWED.get(name, set()))
+    for node in walk(plan):
+        table = node.get("Relation Name")
+        if node["Node Type"] in SEQ_SCAN_NODES and table not in allowed and sizes.get(table, 0) >= seq_scan_rows:
+            problems.append(f"seq scan on {table} ({sizes[table]:.0f} rows)")
+    buffers = shared_buffers(plan)
+    if budget is not None and buffers > budget:
+        problems.append(f"{buffers} shared buffers > budget {budget}")
+    return problems
+
+
+async def run(
+    only: Optional[List[str]], skip: List[str], seq_scan_rows: int, buffer_budget: int, analyze: bool,
+    generic_plans: bool
+) -> Tuple[dict, List[str]]:
+    conn = await asyncpg.connect(**db.DB_CONFIG)
+    try:
+        if analyze:
+            await conn.execute("ANALYZE")
+        if generic_plans:
+            # El plan que acaba usando una sentencia preparada tras varias ejecuciones
+            await conn.execute("SET plan_cache_mode = force_generic_plan")
+        sizes = await table_rows(conn)
+        params = samples(await sample_values(conn))
+        report, failures = {}, []
+        for name, statement in sorted(db.STATEMENTS.items()):
+            if (only and name not in only) or name in skip:
+                continue
+            if name not in params:
+                failures.append(f"{name}: no sample parameters in bench/plans.py")
+                continue
+            for variant, args in enumerate(params[name]):
+                label = f"{name}[{variant}]"
+                budget = BUFFER_BUDGETS.get(label, BUFFER_BUDGETS.get(name, buffer_budget))
+                try:
+                    result = await explain(conn, statement.sql, args, generic_plans)
+                except Exception as e:
+                    failures.append(f"{label}: {type(e).__name__}: {e}")
+                    continue
+                plan = result["Plan"]
+                buffers = shared_buffers(plan)
+                problems = check(name, label, plan, sizes, seq_scan_rows, budget)
+                report[label] = {
+                    "ms": round(result.get("Execution Time", 0), 2),
+                    "buffers": buffers,
+                    "rows": plan.get("Actual Rows", 0),
+                    "problems": problems,
+                }
+                print(f"{label:32} {report[label]['ms']:>10}ms buffers={buffers:<8} "
+                      f"{'; '.join(problems) if problems else 'ok'}")
+                failures.extend(f"{label}: {problem}" for problem in problems)
+        return report, failures
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regresiones de planes de las sentencias de la API")
+    parser.add_argument("--only", nargs="*", help="limitar a estas sentencias (por nombre)")
+    parser.add_argument("--skip", nargs="*", default=[], help="omitir estas sentencias")
+    parser.add_argument("--seq-scan-rows", type=int, default=10000,
+                        help="filas a partir de las cuales un seq scan no permitido es un fallo")
+    parser.add_argument("--buffer-budget", type=int, default=2000,
+                        help="bloques compartidos por ejecución para las sentencias sin presupuesto propio")
+    parser.add_argument("--analyze", action="store_true", help="ANALYZE antes de medir (estadísticas al día)")
+    parser.add_argument("--generic-plans", action="store_true",
+                        help="comprobar el plan genérico (sin los valores de los parámetros)")
+    parser.add_argument("--output", help="guardar el informe en este fichero JSON")
+    args = parser.parse_args()
+
+    report, failures = asyncio.run(run(
+        args.only, args.skip, args.seq_scan_rows, args.buffer_budget, args.analyze, args.generic_plans
+    ))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    if failures:
+        print(f"{len(failures)} plan regressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Benchmark de los endpoints de la API.
+
+Lanza peticiones concurrentes contra cada endpoint y mide latencias (p50/p95/p99),
+throughput y filas leídas por PostgreSQL (diferencia de pg_stat_user_tables antes y
+después de cada endpoint). El resultado se guarda en JSON; con --baseline se compara
+con una ejecución anterior y se sale con error si algún p95 empeora más de lo permitido.
+
+Uso: python -m bench.run --base-url http://localhost:8000 [--requests 200] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import asyncpg
+
+import db
+
+# (nombre, ruta) de cada endpoint de main.py; {adjudicatario} se sustituye por --adjudicatario-id
+ENDPOINTS = [
+    ("tenders_active", "/api/tenders/active"),
+    ("tenders_active_columns", "/api/tenders/active?format=columns"),
+    ("tenders_deserted", "/api/tenders/deserted"),
+    ("tenders_list", "/api/tenders?limit=100"),
+    ("tenders_export_ndjson", "/api/tenders?format=ndjson"),
+    ("market_organisms", "/api/market/organisms"),
+    ("trends", "/api/trends?group_by=cpv&granularity=trimestre"),
+    ("competition_top", "/api/competition/top"),
+    ("competition_network", "/api/competition/network"),
+    ("adjudicatarios_search", "/api/adjudicatarios/search?q=servicios"),
+    ("adjudicatario_tenders", "/api/adjudicatarios/{adjudicatario}/tenders"),
+    ("health", "/api/health"),
+]
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+STATS_SQL = """
+    SELECT
+        COALESCE(SUM(seq_tup_read), 0) as seq_tup_read,
+        COALESCE(SUM(idx_tup_fetch), 0) as idx_tup_fetch,
+        COALESCE(SUM(seq_scan), 0) as seq_scan
+    FROM pg_stat_user_tables
+    WHERE schemaname = 'dw'
+"""
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil con interpolación lineal (values ordenados)"""
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def timed_request(url: str, timeout: float):
+    """Hacer una petición GET y devolver (segundos, bytes, error)"""
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            size = len(response.read())
+        return time.perf_counter() - started, size, None
+    except (urllib.error.URLError, OSError) as e:
+        return time.perf_counter() - started, 0, str(e)
+
+
+class TableStats:
+    """Lecturas de filas acumuladas en pg_stat_user_tables (opcional)"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+        self.conn = None
+        try:
+            self.conn = self.loop.run_until_complete(asyncpg.connect(**db.DB_CONFIG))
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Rows scanned not available: {str(e)}")
+
+    def snapshot(self) -> Optional[Dict[str, int]]:
+        if self.conn is None:
+            return None
+        # Las estadísticas se publican con cierto retraso tras cada transacción
+        time.sleep(self.delay)
+        self.loop.run_until_complete(self.conn.execute("SELECT pg_stat_clear_snapshot()"))
+        row = self.loop.run_until_complete(self.conn.fetchrow(STATS_SQL))
+        return {key: int(value) for key, value in row.items()}
+
+    def close(self):
+        if self.conn is not None:
+            self.loop.run_until_complete(self.conn.close())
+        self.loop.close()
+
+
+def bench_endpoint(base_url: str, path: str, requests: int, concurrency: int, timeout: float, stats: TableStats):
+    url = base_url.rstrip("/") + path
+    # Primera petición aparte: sin caché de respuestas ni planes preparados
+    cold, _, cold_error = timed_request(url, timeout)
+    before = stats.snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(lambda _: timed_request(url, timeout), range(requests)))
+    elapsed = time.perf_counter() - started
+    after = stats.snapshot()
+
+    latencies = sorted(seconds * 1000 for seconds, _, error in samples if error is None)
+    errors = [error for _, _, error in samples if error is not None]
+    result = {
+        "path": path,
+        "requests": requests,
+        "errors": len(errors) + (1 if cold_error else 0),
+        "cold_ms": round(cold * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else None,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        "bytes_per_request": round(statistics.fmean(size for _, size, error in samples if error is None))
+        if latencies else 0,
+    }
+    if before is not None and after is not None:
+        scanned = (after["seq_tup_read"] - before["seq_tup_read"]) + (after["idx_tup_fetch"] - before["idx_tup_fetch"])
+        result["rows_scanned"] = scanned
+        result["rows_scanned_per_request"] = round(scanned / requests, 1)
+        result["seq_scans"] = after["seq_scan"] - before["seq_scan"]
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def compare(current: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Endpoints cuyo p95 ha empeorado más de max_regression (fracción) respecto a baseline"""
+    regressions = []
+    for name, result in current["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous or not previous.get("p95_ms"):
+            continue
+        change = (result["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"]
+        print(f"  {name}: p95 {previous['p95_ms']} -> {result['p95_ms']} ms ({change:+.0%})")
+        if change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los endpoints de la API")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=200, help="peticiones por endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="peticiones simultáneas")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout por petición (s)")
+    parser.add_argument("--only", nargs="*", help="limitar a estos endpoints (por nombre)")
+    parser.add_argument("--adjudicatario-id", type=int, default=1)
+    parser.add_argument("--stats-delay", type=float, default=1.0,
+                        help="espera antes de leer pg_stat_user_tables (s)")
+    parser.add_argument("--label", default="", help="etiqueta libre guardada con el resultado")
+    parser.add_argument("--output", help="fichero JSON de salida (por defecto bench/results/<fecha>.json)")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="empeoramiento máximo permitido del p95 frente a --baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    stats = TableStats(args.stats_delay)
+    run = {
+        "label": args.label,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "base_url": args.base_url,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "endpoints": {},
+    }
+    try:
+        for name, path in ENDPOINTS:
+            if args.only and name not in args.only:
+                continue
+            path = path.format(adjudicatario=args.adjudicatario_id)
+            result = bench_endpoint(args.base_url, path, args.requests, args.concurrency, args.timeout, stats)
+            run["endpoints"][name] = result
+            print(
+                f"{name:24} p50={result['p50_ms']:>8}ms p95={result['p95_ms']:>8}ms p99={result['p99_ms']:>8}ms "
+                f"rps={result['throughput_rps']} rows/req={result.get('rows_scanned_per_request', '-')} "
+                f"errors={result['errors']}"
+            )
+    finally:
+        stats.close()
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(run, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"Results saved to {output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(run, baseline, args.max_regression)
+        if regressions:
+            print(f"p95 regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark de la serialización de respuestas (sin base de datos).
+
+Compara, con filas como las de /api/tenders/active, el camino por defecto de FastAPI
+(jsonable_encoder + json.dumps), orjson sobre diccionarios, orjson en formato por
+columnas y el tamaño/tiempo de comprimir el resultado con gzip y brotli.
+
+Uso: python -m bench.serialization [--rows 1000] [--repeat 20]
+"""
+import argparse
+import gzip
+import json
+import random
+import statistics
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Callable, List
+
+from fastapi.encoders import jsonable_encoder
+
+from responses import columnar_from_dicts, dumps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def sample_rows(count: int, seed: int = 42) -> List[dict]:
+    rng = random.Random(seed)
+    today = date.today()
+    return [
+        {
+            "id": 100000 + index,
+            "title": f"Servicio de mantenimiento de instalaciones municipales ({index})",
+            "description": rng.choice(["Obras", "Servicios", "Suministros"]) + " - Ordinaria",
+            "organism": f"Concello de ejemplo {rng.randint(1, 300)}",
+            "budget": Decimal(rng.randint(1000, 5000000)) / 100,
+            "deadline": today + timedelta(days=rng.randint(0, 60)),
+            "status": "En plazo",
+            "url": f"https://contrataciondelestado.es/expediente/{index}" if rng.random() < 0.8 else None,
+        }
+        for index in range(count)
+    ]
+
+
+def measure(func: Callable[[], bytes], repeat: int):
+    """Mediana en ms de repeat ejecuciones y el resultado de la última"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de serialización de respuestas")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = sample_rows(args.rows)
+    scale = 1000 / args.rows
+    variants = {
+        "jsonable_encoder+json": lambda: json.dumps(jsonable_encoder(rows)).encode(),
+        "orjson dicts": lambda: dumps(rows),
+        "orjson columns": lambda: dumps(columnar_from_dicts(rows)),
+    }
+    print(f"{args.rows} rows, median of {args.repeat} runs (ms per 1k rows)")
+    bodies = {}
+    for name, func in variants.items():
+        elapsed, bodies[name] = measure(func, args.repeat)
+        print(f"  {name:24} {elapsed * scale:8.2f} ms  {len(bodies[name]):>9} bytes")
+
+    for name in ("orjson dicts", "orjson columns"):
+        body = bodies[name]
+        elapsed, compressed = measure(lambda: gzip.compress(body, compresslevel=9), args.repeat)
+        print(f"  {name + ' gzip':24} {elapsed * scale:8.2f} ms  {len(compressed):>9} bytes")
+        if brotli is not None:
+            # Mismo nivel que usa brotli-asgi por defecto
+            elapsed, compressed = measure(lambda: brotli.compress(body, quality=4), args.repeat)
+            print(f"  {name + ' brotli':24} {elapsed * scale:8.2f} ms  {len(compressed):>9} bytes")
+
+
+if __name__ == "__main__":
+    main()
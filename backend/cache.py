@@ -0,0 +1,184 @@
+"""Caché de respuestas para los endpoints analíticos, invalidada por marca de agua."""
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+import db
+import metrics
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # redis es opcional: sin él la caché es sólo local
+    aioredis = None
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "900"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "512"))
+# Frecuencia máxima con la que se consulta la marca de agua en la base de datos
+WATERMARK_CHECK_SECONDS = float(os.getenv("CACHE_WATERMARK_CHECK_SECONDS", "5"))
+# Backend compartido entre workers (opcional), p.ej. redis://localhost:6379/0
+REDIS_URL = os.getenv("CACHE_REDIS_URL")
+
+# La marca de agua es la que guarda refresh.py al terminar todos sus pasos (proceso
+# "refresco_completo"): cubre las licitaciones modificadas (id_carga del diario) y no cambia
+# hasta que las tablas precalculadas están al día. Se lee del primario para que sea monótona
+# entre consultas consecutivas (las réplicas se reparten por turnos y pueden ir atrasadas).
+WATERMARK_SQL = db.prepared("cache_watermark", """
+    SELECT COALESCE((
+        SELECT id_licitacion || ':' || id_resultado_lote || ':' || id_carga
+        FROM dw.etl_marca WHERE proceso = 'refresco_completo'
+    ), '0:0:0') as watermark
+""")
+
+_MISS = object()
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Caché LRU en memoria con caducidad por entrada"""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISS
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return _MISS
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+response_cache = ResponseCache()
+
+_watermark: Optional[str] = None
+_watermark_checked = 0.0
+_watermark_lock = asyncio.Lock()
+_redis = None
+# Cálculos en curso por clave: las peticiones idénticas simultáneas esperan al mismo
+_inflight: "dict[str, asyncio.Task]" = {}
+
+
+async def current_watermark() -> str:
+    """Obtener la marca de agua de los datos, consultándola como mucho cada pocos segundos"""
+    global _watermark, _watermark_checked
+    if _watermark is not None and time.monotonic() - _watermark_checked < WATERMARK_CHECK_SECONDS:
+        return _watermark
+    async with _watermark_lock:
+        if _watermark is None or time.monotonic() - _watermark_checked >= WATERMARK_CHECK_SECONDS:
+            watermark = await db.fetchval(WATERMARK_SQL)
+            if watermark != _watermark:
+                # Nueva carga de datos: todo lo cacheado ha quedado obsoleto
+                response_cache.clear()
+                _watermark = watermark
+            _watermark_checked = time.monotonic()
+    return _watermark
+
+
+def _shared_backend():
+    global _redis
+    if _redis is None and REDIS_URL and aioredis is not None:
+        _redis = aioredis.from_url(REDIS_URL)
+    return _redis
+
+
+async def _shared_get(key: str) -> Any:
+    backend = _shared_backend()
+    if backend is None:
+        return _MISS
+    try:
+        raw = await backend.get(key)
+    except Exception as e:
+        logger.warning("error reading shared cache", extra={"error": str(e)})
+        return _MISS
+    return _MISS if raw is None else json.loads(raw)
+
+
+async def _shared_set(key: str, value: Any):
+    backend = _shared_backend()
+    if backend is None:
+        return
+    try:
+        await backend.set(key, json.dumps(value), ex=int(CACHE_TTL_SECONDS))
+    except Exception as e:
+        logger.warning("error writing shared cache", extra={"error": str(e)})
+
+
+def cache_key(endpoint: str, watermark: str, params: dict) -> str:
+    query = "&".join(f"{name}={params[name]}" for name in sorted(params))
+    return f"licitamonitor:{endpoint}:{watermark}:{query}"
+
+
+def cached(endpoint: str):
+    """Decorador para cachear la respuesta de un endpoint según sus parámetros.
+
+    La clave incluye la marca de agua, así que una carga nueva invalida
+    automáticamente las entradas anteriores (también en el backend compartido).
+    Si la misma clave ya se está calculando, la petición espera ese resultado
+    en lugar de lanzar otra vez las consultas.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        async def fill(key: str, args: tuple, kwargs: dict) -> Any:
+            value = await _shared_get(key)
+            if value is _MISS:
+                metrics.CACHE_REQUESTS.inc(endpoint, "miss")
+                value = jsonable_encoder(await func(*args, **kwargs))
+                await _shared_set(key, value)
+            else:
+                metrics.CACHE_REQUESTS.inc(endpoint, "shared_hit")
+            response_cache.set(key, value)
+            return value
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            watermark = await current_watermark()
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = cache_key(endpoint, watermark, bound.arguments)
+            value = response_cache.get(key)
+            if value is not _MISS:
+                metrics.CACHE_REQUESTS.inc(endpoint, "hit")
+                return value
+            task = _inflight.get(key)
+            if task is None:
+                task = asyncio.create_task(fill(key, args, kwargs))
+                _inflight[key] = task
+                task.add_done_callback(lambda _: _inflight.pop(key, None))
+            else:
+                metrics.CACHE_REQUESTS.inc(endpoint, "coalesced")
+            # shield: si un cliente se desconecta, el cálculo sigue para los demás
+            return await asyncio.shield(task)
+        return wrapper
+    return decorator
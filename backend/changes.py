@@ -0,0 +1,51 @@
+"""Registro de cambios (dw.log_cambios) para clientes que sincronizan en lugar de recargar.
+
+ingest.py anota en cada lote las licitaciones nuevas, los cambios de estado, las nuevas
+versiones del expediente y las adjudicaciones nuevas, en la misma transacción que los
+hechos. id_cambio es el cursor: /api/changes?since=N devuelve los cambios posteriores a N
+con una lectura por rango de la clave primaria, así que el coste depende del número de
+cambios y no del tamaño de las tablas.
+
+Para que el cursor sea monótono también en lo visible, las escrituras se serializan con
+un bloqueo consultivo hasta el commit: un lector nunca ve el cambio N+1 sin el N.
+"""
+from typing import List, Tuple
+
+import asyncpg
+
+import db
+
+CHANGE_TYPES = ("alta", "estado", "modificacion", "adjudicacion")
+MAX_BATCH_SIZE = 5000
+# Clave del bloqueo consultivo de los escritores del registro
+LOG_LOCK_KEY = 0x6C6F675F63616D62
+
+CHANGE_COLUMNS = [
+    "id_licitacion", "tipo", "estado", "numero_lote", "id_adjudicatario", "importe",
+]
+
+CHANGES_SQL = db.prepared("changes", """
+    SELECT
+        id_cambio as id,
+        tipo as type,
+        id_licitacion as "tenderId",
+        estado as status,
+        numero_lote as lot,
+        id_adjudicatario as "awardeeId",
+        importe::float as amount,
+        registrado_en as "recordedAt"
+    FROM dw.log_cambios
+    WHERE id_cambio > $1 AND ($2::varchar[] IS NULL OR tipo = ANY($2))
+    ORDER BY id_cambio
+    LIMIT $3
+""", replica=True)
+
+HEAD_SQL = db.prepared("changes_head", "SELECT COALESCE(MAX(id_cambio), 0) FROM dw.log_cambios", replica=True)
+
+
+async def record_changes(conn: asyncpg.Connection, changes: List[Tuple]):
+    """Anotar cambios (filas con CHANGE_COLUMNS) dentro de la transacción de la carga"""
+    if not changes:
+        return
+    await conn.execute("SELECT pg_advisory_xact_lock($1)", LOG_LOCK_KEY)
+    await conn.copy_records_to_table("log_cambios", schema_name="dw", records=changes, columns=CHANGE_COLUMNS)
@@ -0,0 +1,153 @@
+"""Agrupación de licitaciones relacionadas (dw.licitacion_cluster) y del historial de
+adjudicaciones de cada empresa por grupo (dw.agg_adjudicatario_cluster).
+
+Dos licitaciones del mismo organismo van al mismo grupo cuando su objeto normalizado
+es parecido (similitud de Jaccard entre palabras) y sus periodos se solapan o están
+próximos: así se juntan los marcos de acuerdo y los contratos que se licitan cada año.
+"""
+import math
+import os
+from collections import Counter
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+
+from normalize import normalize_title
+
+# Similitud mínima entre objetos normalizados para unir dos licitaciones
+CLUSTER_SIMILARITY = float(os.getenv("CLUSTER_SIMILARITY", "0.75"))
+# Holgura entre el final del periodo de un grupo y la publicación de la siguiente licitación
+CLUSTER_GAP_DAYS = int(os.getenv("CLUSTER_GAP_DAYS", "180"))
+# Periodo que se supone a las licitaciones sin plazo de ejecución
+DEFAULT_DURATION_DAYS = 365
+BATCH_SIZE = 5000
+
+# Organismos de las licitaciones afectadas (también el anterior si ha cambiado)
+CLUSTER_ORGANISMS_SQL = """
+    SELECT id_organo FROM dw.fact_licitacion WHERE id_licitacion = ANY($1)
+    UNION
+    SELECT id_organo FROM dw.licitacion_cluster WHERE id_licitacion = ANY($1)
+"""
+
+# Los grupos se recalculan por organismo completo. $1 NULL = todos.
+CLUSTER_TENDERS_SQL = """
+    SELECT id_licitacion, id_organo, fecha_publicacion, plazo_ejecucion_dias, objeto_contrato
+    FROM dw.fact_licitacion
+    WHERE $1::bigint[] IS NULL OR id_organo = ANY($1)
+    ORDER BY id_organo, fecha_publicacion, id_licitacion
+"""
+
+CLUSTER_DELETE_SQL = """
+    DELETE FROM dw.licitacion_cluster WHERE $1::bigint[] IS NULL OR id_organo = ANY($1)
+"""
+
+CLUSTER_HISTORY_DELETE_SQL = """
+    DELETE FROM dw.agg_adjudicatario_cluster WHERE $1::bigint[] IS NULL OR id_organo = ANY($1)
+"""
+
+CLUSTER_HISTORY_INSERT_SQL = """
+    INSERT INTO dw.agg_adjudicatario_cluster (
+        id_adjudicatario, id_cluster, id_organo, id_licitacion, objeto_contrato,
+        num_licitaciones, num_lotes, primera_adjudicacion, fecha_orden,
+        importe_total, presupuesto_total, url_expediente
+    )
+    SELECT
+        r.id_adjudicatario,
+        c.id_cluster,
+        c.id_organo,
+        MIN(l.id_licitacion),
+        (array_agg(l.objeto_contrato ORDER BY l.id_licitacion))[1],
+        COUNT(DISTINCT l.id_licitacion),
+        COUNT(DISTINCT lot.id_lote),
+        MIN(r.fecha_adjudicacion),
+        COALESCE(MIN(r.fecha_adjudicacion), MIN(l.fecha_publicacion)),
+        SUM(r.importe_adjudicacion_con_iva),
+        SUM(lot.importe_lote_con_iva),
+        MAX(l.url_expediente)
+    FROM dw.licitacion_cluster c
+    INNER JOIN dw.fact_licitacion l ON c.id_licitacion = l.id_licitacion
+    INNER JOIN dw.fact_lote lot ON lot.id_licitacion = l.id_licitacion
+    INNER JOIN dw.fact_resultado_lote r ON r.id_lote = lot.id_lote
+    WHERE r.es_exito = true
+      AND ($1::bigint[] IS NULL OR c.id_organo = ANY($1))
+    GROUP BY r.id_adjudicatario, c.id_cluster, c.id_organo
+"""
+
+
+def cluster_tenders(tenders: List[Tuple[int, date, Optional[int], str]]) -> List[Tuple[int, int, str]]:
+    """Agrupar las licitaciones de un organismo, ordenadas por fecha de publicación.
+
+    Recibe (id_licitacion, fecha_publicacion, plazo_ejecucion_dias, objeto_contrato) y
+    devuelve (id_licitacion, id_cluster, objeto_normalizado). Cada grupo se compara con
+    las palabras de su primera licitación; para no comparar con todos los grupos sólo se
+    indexan las palabras menos frecuentes de cada uno (prefix filtering: si la similitud
+    alcanza el umbral, los dos conjuntos comparten alguna de ellas).
+    """
+    normalized = [normalize_title(objeto) for _, _, _, objeto in tenders]
+    frequency = Counter(word for title in normalized for word in set(title.split()))
+    gap = timedelta(days=CLUSTER_GAP_DAYS)
+
+    # Grupo: [id_cluster, palabras, fin del periodo]
+    clusters: List[list] = []
+    by_word: Dict[str, List[int]] = {}
+    assigned = []
+    for (id_licitacion, published, duration, _), title in zip(tenders, normalized):
+        words = sorted(set(title.split()), key=lambda word: (frequency[word], word))
+        end = published + timedelta(days=duration if duration and duration > 0 else DEFAULT_DURATION_DAYS)
+        prefix = words[:len(words) - math.ceil(CLUSTER_SIMILARITY * len(words)) + 1]
+
+        best, best_score = None, CLUSTER_SIMILARITY
+        candidates = sorted({index for word in prefix for index in by_word.get(word, ())})
+        word_set = set(words)
+        for index in candidates:
+            cluster = clusters[index]
+            if cluster[2] + gap < published:
+                continue
+            score = len(word_set & cluster[1]) / len(word_set | cluster[1])
+            if score >= best_score:
+                best, best_score = cluster, score
+
+        if best is None:
+            best = [id_licitacion, word_set, end]
+            clusters.append(best)
+            for word in prefix:
+                by_word.setdefault(word, []).append(len(clusters) - 1)
+        elif end > best[2]:
+            best[2] = end
+        assigned.append((id_licitacion, best[0], title))
+    return assigned
+
+
+async def refresh_tender_clusters(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Reagrupar las licitaciones de los organismos afectados y su historial por empresa"""
+    organos = None
+    if licitaciones is not None:
+        organos = [row["id_organo"] for row in await conn.fetch(CLUSTER_ORGANISMS_SQL, licitaciones)]
+    await conn.execute(CLUSTER_DELETE_SQL, organos)
+
+    batch = []
+
+    async def add(id_organo: int, tenders: list):
+        for id_licitacion, id_cluster, title in cluster_tenders(tenders):
+            batch.append((id_licitacion, id_organo, id_cluster, title))
+        if len(batch) >= BATCH_SIZE:
+            await conn.copy_records_to_table("licitacion_cluster", schema_name="dw", records=batch)
+            batch.clear()
+
+    # Las filas llegan ordenadas por organismo: se agrupa cada organismo al completarlo
+    current, tenders = None, []
+    async for row in conn.cursor(CLUSTER_TENDERS_SQL, organos, prefetch=BATCH_SIZE):
+        if row["id_organo"] != current and tenders:
+            await add(current, tenders)
+            tenders = []
+        current = row["id_organo"]
+        tenders.append((row["id_licitacion"], row["fecha_publicacion"], row["plazo_ejecucion_dias"],
+                        row["objeto_contrato"]))
+    if tenders:
+        await add(current, tenders)
+    if batch:
+        await conn.copy_records_to_table("licitacion_cluster", schema_name="dw", records=batch)
+
+    await conn.execute(CLUSTER_HISTORY_DELETE_SQL, organos)
+    await conn.execute(CLUSTER_HISTORY_INSERT_SQL, organos)
@@ -0,0 +1,388 @@
+"""Capa de acceso a datos asíncrona sobre un pool de asyncpg."""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import asyncpg
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv(".env.local")
+
+# Configuración de base de datos
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "port": int(os.getenv("DB_PORT", "5432")),
+    "database": os.getenv("DB_NAME", "licitaciones_espana"),
+    "user": os.getenv("DB_USER", "admin"),
+    "password": os.getenv("DB_PASSWORD", "admin")
+}
+
+# Configuración del pool
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX", "10"))
+# Timeout por sentencia (segundos), aplicado en cliente y en servidor
+STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", "30"))
+# Nº de sentencias preparadas que asyncpg mantiene por conexión
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Umbral de consulta lenta (ms): se registra con su plan EXPLAIN (ANALYZE, BUFFERS)
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "1000"))
+# Como mucho un plan por sentencia en este intervalo (s)
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("DB_SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+# Nº máximo de sentencias pesadas ejecutándose a la vez; las demás esperan turno sin ocupar conexión
+HEAVY_QUERY_CONCURRENCY = int(os.getenv("DB_HEAVY_CONCURRENCY", str(max(1, POOL_MAX_SIZE // 2))))
+
+# Réplicas de lectura (DSN separados por comas); las sentencias replica=True se reparten entre ellas
+REPLICA_DSNS = [dsn.strip() for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()]
+# Retraso de replicación máximo (s): una réplica más retrasada deja de recibir lecturas hasta ponerse al día
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "30"))
+# Intervalo de comprobación del estado y el retraso de las réplicas (s)
+REPLICA_CHECK_SECONDS = float(os.getenv("DB_REPLICA_CHECK_SECONDS", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class Statement(NamedTuple):
+    """Sentencia SQL fija identificada por nombre"""
+    name: str
+    sql: str
+    # Agregación costosa: sujeta al límite HEAVY_QUERY_CONCURRENCY
+    heavy: bool = False
+    # Lectura que admite el retraso de una réplica (ver REPLICA_DSNS)
+    replica: bool = False
+
+
+# Registro de todas las sentencias fijas declaradas por la aplicación
+STATEMENTS: Dict[str, Statement] = {}
+
+_pool: Optional[asyncpg.Pool] = None
+_replicas: List["Replica"] = []
+_replica_monitor: Optional[asyncio.Task] = None
+_replica_turn = 0
+_explained: Dict[str, float] = {}
+_explain_tasks: set = set()
+_heavy_slots = asyncio.Semaphore(HEAVY_QUERY_CONCURRENCY)
+_heavy_waiting = 0
+_heavy_running = 0
+
+
+def prepared(name: str, sql: str, heavy: bool = False, replica: bool = False) -> Statement:
+    """Declarar una sentencia fija.
+
+    asyncpg prepara cada sentencia la primera vez que se usa en una conexión
+    y reutiliza el plan en las siguientes ejecuciones (caché por conexión).
+    Las sentencias heavy pasan por el control de admisión (ver _admitted) y las
+    replica se ejecutan en una réplica de lectura si hay alguna disponible.
+    """
+    statement = Statement(name, sql, heavy, replica)
+    STATEMENTS[name] = statement
+    return statement
+
+
+# Retraso de una réplica: pg_last_xact_replay_timestamp() no avanza si el primario no escribe,
+# así que una réplica que ya ha aplicado todo lo recibido tiene retraso 0 (tras reiniciar, la
+# posición recibida empieza en el inicio del segmento y puede quedar por detrás de la aplicada).
+# Si aún no ha aplicado ninguna transacción desde que arrancó, se cuenta desde el arranque.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - COALESCE(pg_last_xact_replay_timestamp(), pg_postmaster_start_time()))
+    END::float
+"""
+
+
+async def _create_pool(**connect_args) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        **connect_args,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        command_timeout=STATEMENT_TIMEOUT,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+        server_settings={
+            "application_name": "licitamonitor",
+            "statement_timeout": str(int(STATEMENT_TIMEOUT * 1000)),
+        },
+    )
+
+
+class Replica:
+    """Pool de una réplica de lectura y su último estado conocido"""
+
+    def __init__(self, index: int, dsn: str):
+        self.name = f"replica{index}"
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.healthy = False
+        self.lag: Optional[float] = None
+
+    async def check(self):
+        """Comprobar la réplica (creando su pool si aún no existe) y actualizar su estado"""
+        try:
+            if self.pool is None:
+                self.pool = await _create_pool(dsn=self.dsn)
+            async with self.pool.acquire(timeout=REPLICA_CHECK_SECONDS) as conn:
+                self.lag = await conn.fetchval(REPLICA_LAG_SQL, timeout=REPLICA_CHECK_SECONDS)
+            self.mark(self.lag <= REPLICA_MAX_LAG)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            self.lag = None
+            self.mark(False, str(e))
+        metrics.DB_REPLICA_LAG_SECONDS.set(-1 if self.lag is None else self.lag, self.name)
+
+    def mark(self, healthy: bool, error: Optional[str] = None):
+        if healthy != self.healthy:
+            log = logger.info if healthy else logger.warning
+            log("replica " + ("available" if healthy else "unavailable"),
+                extra={"replica": self.name, "lag": self.lag, "error": error})
+        self.healthy = healthy
+        metrics.DB_REPLICA_HEALTHY.set(int(healthy), self.name)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+async def _monitor_replicas():
+    while True:
+        await asyncio.sleep(REPLICA_CHECK_SECONDS)
+        await asyncio.gather(*(replica.check() for replica in _replicas))
+
+
+async def init_pool():
+    """Crear el pool de conexiones (una vez por proceso) y los de las réplicas"""
+    global _pool, _replica_monitor
+    if _pool is None:
+        _pool = await _create_pool(**DB_CONFIG)
+        if REPLICA_DSNS:
+            _replicas[:] = [Replica(index, dsn) for index, dsn in enumerate(REPLICA_DSNS, 1)]
+            await asyncio.gather(*(replica.check() for replica in _replicas))
+            _replica_monitor = asyncio.create_task(_monitor_replicas())
+    return _pool
+
+
+async def close_pool():
+    """Cerrar el pool de conexiones y los de las réplicas"""
+    global _pool, _replica_monitor
+    if _replica_monitor is not None:
+        _replica_monitor.cancel()
+        _replica_monitor = None
+    for replica in _replicas:
+        await replica.close()
+    _replicas.clear()
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> asyncpg.Pool:
+    if _pool is None:
+        raise RuntimeError("El pool de base de datos no está inicializado")
+    return _pool
+
+
+def _read_replica() -> Optional[Replica]:
+    """Siguiente réplica disponible (por turnos), o None para leer del primario"""
+    global _replica_turn
+    available = [replica for replica in _replicas if replica.healthy]
+    if not available:
+        return None
+    _replica_turn += 1
+    return available[_replica_turn % len(available)]
+
+
+@asynccontextmanager
+async def connection(replica: bool = False):
+    """Obtener una conexión durante un bloque: del primario, o de una réplica si replica=True.
+
+    Sin réplicas disponibles (ninguna configurada, caídas o demasiado retrasadas) se usa
+    el primario. Si una réplica falla al conectar se marca como no disponible hasta la
+    siguiente comprobación y la petición se reintenta en el primario.
+    """
+    target = _read_replica() if replica else None
+    started = time.perf_counter()
+    if target is not None:
+        try:
+            conn = await target.pool.acquire()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as e:
+            target.mark(False, str(e))
+            target = None
+        else:
+            metrics.DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+            try:
+                yield conn
+            except (OSError, asyncpg.PostgresConnectionError) as e:
+                target.mark(False, str(e))
+                raise
+            finally:
+                await target.pool.release(conn)
+            return
+    async with get_pool().acquire() as conn:
+        metrics.DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+        yield conn
+
+
+@asynccontextmanager
+async def dedicated_connection(replica: bool = False, statement_timeout: float = 0, idle_timeout: float = 0,
+                               application_name: str = "licitamonitor-jobs"):
+    """Conexión propia, fuera del pool, para trabajos largos (informes, exportaciones).
+
+    No ocupa conexiones del pool de la API; con replica=True se abre contra una réplica
+    disponible si la hay. statement_timeout e idle_timeout (tiempo máximo con una
+    transacción abierta sin ejecutar nada) en segundos (0 = sin límite).
+    """
+    settings = {
+        "application_name": application_name,
+        "statement_timeout": str(int(statement_timeout * 1000)),
+        "idle_in_transaction_session_timeout": str(int(idle_timeout * 1000)),
+    }
+    target = _read_replica() if replica else None
+    conn = None
+    if target is not None:
+        try:
+            conn = await asyncpg.connect(dsn=target.dsn, server_settings=settings)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as e:
+            target.mark(False, str(e))
+    if conn is None:
+        conn = await asyncpg.connect(**DB_CONFIG, server_settings=settings)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def _explain(statement: Statement, args: tuple):
+    """Registrar el plan real de una consulta lenta (se ejecuta en segundo plano)"""
+    try:
+        async with connection(statement.replica) as conn:
+            transaction = conn.transaction(readonly=True)
+            await transaction.start()
+            try:
+                rows = await conn.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {statement.sql}", *args)
+            finally:
+                await transaction.rollback()
+        plan = "\n".join(row[0] for row in rows)
+        logger.warning("slow query plan", extra={"statement": statement.name, "plan": plan})
+    except Exception as e:
+        logger.warning("could not explain slow query", extra={"statement": statement.name, "error": str(e)})
+
+
+def _record(statement: Statement, args: tuple, elapsed: float, rows: int):
+    metrics.DB_STATEMENT_SECONDS.observe(elapsed, statement.name)
+    metrics.DB_STATEMENT_ROWS.observe(rows, statement.name)
+    if elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    metrics.DB_SLOW_QUERIES.inc(statement.name)
+    logger.warning("slow query", extra={"statement": statement.name, "ms": round(elapsed * 1000, 1), "rows": rows})
+    now = time.monotonic()
+    if now - _explained.get(statement.name, -SLOW_QUERY_EXPLAIN_INTERVAL) >= SLOW_QUERY_EXPLAIN_INTERVAL:
+        _explained[statement.name] = now
+        task = asyncio.create_task(_explain(statement, args))
+        _explain_tasks.add(task)
+        task.add_done_callback(_explain_tasks.discard)
+
+
+@asynccontextmanager
+async def _admitted(statement: Statement):
+    """Esperar turno si la sentencia es pesada y ya hay HEAVY_QUERY_CONCURRENCY en curso"""
+    global _heavy_waiting, _heavy_running
+    if not statement.heavy:
+        yield
+        return
+    started = time.perf_counter()
+    _heavy_waiting += 1
+    metrics.DB_HEAVY_QUERIES.set(_heavy_waiting, "waiting")
+    try:
+        await _heavy_slots.acquire()
+    finally:
+        _heavy_waiting -= 1
+        metrics.DB_HEAVY_QUERIES.set(_heavy_waiting, "waiting")
+    metrics.DB_HEAVY_QUEUE_SECONDS.observe(time.perf_counter() - started, statement.name)
+    _heavy_running += 1
+    metrics.DB_HEAVY_QUERIES.set(_heavy_running, "running")
+    try:
+        yield
+    finally:
+        _heavy_running -= 1
+        metrics.DB_HEAVY_QUERIES.set(_heavy_running, "running")
+        _heavy_slots.release()
+
+
+@asynccontextmanager
+async def _measured(statement: Statement, conn: Optional[asyncpg.Connection] = None):
+    """Conexión para ejecutar una sentencia, contando los errores por sentencia.
+
+    Con conn se usa esa conexión (p. ej. para leer varias sentencias en la misma
+    transacción) en lugar de tomar una del pool.
+    """
+    try:
+        async with _admitted(statement):
+            if conn is not None:
+                yield conn
+            else:
+                async with connection(statement.replica) as conn:
+                    yield conn
+    except Exception:
+        metrics.DB_STATEMENT_ERRORS.inc(statement.name)
+        raise
+
+
+async def fetch(
+    statement: Statement, *args: Any, timeout: Optional[float] = None, conn: Optional[asyncpg.Connection] = None
+) -> List[Dict[str, Any]]:
+    """Ejecutar una sentencia y devolver todas las filas como diccionarios"""
+    async with _measured(statement, conn) as conn:
+        started = time.perf_counter()
+        rows = await conn.fetch(statement.sql, *args, timeout=timeout)
+        _record(statement, args, time.perf_counter() - started, len(rows))
+    return [dict(row) for row in rows]
+
+
+async def fetch_columns(statement: Statement, *args: Any, timeout: Optional[float] = None) -> Tuple[List[str], List[tuple]]:
+    """Ejecutar una sentencia y devolver (nombres de columna, filas como tuplas), sin un dict por fila"""
+    async with _measured(statement) as conn:
+        started = time.perf_counter()
+        rows = await conn.fetch(statement.sql, *args, timeout=timeout)
+        _record(statement, args, time.perf_counter() - started, len(rows))
+        if rows:
+            columns = list(rows[0].keys())
+        else:
+            columns = [attribute.name for attribute in (await conn.prepare(statement.sql)).get_attributes()]
+    return columns, [tuple(row) for row in rows]
+
+
+async def fetchrow(
+    statement: Statement, *args: Any, timeout: Optional[float] = None, conn: Optional[asyncpg.Connection] = None
+) -> Optional[Dict[str, Any]]:
+    """Ejecutar una sentencia y devolver la primera fila (o None)"""
+    async with _measured(statement, conn) as conn:
+        started = time.perf_counter()
+        row = await conn.fetchrow(statement.sql, *args, timeout=timeout)
+        _record(statement, args, time.perf_counter() - started, 0 if row is None else 1)
+    return dict(row) if row is not None else None
+
+
+async def fetchval(statement: Statement, *args: Any, timeout: Optional[float] = None) -> Any:
+    """Ejecutar una sentencia y devolver el primer valor de la primera fila"""
+    async with _measured(statement) as conn:
+        started = time.perf_counter()
+        value = await conn.fetchval(statement.sql, *args, timeout=timeout)
+        _record(statement, args, time.perf_counter() - started, 1)
+    return value
+
+
+def pool_stats() -> Dict[str, int]:
+    """Conexiones del pool del primario: total, libres y en uso"""
+    if _pool is None:
+        return {"size": 0, "idle": 0, "busy": 0}
+    size, idle = _pool.get_size(), _pool.get_idle_size()
+    return {"size": size, "idle": idle, "busy": size - idle}
+
+
+def replica_status() -> List[Dict[str, Any]]:
+    """Estado de cada réplica configurada (para /health)"""
+    return [{"name": replica.name, "healthy": replica.healthy, "lag": replica.lag} for replica in _replicas]
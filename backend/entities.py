@@ -0,0 +1,316 @@
+"""Resolución de entidades de adjudicatarios: filas de dw.dim_adjudicatario que son la
+misma empresa (sin NIF o con erratas, variantes del nombre) se agrupan en
+dim_adjudicatario.id_grupo_empresarial.
+
+1. Bloques: cada empresa se indexa por los tokens de su nombre normalizado, por cada par
+   de tokens consecutivos y por su NIF sin el carácter de control; sólo se comparan
+   empresas que comparten bloque. Los bloques con más de ENTITY_MAX_BLOCK miembros
+   (palabras como "servicios") no se usan.
+2. Puntuación: mismo NIF, misma empresa; NIF distintos, empresas distintas salvo que sólo
+   cambie el carácter de control; si no, similitud de Jaccard entre los tokens del nombre,
+   con tolerancia a erratas. Las UTE sólo se comparan entre sí: sin "UTE" su nombre
+   coincidiría con el de uno de los socios.
+3. Agrupación: union-find sobre los pares que superan ENTITY_SIMILARITY; el id del grupo
+   es el menor id_adjudicatario del grupo.
+
+Los bloques se puntúan en paralelo (ENTITY_WORKERS procesos). Las claves de cada empresa
+se guardan en dw.entidad_adjudicatario y el tamaño de cada bloque en dw.bloque_adjudicatario,
+así que en los refrescos incrementales sólo se comparan las empresas nuevas con las de sus
+bloques; si una empresa nueva une dos grupos existentes, se fusionan.
+"""
+import asyncio
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, combinations, product, repeat
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import asyncpg
+
+from normalize import normalize_nif, strip_legal_suffix, tokens
+
+# Similitud mínima entre dos nombres para considerarlos la misma empresa
+ENTITY_SIMILARITY = float(os.getenv("ENTITY_SIMILARITY", "0.8"))
+# Bloques más grandes se descartan: sus claves no distinguen empresas
+ENTITY_MAX_BLOCK = int(os.getenv("ENTITY_MAX_BLOCK", "1000"))
+ENTITY_WORKERS = int(os.getenv("ENTITY_WORKERS", str(os.cpu_count() or 1)))
+# Por debajo de este número de comparaciones no compensa lanzar procesos
+PARALLEL_MIN_PAIRS = 200000
+# Tokens a una errata cuentan como el mismo; sólo a partir de esta longitud
+TYPO_MIN_LENGTH = 5
+MIN_TOKEN_LENGTH = 3
+# Longitud del NIF sin el carácter de control
+NIF_PREFIX = 8
+
+COMPANIES_SQL = """
+    SELECT id_adjudicatario, nombre, nif
+    FROM dw.dim_adjudicatario
+    WHERE id_adjudicatario > $1
+    ORDER BY id_adjudicatario
+"""
+
+LAST_RESOLVED_SQL = "SELECT COALESCE(MAX(id_adjudicatario), 0) FROM dw.entidad_adjudicatario"
+
+BLOCK_SIZES_SQL = "SELECT clave, miembros FROM dw.bloque_adjudicatario WHERE clave = ANY($1)"
+
+# Empresas ya resueltas que comparten alguna clave con las nuevas
+CANDIDATES_SQL = """
+    SELECT e.id_adjudicatario, e.nombre_normalizado, e.nif_normalizado, e.es_ute, e.claves,
+           COALESCE(a.id_grupo_empresarial, a.id_adjudicatario) as id_grupo
+    FROM dw.entidad_adjudicatario e
+    INNER JOIN dw.dim_adjudicatario a ON a.id_adjudicatario = e.id_adjudicatario
+    WHERE e.claves && $1::text[]
+"""
+
+BLOCK_SIZES_UPSERT_SQL = """
+    INSERT INTO dw.bloque_adjudicatario (clave, miembros)
+    SELECT * FROM unnest($1::text[], $2::integer[])
+    ON CONFLICT (clave) DO UPDATE SET miembros = dw.bloque_adjudicatario.miembros + EXCLUDED.miembros
+"""
+
+GROUPS_UPDATE_SQL = """
+    UPDATE dw.dim_adjudicatario a SET id_grupo_empresarial = g.id_grupo
+    FROM unnest($1::bigint[], $2::bigint[]) as g (id_adjudicatario, id_grupo)
+    WHERE a.id_adjudicatario = g.id_adjudicatario AND a.id_grupo_empresarial IS DISTINCT FROM g.id_grupo
+"""
+
+GROUPS_MERGE_SQL = """
+    UPDATE dw.dim_adjudicatario SET id_grupo_empresarial = $2 WHERE id_grupo_empresarial = $1
+"""
+
+ENTITY_COLUMNS = ["id_adjudicatario", "nombre_normalizado", "nif_normalizado", "es_ute", "claves"]
+
+
+class Company(NamedTuple):
+    id: int
+    tokens: Tuple[str, ...]
+    nif: str
+    es_ute: bool
+    keys: FrozenSet[str]
+    # En los refrescos incrementales sólo se comparan pares con alguna empresa nueva
+    nueva: bool = True
+
+
+def company(id_adjudicatario: int, nombre: str, nif: Optional[str]) -> Company:
+    """Normalizar nombre y NIF de un adjudicatario y calcular sus claves de bloque"""
+    words = tokens(nombre)
+    nif = normalize_nif(nif)
+    if len(nif) < NIF_PREFIX:
+        nif = ""
+    es_ute = nif.startswith("U") or "ute" in words or ("union", "temporal") in zip(words, words[1:])
+    name = tuple(word for word in strip_legal_suffix(words) if word != "ute")
+    words = [word for word in name if len(word) >= MIN_TOKEN_LENGTH]
+    keys = {f"tok:{word}" for word in words}
+    # Pares de tokens consecutivos: siguen siendo bloques pequeños cuando cada token es frecuente
+    keys.update(f"par:{first} {second}" for first, second in zip(words, words[1:]))
+    if nif:
+        keys.add(f"nif:{nif[:NIF_PREFIX]}")
+    if es_ute:
+        keys = {f"ute:{key}" for key in keys}
+    return Company(id_adjudicatario, name, nif, es_ute, frozenset(keys))
+
+
+def _one_edit(a: str, b: str) -> bool:
+    """Dos tokens distintos a una sola errata: sustitución, inserción, omisión o transposición"""
+    if abs(len(a) - len(b)) > 1 or min(len(a), len(b)) < TYPO_MIN_LENGTH:
+        return False
+    # Con una sola errata coinciden los dos primeros o los dos últimos caracteres
+    if a[:2] != b[:2] and a[-2:] != b[-2:]:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    index = 0
+    while index < len(a) and a[index] == b[index]:
+        index += 1
+    if len(a) < len(b):
+        return a[index:] == b[index + 1:]
+    if a[index + 1:] == b[index + 1:]:
+        return True
+    return index + 1 < len(a) and a[index] == b[index + 1] and a[index + 1] == b[index] and a[index + 2:] == b[index + 2:]
+
+
+def name_similarity(a: Tuple[str, ...], b: Tuple[str, ...]) -> float:
+    """Jaccard entre tokens, emparejando también los que difieren en una errata"""
+    common = set(a) & set(b)
+    rest = [word for word in b if word not in common]
+    matched = len(a) - sum(1 for word in a if word not in common)
+    for word in a:
+        if word in common:
+            continue
+        for index, other in enumerate(rest):
+            if _one_edit(word, other):
+                del rest[index]
+                matched += 1
+                break
+    return matched / (len(a) + len(b) - matched)
+
+
+def score(a: Company, b: Company) -> float:
+    """Probabilidad aproximada de que dos adjudicatarios sean la misma empresa"""
+    if a.es_ute != b.es_ute:
+        return 0.0
+    if a.nif and b.nif:
+        if a.nif == b.nif:
+            return 1.0
+        if a.nif[:NIF_PREFIX] != b.nif[:NIF_PREFIX]:
+            return 0.0
+    if not a.tokens or not b.tokens:
+        return 0.0
+    return name_similarity(a.tokens, b.tokens)
+
+
+def _block_pairs(key: str, members: List[Company]) -> Iterator[Tuple[Company, Company]]:
+    """Pares a comparar en un bloque.
+
+    En los bloques por nombre se omiten los pares en que ambas empresas tienen NIF: sólo
+    coinciden si comparten NIF sin control, y entonces se comparan en ese bloque.
+    """
+    if key.startswith(("nif:", "ute:nif:")):
+        return combinations(members, 2)
+    anonymous = [item for item in members if not item.nif]
+    identified = [item for item in members if item.nif]
+    return chain(combinations(anonymous, 2), product(anonymous, identified))
+
+
+def _comparisons(key: str, members: List[Company]) -> int:
+    if key.startswith(("nif:", "ute:nif:")):
+        return len(members) * (len(members) - 1) // 2
+    anonymous = sum(1 for item in members if not item.nif)
+    return anonymous * (anonymous - 1) // 2 + anonymous * (len(members) - anonymous)
+
+
+def match_blocks(blocks: List[Tuple[str, List[Company]]], threshold: float) -> List[Tuple[int, int]]:
+    """Pares de empresas que superan el umbral.
+
+    Un par que comparte varios bloques sólo se compara en el de menor clave (las claves
+    de cada empresa ya están reducidas a los bloques en uso).
+    """
+    pairs = []
+    for key, members in blocks:
+        for a, b in _block_pairs(key, members):
+            if not (a.nueva or b.nueva) or min(a.keys & b.keys) != key:
+                continue
+            if score(a, b) >= threshold:
+                pairs.append((min(a.id, b.id), max(a.id, b.id)))
+    return pairs
+
+
+def build_blocks(companies: Iterable[Company], active: Set[str]) -> List[Tuple[str, List[Company]]]:
+    """Agrupar las empresas por las claves activas (bloques de al menos dos miembros)"""
+    members: Dict[str, List[Company]] = defaultdict(list)
+    for item in companies:
+        keys = item.keys & active
+        if keys:
+            item = item._replace(keys=keys)
+            for key in keys:
+                members[key].append(item)
+    return [(key, sorted(block)) for key, block in members.items() if len(block) > 1]
+
+
+def score_blocks(blocks: List[Tuple[str, List[Company]]], workers: int = ENTITY_WORKERS) -> List[Tuple[int, int]]:
+    """Puntuar los bloques, repartidos entre procesos si hay suficientes comparaciones"""
+    comparisons = sum(_comparisons(key, members) for key, members in blocks)
+    if workers <= 1 or comparisons < PARALLEL_MIN_PAIRS:
+        return match_blocks(blocks, ENTITY_SIMILARITY)
+    # Los bloques más grandes primero y en turnos, para equilibrar los trozos
+    chunks: List[list] = [[] for _ in range(workers * 4)]
+    for index, block in enumerate(sorted(blocks, key=lambda block: -len(block[1]))):
+        chunks[index % len(chunks)].append(block)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [
+            pair for pairs in executor.map(match_blocks, chunks, repeat(ENTITY_SIMILARITY)) for pair in pairs
+        ]
+
+
+class UnionFind:
+    """Conjuntos disjuntos con compresión de caminos; la raíz es siempre el menor id"""
+
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, item: int) -> int:
+        parent = self.parent
+        root = item
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while parent.get(item, item) != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+def _active_keys(sizes: Dict[str, int], keys: Iterable[str]) -> Set[str]:
+    return {key for key in keys if 1 < sizes.get(key, 0) <= ENTITY_MAX_BLOCK}
+
+
+async def _match(companies: List[Company], active: Set[str]) -> List[Tuple[int, int]]:
+    """Construir y puntuar los bloques en un hilo, sin bloquear el bucle de eventos
+    mientras se espera a los procesos de score_blocks"""
+    return await asyncio.to_thread(lambda: score_blocks(build_blocks(companies, active)))
+
+
+async def _save_entities(conn: asyncpg.Connection, companies: List[Company]):
+    await conn.copy_records_to_table("entidad_adjudicatario", schema_name="dw", columns=ENTITY_COLUMNS, records=[
+        (item.id, " ".join(item.tokens), item.nif, item.es_ute, sorted(item.keys)) for item in companies
+    ])
+
+
+async def _save_groups(conn: asyncpg.Connection, groups: List[Tuple[int, int]]):
+    await conn.execute(GROUPS_UPDATE_SQL, [company for company, _ in groups], [group for _, group in groups])
+
+
+async def _resolve_all(conn: asyncpg.Connection):
+    companies = [company(*row) for row in await conn.fetch(COMPANIES_SQL, 0)]
+    sizes = Counter(key for item in companies for key in item.keys)
+    groups = UnionFind()
+    for a, b in await _match(companies, _active_keys(sizes, sizes)):
+        groups.union(a, b)
+
+    await conn.execute("TRUNCATE dw.entidad_adjudicatario, dw.bloque_adjudicatario")
+    await _save_entities(conn, companies)
+    await conn.copy_records_to_table("bloque_adjudicatario", schema_name="dw", records=list(sizes.items()))
+    await _save_groups(conn, [(item.id, groups.find(item.id)) for item in companies])
+
+
+async def _resolve_new(conn: asyncpg.Connection):
+    new = [company(*row) for row in await conn.fetch(COMPANIES_SQL, await conn.fetchval(LAST_RESOLVED_SQL))]
+    if not new:
+        return
+    new_sizes = Counter(key for item in new for key in item.keys)
+    sizes = Counter({row["clave"]: row["miembros"] for row in await conn.fetch(BLOCK_SIZES_SQL, list(new_sizes))})
+    sizes.update(new_sizes)
+    active = _active_keys(sizes, new_sizes)
+
+    existing, current = [], {}
+    if active:
+        for row in await conn.fetch(CANDIDATES_SQL, list(active)):
+            existing.append(Company(
+                row["id_adjudicatario"], tuple(row["nombre_normalizado"].split()), row["nif_normalizado"],
+                row["es_ute"], frozenset(row["claves"]), nueva=False
+            ))
+            current[row["id_adjudicatario"]] = row["id_grupo"]
+
+    groups = UnionFind()
+    for id_adjudicatario, group in current.items():
+        groups.union(id_adjudicatario, group)
+    for a, b in await _match(existing + new, active):
+        groups.union(a, b)
+
+    # Grupos existentes unidos por una empresa nueva: todos sus miembros pasan al menor id
+    merges = {group: groups.find(group) for group in set(current.values())}
+    await conn.executemany(GROUPS_MERGE_SQL, [(old, root) for old, root in merges.items() if old != root])
+    await _save_entities(conn, new)
+    await conn.execute(BLOCK_SIZES_UPSERT_SQL, list(new_sizes), list(new_sizes.values()))
+    await _save_groups(conn, [(item.id, groups.find(item.id)) for item in new])
+
+
+async def refresh_company_groups(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Resolver los adjudicatarios nuevos (todos si licitaciones es None) y actualizar sus grupos"""
+    if licitaciones is None:
+        await _resolve_all(conn)
+    else:
+        await _resolve_new(conn)
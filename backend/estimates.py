@@ -0,0 +1,225 @@
+"""Estimación del importe de adjudicación de las licitaciones abiertas (dw.estimacion_licitacion).
+
+Para cada licitación con plazo vigente se toma la distribución de bajas de las licitaciones
+ya adjudicadas con el mismo CPV principal, organismo y tipo de procedimiento. Si no hay
+suficientes adjudicaciones se sube por la jerarquía de CPV (dw.cpv_antecesor) y, después,
+se prescinde del CPV, del organismo y del procedimiento, por este orden. Las distribuciones
+y la puntuación se calculan por lotes con NumPy tras cada carga.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import asyncpg
+import numpy as np
+
+# Adjudicaciones mínimas para usar la distribución de una clave (salvo la global)
+ESTIMATE_MIN_SAMPLES = int(os.getenv("ESTIMATE_MIN_SAMPLES", "10"))
+QUANTILES = np.array([0.25, 0.5, 0.75])
+
+_PRINCIPAL_CPV = """
+    LEFT JOIN LATERAL (
+        SELECT rc.codigo_cpv FROM dw.rel_licitacion_cpv rc
+        WHERE rc.id_licitacion = l.id_licitacion
+        ORDER BY rc.es_principal DESC NULLS LAST, rc.codigo_cpv
+        LIMIT 1
+    ) cpv ON true
+"""
+
+# Baja de cada licitación adjudicada: importe adjudicado frente al presupuesto de sus lotes
+# adjudicados. Se descartan valores imposibles (errores de carga).
+HISTORY_SQL = f"""
+    WITH lotes AS (
+        SELECT lot.id_licitacion, MAX(lot.importe_lote_con_iva) as presupuesto,
+               SUM(r.importe_adjudicacion_con_iva) as importe
+        FROM dw.fact_lote lot
+        INNER JOIN dw.fact_resultado_lote r ON r.id_lote = lot.id_lote
+        WHERE r.es_exito AND lot.importe_lote_con_iva > 0 AND r.importe_adjudicacion_con_iva > 0
+        GROUP BY lot.id_lote, lot.id_licitacion
+    ),
+    bajas AS (
+        SELECT id_licitacion, 100 * (1 - SUM(importe) / SUM(presupuesto)) as baja
+        FROM lotes
+        GROUP BY id_licitacion
+    )
+    SELECT
+        COALESCE(cpv.codigo_cpv, '') as codigo_cpv,
+        l.id_organo,
+        COALESCE(l.tipo_procedimiento, '') as tipo_procedimiento,
+        b.baja::float as baja
+    FROM bajas b
+    INNER JOIN dw.fact_licitacion l ON l.id_licitacion = b.id_licitacion
+    {_PRINCIPAL_CPV}
+    WHERE b.baja > -100 AND b.baja < 100
+"""
+
+# Mismo criterio de "activa" y de presupuesto que /api/tenders/active
+ACTIVE_SQL = f"""
+    SELECT
+        l.id_licitacion,
+        COALESCE(cpv.codigo_cpv, '') as codigo_cpv,
+        l.id_organo,
+        COALESCE(l.tipo_procedimiento, '') as tipo_procedimiento,
+        COALESCE(l.presupuesto_base_con_iva, l.presupuesto_base_sin_iva, l.valor_estimado, 0)::float as presupuesto
+    FROM dw.fact_licitacion l
+    {_PRINCIPAL_CPV}
+    WHERE l.fecha_limite_ofertas >= CURRENT_DATE
+"""
+
+ANCESTORS_SQL = "SELECT codigo_cpv, codigo_antecesor, distancia FROM dw.cpv_antecesor ORDER BY codigo_cpv, distancia"
+
+ESTIMATE_COLUMNS = [
+    "id_licitacion", "baja_p25", "baja_p50", "baja_p75", "importe_estimado", "importe_min", "importe_max",
+    "muestras", "nivel", "codigo_cpv", "calculada_en",
+]
+
+
+class _Codes:
+    """Códigos enteros para los valores de una dimensión; 0 queda como comodín"""
+
+    def __init__(self):
+        self.codes: Dict = {}
+        self.values: List = [None]
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class Estimator:
+    """Distribuciones de baja por clave (CPV, organismo, procedimiento), ya ordenadas"""
+
+    def __init__(self, history: list, ancestors: list, min_samples: int = ESTIMATE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self.cpvs, self.organos, self.procedimientos = _Codes(), _Codes(), _Codes()
+        self.chains: Dict[str, List[str]] = {}
+        for codigo, antecesor, _ in ancestors:
+            self.chains.setdefault(codigo, []).append(antecesor)
+        self.depth = max((len(chain) for chain in self.chains.values()), default=1)
+
+        count = len(history)
+        chain = self._chain_matrix([row[0] for row in history])
+        organo = np.fromiter((self.organos.encode(row[1]) for row in history), dtype=np.int64, count=count)
+        procedimiento = np.fromiter(
+            (self.procedimientos.encode(row[2]) for row in history), dtype=np.int64, count=count
+        )
+        bajas = np.fromiter((row[3] for row in history), dtype=np.float64, count=count)
+
+        # Cada adjudicación cuenta en todas las claves por las que se puede buscar
+        keys, values = [], []
+        for _, valid, key, _ in self._levels(chain, organo, procedimiento):
+            keys.append(key[valid])
+            values.append(bajas[valid])
+        keys, values = np.concatenate(keys), np.concatenate(values)
+        order = np.lexsort((values, keys))
+        self.values = values[order]
+        self.keys, self.starts, self.counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    def _chain_matrix(self, codigos: List[str]) -> np.ndarray:
+        """Antecesores codificados de cada CPV por distancia (columna 0 = el propio código, 0 = ninguno)"""
+        matrix = np.zeros((len(codigos), self.depth), dtype=np.int64)
+        encoded: Dict[str, List[int]] = {}
+        for row, codigo in enumerate(codigos):
+            if not codigo:
+                continue
+            chain = encoded.get(codigo)
+            if chain is None:
+                # Un CPV que aún no está en la clausura cuenta sólo como él mismo
+                chain = encoded[codigo] = [self.cpvs.encode(code) for code in self.chains.get(codigo, [codigo])]
+            matrix[row, :len(chain)] = chain
+        return matrix
+
+    def _key(self, cpv, organo, procedimiento) -> np.ndarray:
+        return (cpv * len(self.organos) + organo) * len(self.procedimientos) + procedimiento
+
+    def _levels(self, chain: np.ndarray, organo: np.ndarray, procedimiento: np.ndarray):
+        """(nivel, filas con clave en ese nivel, clave, CPV usado), de la más a la menos específica.
+
+        organo y procedimiento valen -1 si no aparecen en el historial: esas filas sólo
+        pueden usar los niveles que prescinden de ellos.
+        """
+        known = (organo >= 0) & (procedimiento >= 0)
+        for distance in range(self.depth):
+            ancestor = chain[:, distance]
+            yield "cpv_organo_procedimiento", known & (ancestor > 0), self._key(ancestor, organo, procedimiento), ancestor
+        wildcard = np.zeros_like(organo)
+        yield "organo_procedimiento", known, self._key(0, organo, procedimiento), wildcard
+        yield "procedimiento", procedimiento >= 0, self._key(0, 0, procedimiento), wildcard
+        yield "global", np.ones(len(organo), dtype=bool), self._key(0, 0, wildcard), wildcard
+
+    def quantiles(self, groups: np.ndarray) -> np.ndarray:
+        """Cuartiles (interpolación lineal) de los grupos indicados: matriz len(groups) x 3"""
+        starts = self.starts[groups][:, None]
+        last = (self.counts[groups] - 1)[:, None]
+        position = QUANTILES[None, :] * last
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        low, high = self.values[starts + lower], self.values[starts + upper]
+        return low + (high - low) * (position - lower)
+
+    def score(self, active: list) -> list:
+        """Estimaciones para filas (id_licitacion, codigo_cpv, id_organo, tipo_procedimiento, presupuesto)"""
+        count = len(active)
+        ids = np.fromiter((row[0] for row in active), dtype=np.int64, count=count)
+        chain = self._chain_matrix([row[1] for row in active])
+        organo = np.fromiter((self.organos.codes.get(row[2], -1) for row in active), dtype=np.int64, count=count)
+        procedimiento = np.fromiter(
+            (self.procedimientos.codes.get(row[3], -1) for row in active), dtype=np.int64, count=count
+        )
+        presupuesto = np.fromiter((row[4] for row in active), dtype=np.float64, count=count)
+
+        group = np.full(count, -1, dtype=np.int64)
+        level = np.empty(count, dtype=object)
+        used_cpv = np.zeros(count, dtype=np.int64)
+        if len(self.keys):
+            for name, valid, key, ancestor in self._levels(chain, organo, procedimiento):
+                position = np.minimum(np.searchsorted(self.keys, key), len(self.keys) - 1)
+                minimum = 1 if name == "global" else self.min_samples
+                found = (group < 0) & valid & (self.keys[position] == key) & (self.counts[position] >= minimum)
+                group[found] = position[found]
+                level[found] = name
+                used_cpv[found] = ancestor[found]
+
+        scored = np.flatnonzero(group >= 0)
+        bajas = np.round(self.quantiles(group[scored]), 2)
+        budget = presupuesto[scored]
+        # Baja baja -> importe alto: el p25 de la baja da el máximo del rango
+        importes = np.round(budget[:, None] * (1 - bajas / 100), 2)
+        now = datetime.now(timezone.utc)
+        estimates = []
+        for row, index in enumerate(scored):
+            priced = budget[row] > 0
+            estimates.append((
+                int(ids[index]),
+                float(bajas[row, 0]), float(bajas[row, 1]), float(bajas[row, 2]),
+                float(importes[row, 1]) if priced else None,
+                float(importes[row, 2]) if priced else None,
+                float(importes[row, 0]) if priced else None,
+                int(self.counts[group[index]]),
+                level[index],
+                self.cpvs.values[used_cpv[index]],
+                now,
+            ))
+        return estimates
+
+
+async def refresh_award_estimates(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Recalcular las estimaciones de todas las licitaciones abiertas.
+
+    Cualquier adjudicación nueva cambia las distribuciones, así que no basta con
+    las licitaciones afectadas: se puntúan todas las abiertas de una vez.
+    """
+    estimator = Estimator(await conn.fetch(HISTORY_SQL), await conn.fetch(ANCESTORS_SQL))
+    estimates = estimator.score(await conn.fetch(ACTIVE_SQL))
+    # DELETE y no TRUNCATE: el endpoint sigue leyendo las anteriores hasta el commit
+    await conn.execute("DELETE FROM dw.estimacion_licitacion")
+    if estimates:
+        await conn.copy_records_to_table(
+            "estimacion_licitacion", schema_name="dw", records=estimates, columns=ESTIMATE_COLUMNS
+        )
@@ -0,0 +1,75 @@
+"""Exportación en streaming (NDJSON/CSV) con cursor de servidor."""
+import asyncio
+import csv
+import io
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+import db
+from responses import dumps
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+# Filas por lote leído del cursor y escrito en la respuesta
+CHUNK_SIZE = 2000
+# Exportaciones a la vez por worker; las demás esperan turno
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "4"))
+# Segundos por consulta y sin leer del cursor (un cliente que deja de leer la descarga
+# deja la transacción parada); al superarlos PostgreSQL cierra la conexión
+EXPORT_STATEMENT_TIMEOUT = float(os.getenv("EXPORT_STATEMENT_TIMEOUT", "600"))
+EXPORT_IDLE_TIMEOUT = float(os.getenv("EXPORT_IDLE_TIMEOUT", "60"))
+
+_export_slots = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+
+def _ndjson_chunk(rows: list, header: bool) -> bytes:
+    return b"".join(dumps(dict(row)) + b"\n" for row in rows)
+
+
+def _csv_chunk(rows: list, header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(rows[0].keys())
+    writer.writerows(row.values() for row in rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+# Serializador de un lote de filas por formato (header: es el primer lote)
+CHUNK_WRITERS = {
+    "ndjson": _ndjson_chunk,
+    "csv": _csv_chunk,
+}
+
+
+async def _generate(statement: db.Statement, args: tuple, fmt: str):
+    write_chunk = CHUNK_WRITERS[fmt]
+    # Conexión propia (fuera del pool de la API) durante toda la descarga
+    async with _export_slots, db.dedicated_connection(
+        statement.replica, EXPORT_STATEMENT_TIMEOUT, EXPORT_IDLE_TIMEOUT, "licitamonitor-export"
+    ) as conn:
+        # Los cursores de servidor necesitan una transacción abierta
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(statement.sql, *args)
+            first = True
+            while True:
+                rows = await cursor.fetch(CHUNK_SIZE)
+                if not rows:
+                    break
+                yield write_chunk(rows, first)
+                first = False
+
+
+def stream_export(statement: db.Statement, args: tuple, fmt: str, filename: str) -> StreamingResponse:
+    """Devolver el resultado completo de una sentencia en streaming, por lotes"""
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format debe ser uno de: json, columns, {', '.join(EXPORT_FORMATS)}")
+    return StreamingResponse(
+        _generate(statement, args, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
@@ -0,0 +1,401 @@
+"""Grafo de co-adjudicaciones en memoria para la red de competencia.
+
+El grafo se construye una vez desde la base de datos y después se actualiza
+de forma incremental con los resultados nuevos. Se mantienen dos tipos de
+relación entre empresas:
+
+- competencia: ganan lotes de la misma licitación (excluyendo licitaciones con
+  más de MAX_WINNERS adjudicatarios distintos, típicamente marcos de acuerdo)
+- ute: participan juntas en la misma UTE adjudicataria
+
+Los contadores se guardan también por mes (aaaamm) para poder responder
+consultas con ventana temporal sin volver a la base de datos. Para ver la red
+por grupos empresariales (entities.py) se suman al consultar, según el grupo
+de cada empresa, que se recarga cuando cambian los grupos.
+"""
+import asyncio
+import heapq
+import os
+import time
+from collections import Counter, defaultdict
+from datetime import date
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import asyncpg
+
+import db
+
+# Licitaciones con más adjudicatarios distintos se consideran marcos de acuerdo
+MAX_WINNERS = 3
+# Frecuencia máxima con la que se comprueba si hay resultados nuevos
+GRAPH_SYNC_SECONDS = float(os.getenv("GRAPH_SYNC_SECONDS", "5"))
+
+EDGE_TYPES = ("competencia", "ute")
+
+GRAPH_MARKS_SQL = db.prepared("graph_marks", """
+    SELECT
+        COALESCE((SELECT MAX(id_resultado_lote) FROM dw.fact_resultado_lote), 0) as id_resultado_lote,
+        COALESCE((SELECT MAX(id_participacion) FROM dw.rel_resultado_ute_participante), 0) as id_participacion,
+        COALESCE((SELECT MAX(id_carga) FROM dw.etl_licitacion_cargada), 0) as id_carga,
+        (SELECT actualizado_en FROM dw.etl_marca WHERE proceso = 'grupos_empresariales') as grupos
+""", replica=True)
+
+# Licitaciones con resultados, participantes de UTE o cargas nuevas desde las marcas
+GRAPH_TOUCHED_SQL = db.prepared("graph_touched", """
+    SELECT lot.id_licitacion
+    FROM dw.fact_resultado_lote r
+    INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+    WHERE r.id_resultado_lote > $1 AND r.id_resultado_lote <= $2
+    UNION
+    SELECT lot.id_licitacion
+    FROM dw.rel_resultado_ute_participante p
+    INNER JOIN dw.fact_resultado_lote r ON p.id_resultado_lote = r.id_resultado_lote
+    INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+    WHERE p.id_participacion > $3 AND p.id_participacion <= $4
+    UNION
+    SELECT id_licitacion FROM dw.etl_licitacion_cargada
+    WHERE id_carga > $5 AND id_carga <= $6
+""", replica=True)
+
+# $1 NULL = todas las licitaciones (construcción inicial)
+GRAPH_RESULTS_SQL = db.prepared("graph_results", """
+    SELECT
+        lot.id_licitacion,
+        r.id_adjudicatario,
+        r.fecha_adjudicacion,
+        COALESCE(r.importe_adjudicacion_con_iva, 0)::FLOAT as importe
+    FROM dw.fact_resultado_lote r
+    INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+    WHERE r.es_exito = true
+      AND r.id_resultado_lote <= $2
+      AND ($1::bigint[] IS NULL OR lot.id_licitacion = ANY($1))
+""", heavy=True, replica=True)
+
+GRAPH_UTE_SQL = db.prepared("graph_ute", """
+    SELECT
+        lot.id_licitacion,
+        p.id_resultado_lote,
+        p.id_adjudicatario,
+        r.fecha_adjudicacion
+    FROM dw.rel_resultado_ute_participante p
+    INNER JOIN dw.fact_resultado_lote r ON p.id_resultado_lote = r.id_resultado_lote
+    INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+    WHERE r.es_exito = true
+      AND p.id_participacion <= $2
+      AND ($1::bigint[] IS NULL OR lot.id_licitacion = ANY($1))
+""", heavy=True, replica=True)
+
+GRAPH_COMPANIES_SQL = db.prepared("graph_companies", """
+    SELECT id_adjudicatario, nombre, COALESCE(es_pyme, false) as es_pyme
+    FROM dw.dim_adjudicatario
+    WHERE id_adjudicatario = ANY($1)
+""", replica=True)
+
+
+# Empresas agrupadas con otras (entities.py); las demás son su propio grupo
+GRAPH_GROUPS_SQL = db.prepared("graph_groups", """
+    SELECT id_adjudicatario, id_grupo_empresarial
+    FROM dw.dim_adjudicatario
+    WHERE id_grupo_empresarial <> id_adjudicatario
+""", replica=True)
+
+
+def month_key(value: Optional[date]) -> Optional[int]:
+    return value.year * 100 + value.month if value is not None else None
+
+
+class TenderState:
+    """Aportación de una licitación al grafo, para poder retirarla al actualizarla"""
+    __slots__ = ("results", "month", "pairs", "ute")
+
+    def __init__(self):
+        # (empresa, mes, importe) por resultado con éxito
+        self.results: List[Tuple[int, Optional[int], float]] = []
+        # Mes de la primera adjudicación de la licitación
+        self.month: Optional[int] = None
+        # Pares de competencia aportados (vacío si es marco de acuerdo)
+        self.pairs: Tuple[Tuple[int, int], ...] = ()
+        # (mes, pares) por UTE adjudicataria
+        self.ute: List[Tuple[Optional[int], Tuple[Tuple[int, int], ...]]] = []
+
+
+class CoAwardGraph:
+    """Grafo ponderado empresa-empresa con contadores totales y mensuales"""
+
+    def __init__(self):
+        self.tenders: Dict[int, TenderState] = {}
+        self.companies: Dict[int, Tuple[str, bool]] = {}
+        self.wins: Counter = Counter()
+        self.amounts: Counter = Counter()
+        self.month_wins: Dict[int, Counter] = defaultdict(Counter)
+        self.month_amounts: Dict[int, Counter] = defaultdict(Counter)
+        self.edges = {kind: Counter() for kind in EDGE_TYPES}
+        self.adjacency = {kind: defaultdict(Counter) for kind in EDGE_TYPES}
+        self.month_edges = {kind: defaultdict(Counter) for kind in EDGE_TYPES}
+        # Empresa -> grupo y grupo -> miembros, sólo para los grupos de más de una empresa
+        self.groups: Dict[int, int] = {}
+        self.members: Dict[int, List[int]] = {}
+        self.marks: Optional[tuple] = None
+        self._checked = 0.0
+        self._lock = asyncio.Lock()
+
+    # --- mantenimiento ---
+
+    def _add_edges(self, kind: str, month: Optional[int], pairs: Iterable[Tuple[int, int]], sign: int):
+        edges = self.edges[kind]
+        adjacency = self.adjacency[kind]
+        month_edges = self.month_edges[kind][month] if month is not None else None
+        for a, b in pairs:
+            edges[(a, b)] += sign
+            adjacency[a][b] += sign
+            adjacency[b][a] += sign
+            if month_edges is not None:
+                month_edges[(a, b)] += sign
+            if edges[(a, b)] <= 0:
+                del edges[(a, b)]
+                del adjacency[a][b]
+                del adjacency[b][a]
+            if month_edges is not None and month_edges[(a, b)] <= 0:
+                del month_edges[(a, b)]
+
+    def _apply(self, state: TenderState, sign: int):
+        for company, month, amount in state.results:
+            self.wins[company] += sign
+            self.amounts[company] += sign * amount
+            if month is not None:
+                self.month_wins[month][company] += sign
+                self.month_amounts[month][company] += sign * amount
+        self._add_edges("competencia", state.month, state.pairs, sign)
+        for month, pairs in state.ute:
+            self._add_edges("ute", month, pairs, sign)
+
+    def replace_tender(self, id_licitacion: int, results: list, ute: Dict[int, Tuple[Optional[int], set]]):
+        """Sustituir la aportación de una licitación por sus datos actuales"""
+        previous = self.tenders.pop(id_licitacion, None)
+        if previous is not None:
+            self._apply(previous, -1)
+        if not results:
+            return
+        state = TenderState()
+        state.results = results
+        dated = [month for _, month, _ in results if month is not None]
+        state.month = min(dated) if dated else None
+        winners = sorted({company for company, _, _ in results})
+        if len(winners) <= MAX_WINNERS:
+            state.pairs = tuple(combinations(winners, 2))
+        state.ute = [
+            (month, tuple(combinations(sorted(participants), 2)))
+            for month, participants in ute.values()
+            if len(participants) > 1
+        ]
+        self.tenders[id_licitacion] = state
+        self._apply(state, 1)
+
+    async def _load(self, conn: asyncpg.Connection, licitaciones: Optional[List[int]], marks: tuple):
+        results = defaultdict(list)
+        for row in await db.fetch(GRAPH_RESULTS_SQL, licitaciones, marks[0], conn=conn):
+            results[row["id_licitacion"]].append(
+                (row["id_adjudicatario"], month_key(row["fecha_adjudicacion"]), row["importe"])
+            )
+        ute = defaultdict(dict)
+        for row in await db.fetch(GRAPH_UTE_SQL, licitaciones, marks[1], conn=conn):
+            entry = ute[row["id_licitacion"]].setdefault(
+                row["id_resultado_lote"], (month_key(row["fecha_adjudicacion"]), set())
+            )
+            entry[1].add(row["id_adjudicatario"])
+
+        for id_licitacion in (licitaciones if licitaciones is not None else list(results)):
+            self.replace_tender(id_licitacion, results.get(id_licitacion, []), ute.get(id_licitacion, {}))
+
+        seen = {company for rows in results.values() for company, _, _ in rows}
+        seen.update(company for entries in ute.values() for _, participants in entries.values() for company in participants)
+        missing = [company for company in seen if company not in self.companies]
+        if missing:
+            for row in await db.fetch(GRAPH_COMPANIES_SQL, missing, conn=conn):
+                self.companies[row["id_adjudicatario"]] = (row["nombre"], row["es_pyme"])
+
+    async def sync(self, force: bool = False):
+        """Construir el grafo o incorporar los cambios desde la última sincronización.
+
+        Las marcas y las filas se leen en una sola transacción REPEATABLE READ de una misma
+        conexión: con réplicas, lecturas sueltas podían ir a nodos con distinto retraso y
+        dar marcas más altas que las filas leídas, que ya no se volverían a pedir.
+        """
+        if not force and self.marks is not None and time.monotonic() - self._checked < GRAPH_SYNC_SECONDS:
+            return
+        async with self._lock:
+            if not force and self.marks is not None and time.monotonic() - self._checked < GRAPH_SYNC_SECONDS:
+                return
+            async with db.connection(replica=True) as conn:
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    await self._sync(conn)
+            self._checked = time.monotonic()
+
+    async def _sync(self, conn: asyncpg.Connection):
+        row = await db.fetchrow(GRAPH_MARKS_SQL, conn=conn)
+        marks = (row["id_resultado_lote"], row["id_participacion"], row["id_carga"], row["grupos"])
+        if self.marks is None or marks[3] != self.marks[3]:
+            self.groups = {
+                item["id_adjudicatario"]: item["id_grupo_empresarial"] for item in await db.fetch(GRAPH_GROUPS_SQL, conn=conn)
+            }
+            self.members = defaultdict(list)
+            for company, group in self.groups.items():
+                self.members[group].append(company)
+            for group, members in self.members.items():
+                members.append(group)
+        if self.marks is None:
+            await self._load(conn, None, marks)
+        elif marks != self.marks:
+            touched = await db.fetch(
+                GRAPH_TOUCHED_SQL,
+                self.marks[0], marks[0], self.marks[1], marks[1], self.marks[2], marks[2], conn=conn
+            )
+            if touched:
+                await self._load(conn, [row["id_licitacion"] for row in touched], marks)
+        self.marks = marks
+
+    # --- consultas ---
+
+    def _months(self, desde: Optional[date], hasta: Optional[date]) -> Optional[List[int]]:
+        if desde is None and hasta is None:
+            return None
+        first = month_key(desde) if desde is not None else 0
+        last = month_key(hasta) if hasta is not None else 999999
+        return [month for month in self.month_wins if first <= month <= last]
+
+    def _totals(self, months: Optional[List[int]]) -> Tuple[Counter, Counter]:
+        if months is None:
+            return self.wins, self.amounts
+        wins, amounts = Counter(), Counter()
+        for month in months:
+            wins.update(self.month_wins[month])
+            amounts.update(self.month_amounts[month])
+        return wins, amounts
+
+    def _edges(self, kind: str, months: Optional[List[int]]) -> Counter:
+        if months is None:
+            return self.edges[kind]
+        edges = Counter()
+        for month in months:
+            edges.update(self.month_edges[kind].get(month, {}))
+        return edges
+
+    def _by_group(self, wins: Counter, amounts: Counter, edges: Counter) -> Tuple[Counter, Counter, Counter]:
+        """Sumar adjudicaciones, importes y enlaces por grupo (sin los enlaces dentro de un grupo)"""
+        groups = self.groups
+        group_wins, group_amounts, group_edges = Counter(), Counter(), Counter()
+        for company, count in wins.items():
+            group = groups.get(company, company)
+            group_wins[group] += count
+            group_amounts[group] += amounts[company]
+        for (a, b), weight in edges.items():
+            a, b = groups.get(a, a), groups.get(b, b)
+            if a != b:
+                group_edges[(min(a, b), max(a, b))] += weight
+        return group_wins, group_amounts, group_edges
+
+    def _label(self, node: int, wins: Counter, grouped: bool) -> Optional[Tuple[str, bool]]:
+        """Nombre y pyme de un nodo; un grupo toma el nombre de su empresa con más adjudicaciones"""
+        if not grouped or node not in self.members:
+            return self.companies.get(node)
+        members = [company for company in self.members[node] if company in self.companies]
+        if not members:
+            return None
+        leader = max(members, key=lambda company: (wins[company], -company))
+        return self.companies[leader][0], all(self.companies[company][1] for company in members)
+
+    def network(
+        self,
+        top: int = 30,
+        min_weight: int = 2,
+        desde: Optional[date] = None,
+        hasta: Optional[date] = None,
+        centro: Optional[int] = None,
+        tipo: str = "competencia",
+        max_links: int = 50,
+        agrupar: str = "empresa"
+    ) -> dict:
+        """Obtener nodos y enlaces de la red (global o centrada en una empresa)
+
+        Con agrupar="grupo" cada nodo es un grupo empresarial (id del grupo en companyId).
+        """
+        months = self._months(desde, hasta)
+        wins, amounts = self._totals(months)
+        edges = self._edges(tipo, months)
+        company_wins = wins
+        grouped = agrupar == "grupo" and bool(self.groups)
+        if grouped:
+            wins, amounts, edges = self._by_group(wins, amounts, edges)
+            if centro is not None:
+                centro = self.groups.get(centro, centro)
+
+        if centro is not None:
+            if months is None and not grouped:
+                neighbours = self.adjacency[tipo].get(centro, {})
+            else:
+                neighbours = Counter()
+                for (a, b), weight in edges.items():
+                    if a == centro:
+                        neighbours[b] = weight
+                    elif b == centro:
+                        neighbours[a] = weight
+            strongest = heapq.nlargest(
+                top - 1,
+                (company for company, weight in neighbours.items() if weight >= min_weight),
+                key=lambda company: neighbours[company]
+            )
+            selected = [centro] + strongest if self._label(centro, company_wins, grouped) else []
+        else:
+            if tipo == "competencia":
+                candidates = (company for company, count in wins.items() if count > 0)
+                selected = heapq.nlargest(top, candidates, key=lambda company: wins[company])
+            else:
+                # En la red de UTEs se ordena por nº de asociaciones, no por adjudicaciones propias
+                strength = Counter()
+                for (a, b), weight in edges.items():
+                    strength[a] += weight
+                    strength[b] += weight
+                selected = heapq.nlargest(top, strength, key=lambda company: strength[company])
+
+        selected_set = set(selected)
+        if months is None and not grouped and len(selected) * 50 < len(edges):
+            # Con pocos nodos es más barato recorrer sus listas de adyacencia
+            adjacency = self.adjacency[tipo]
+            links = [
+                (a, b, adjacency[a][b])
+                for a in selected for b in adjacency.get(a, {})
+                if a < b and b in selected_set and adjacency[a][b] >= min_weight
+            ]
+        else:
+            links = [
+                (a, b, weight) for (a, b), weight in edges.items()
+                if weight >= min_weight and a in selected_set and b in selected_set
+            ]
+        links = heapq.nlargest(max_links, links, key=lambda link: link[2])
+        labels = {node: self._label(node, company_wins, grouped) for node in selected}
+
+        return {
+            "nodes": [
+                {
+                    "id": labels[node][0],
+                    "name": labels[node][0],
+                    "companyId": node,
+                    "wins": wins[node],
+                    "isPyme": labels[node][1],
+                    "totalAmount": amounts[node]
+                }
+                for node in selected if labels[node]
+            ],
+            "links": [
+                {
+                    "source": labels[a][0],
+                    "target": labels[b][0],
+                    "value": weight
+                }
+                for a, b, weight in links if labels[a] and labels[b]
+            ]
+        }
+
+
+network_graph = CoAwardGraph()
@@ -0,0 +1,793 @@
+"""Carga de los feeds Atom de la Plataforma de Contratación del Sector Público (PLACSP).
+
+Los ficheros se analizan en paralelo (un proceso por fichero, con iterparse, que
+envía los documentos en lotes por una cola acotada para mantener la memoria
+constante) y un único escritor resuelve las dimensiones con
+cachés en memoria y vuelca los hechos en bloque con COPY. Las entradas cuyo
+document_hash no ha cambiado se descartan; las que cambian generan una nueva
+versión del expediente sobre la misma id_licitacion.
+
+Uso: python ingest.py feeds/*.atom [--workers 4] [--batch-size 500] [--no-refresh]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import queue
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from multiprocessing import Manager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import asyncpg
+
+import db
+import metrics
+from changes import record_changes
+
+NS = {
+    "atom": "http://www.w3.org/2005/Atom",
+    "at": "http://purl.org/atompub/tombstones/1.0",
+    "cac": "urn:dgpe:names:draft:codice:schema:xsd:CommonAggregateComponents-2",
+    "cbc": "urn:dgpe:names:draft:codice:schema:xsd:CommonBasicComponents-2",
+    "cac-place-ext": "urn:dgpe:names:draft:codice-place-ext:schema:xsd:CommonAggregateComponents-2",
+    "cbc-place-ext": "urn:dgpe:names:draft:codice-place-ext:schema:xsd:CommonBasicComponents-2",
+}
+ENTRY_TAG = "{%s}entry" % NS["atom"]
+
+logger = logging.getLogger(__name__)
+
+# Listas de códigos de PLACSP
+ESTADOS = {
+    "PRE": "Anuncio previo", "PUB": "En plazo", "EV": "Pendiente de adjudicación",
+    "ADJ": "Adjudicada", "RES": "Resuelta", "ANUL": "Anulada",
+}
+TIPOS_CONTRATO = {
+    "1": "Suministros", "2": "Servicios", "3": "Obras", "7": "Administrativo especial",
+    "8": "Privado", "21": "Gestión de Servicios Públicos", "22": "Concesión de Servicios",
+    "31": "Concesión de Obras Públicas", "32": "Concesión de Obras",
+    "40": "Colaboración sector público-privado", "50": "Patrimonial", "999": "Otros",
+}
+PROCEDIMIENTOS = {
+    "1": "Abierto", "2": "Restringido", "3": "Negociado sin publicidad",
+    "4": "Negociado con publicidad", "5": "Diálogo competitivo", "6": "Contrato menor",
+    "7": "Derivado de acuerdo marco", "8": "Concurso de proyectos", "9": "Abierto simplificado",
+    "10": "Asociación para la innovación", "11": "Derivado de asociación para la innovación",
+    "12": "Basado en sistema dinámico de adquisición", "13": "Licitación con negociación",
+    "100": "Normas internas", "999": "Otros",
+}
+TRAMITACIONES = {"1": "Ordinaria", "2": "Urgente", "3": "Emergencia"}
+TIPOS_ADMINISTRACION = {
+    "1": "Administración General del Estado", "2": "Comunidad Autónoma",
+    "3": "Administración Local", "4": "Entidad de Derecho Público",
+    "5": "Otras Entidades del Sector Público",
+}
+RESULTADOS = {
+    "1": "Adjudicado provisionalmente", "2": "Adjudicado definitivamente", "3": "Desierto",
+    "4": "Desistimiento", "5": "Renuncia", "6": "Desierto provisionalmente",
+    "7": "Desierto definitivamente", "8": "Adjudicado", "9": "Formalizado",
+    "10": "Licitador mejor valorado: requerimiento de documentación",
+}
+RESULTADOS_EXITO = {"1", "2", "8", "9"}
+DURACION_DIAS = {"DAY": 1, "WEE": 7, "MON": 30, "ANN": 365}
+
+# Provincia y comunidad autónoma por los dos primeros dígitos del código postal
+PROVINCIAS = {
+    "01": ("Araba/Álava", "País Vasco"), "02": ("Albacete", "Castilla-La Mancha"),
+    "03": ("Alicante", "Comunitat Valenciana"), "04": ("Almería", "Andalucía"),
+    "05": ("Ávila", "Castilla y León"), "06": ("Badajoz", "Extremadura"),
+    "07": ("Illes Balears", "Illes Balears"), "08": ("Barcelona", "Cataluña"),
+    "09": ("Burgos", "Castilla y León"), "10": ("Cáceres", "Extremadura"),
+    "11": ("Cádiz", "Andalucía"), "12": ("Castellón", "Comunitat Valenciana"),
+    "13": ("Ciudad Real", "Castilla-La Mancha"), "14": ("Córdoba", "Andalucía"),
+    "15": ("A Coruña", "Galicia"), "16": ("Cuenca", "Castilla-La Mancha"),
+    "17": ("Girona", "Cataluña"), "18": ("Granada", "Andalucía"),
+    "19": ("Guadalajara", "Castilla-La Mancha"), "20": ("Gipuzkoa", "País Vasco"),
+    "21": ("Huelva", "Andalucía"), "22": ("Huesca", "Aragón"), "23": ("Jaén", "Andalucía"),
+    "24": ("León", "Castilla y León"), "25": ("Lleida", "Cataluña"),
+    "26": ("La Rioja", "La Rioja"), "27": ("Lugo", "Galicia"),
+    "28": ("Madrid", "Comunidad de Madrid"), "29": ("Málaga", "Andalucía"),
+    "30": ("Murcia", "Región de Murcia"), "31": ("Navarra", "Comunidad Foral de Navarra"),
+    "32": ("Ourense", "Galicia"), "33": ("Asturias", "Principado de Asturias"),
+    "34": ("Palencia", "Castilla y León"), "35": ("Las Palmas", "Canarias"),
+    "36": ("Pontevedra", "Galicia"), "37": ("Salamanca", "Castilla y León"),
+    "38": ("Santa Cruz de Tenerife", "Canarias"), "39": ("Cantabria", "Cantabria"),
+    "40": ("Segovia", "Castilla y León"), "41": ("Sevilla", "Andalucía"),
+    "42": ("Soria", "Castilla y León"), "43": ("Tarragona", "Cataluña"),
+    "44": ("Teruel", "Aragón"), "45": ("Toledo", "Castilla-La Mancha"),
+    "46": ("Valencia", "Comunitat Valenciana"), "47": ("Valladolid", "Castilla y León"),
+    "48": ("Bizkaia", "País Vasco"), "49": ("Zamora", "Castilla y León"),
+    "50": ("Zaragoza", "Aragón"), "51": ("Ceuta", "Ceuta"), "52": ("Melilla", "Melilla"),
+}
+
+
+# --- documentos analizados ---
+
+@dataclass
+class Organo:
+    cod_dir3: Optional[str]
+    nif: Optional[str]
+    nombre: str
+    tipo_administracion: Optional[str] = None
+    comunidad_autonoma: Optional[str] = None
+    provincia: Optional[str] = None
+    municipio: Optional[str] = None
+    codigo_postal: Optional[str] = None
+    url_perfil_contratante: Optional[str] = None
+    telefono_contacto: Optional[str] = None
+    email_contacto: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        if self.cod_dir3:
+            return ("dir3", self.cod_dir3)
+        if self.nif:
+            return ("nif", self.nif)
+        return ("nombre", self.nombre)
+
+
+@dataclass
+class Empresa:
+    nif: Optional[str]
+    nombre: str
+    es_pyme: Optional[bool] = None
+    provincia: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return ("nif", self.nif) if self.nif else ("nombre", self.nombre)
+
+
+@dataclass
+class Lote:
+    numero_lote: str
+    objeto_lote: Optional[str]
+    cpvs: List[str]
+    importe_lote_sin_iva: Optional[Decimal]
+    importe_lote_con_iva: Optional[Decimal]
+    plazo_ejecucion_dias: Optional[int]
+
+
+@dataclass
+class Resultado:
+    numero_lote: str
+    resultado: str
+    es_exito: bool
+    fecha_adjudicacion: Optional[date]
+    numero_licitadores: Optional[int]
+    importe_sin_iva: Optional[Decimal]
+    importe_con_iva: Optional[Decimal]
+    empresas: List[Empresa]
+
+
+@dataclass
+class Documento:
+    contract_folder_id: str
+    document_hash: str
+    actualizado: datetime
+    organo: Organo
+    fecha_publicacion: date
+    estado: Optional[str]
+    objeto_contrato: str
+    tipo_contrato: Optional[str]
+    subtipo_contrato: Optional[str]
+    valor_estimado: Optional[Decimal]
+    presupuesto_base_sin_iva: Optional[Decimal]
+    presupuesto_base_con_iva: Optional[Decimal]
+    plazo_ejecucion_dias: Optional[int]
+    tipo_procedimiento: Optional[str]
+    tramitacion: Optional[str]
+    usa_subasta_electronica: Optional[bool]
+    url_expediente: Optional[str]
+    url_pliego_administrativo: Optional[str]
+    url_pliego_tecnico: Optional[str]
+    fecha_limite_ofertas: Optional[date]
+    cpvs: List[str] = field(default_factory=list)
+    lotes: List[Lote] = field(default_factory=list)
+    resultados: List[Resultado] = field(default_factory=list)
+
+
+# --- análisis del XML (se ejecuta en los procesos de trabajo) ---
+
+def _text(elem: Optional[ET.Element], path: str) -> Optional[str]:
+    if elem is None:
+        return None
+    found = elem.find(path, NS)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip() or None
+
+
+def _decimal(value: Optional[str]) -> Optional[Decimal]:
+    try:
+        return Decimal(value) if value is not None else None
+    except InvalidOperation:
+        return None
+
+
+def _int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(Decimal(value)) if value is not None else None
+    except InvalidOperation:
+        return None
+
+
+def _date(value: Optional[str]) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+def _bool(value: Optional[str]) -> Optional[bool]:
+    return None if value is None else value.lower() == "true"
+
+
+def _party_id(party: ET.Element, scheme: str) -> Optional[str]:
+    for identification in party.findall("cac:PartyIdentification/cbc:ID", NS):
+        if identification.get("schemeName") == scheme and identification.text:
+            return identification.text.strip()
+    return None
+
+
+def _duration_days(project: Optional[ET.Element]) -> Optional[int]:
+    if project is None:
+        return None
+    measure = project.find("cac:PlannedPeriod/cbc:DurationMeasure", NS)
+    if measure is None or measure.text is None:
+        return None
+    amount = _int(measure.text)
+    factor = DURACION_DIAS.get(measure.get("unitCode", "DAY"))
+    return amount * factor if amount is not None and factor else None
+
+
+def _cpvs(project: Optional[ET.Element]) -> List[str]:
+    if project is None:
+        return []
+    codes = project.findall("cac:RequiredCommodityClassification/cbc:ItemClassificationCode", NS)
+    return list(dict.fromkeys(code.text.strip()[:8] for code in codes if code.text))
+
+
+def _parse_organo(status: ET.Element) -> Organo:
+    located = status.find("cac-place-ext:LocatedContractingParty", NS)
+    party = located.find("cac:Party", NS) if located is not None else None
+    if party is None:
+        return Organo(cod_dir3=None, nif=None, nombre="Desconocido")
+    postal_zone = _text(party, "cac:PostalAddress/cbc:PostalZone")
+    provincia, comunidad = PROVINCIAS.get((postal_zone or "")[:2], (None, None))
+    return Organo(
+        cod_dir3=_party_id(party, "DIR3"),
+        nif=_party_id(party, "NIF"),
+        nombre=_text(party, "cac:PartyName/cbc:Name") or "Desconocido",
+        tipo_administracion=TIPOS_ADMINISTRACION.get(_text(located, "cbc:ContractingPartyTypeCode")),
+        comunidad_autonoma=comunidad,
+        provincia=provincia,
+        municipio=_text(party, "cac:PostalAddress/cbc:CityName"),
+        codigo_postal=postal_zone,
+        url_perfil_contratante=_text(located, "cbc:BuyerProfileURIID"),
+        telefono_contacto=_text(party, "cac:Contact/cbc:Telephone"),
+        email_contacto=_text(party, "cac:Contact/cbc:ElectronicMail"),
+    )
+
+
+def _parse_resultado(result: ET.Element, default_lote: str) -> Optional[Resultado]:
+    empresas = []
+    for party in result.findall("cac:WinningParty", NS):
+        nombre = _text(party, "cac:PartyName/cbc:Name")
+        if nombre:
+            provincia = _text(party, "cac:PhysicalLocation/cbc:CountrySubentity")
+            empresas.append(Empresa(
+                nif=_party_id(party, "NIF"),
+                nombre=nombre,
+                es_pyme=_bool(_text(result, "cbc:SMEAwardedIndicator")),
+                provincia=provincia
+            ))
+    if not empresas:
+        # fact_resultado_lote exige adjudicatario: los lotes desiertos quedan sólo en el estado
+        return None
+    code = _text(result, "cbc:ResultCode")
+    awarded = result.find("cac:AwardedTenderedProject", NS)
+    return Resultado(
+        numero_lote=_text(awarded, "cbc:ProcurementProjectLotID") or default_lote,
+        resultado=RESULTADOS.get(code, code or "Desconocido"),
+        es_exito=code in RESULTADOS_EXITO,
+        fecha_adjudicacion=_date(_text(result, "cbc:AwardDate")),
+        numero_licitadores=_int(_text(result, "cbc:ReceivedTenderQuantity")),
+        importe_sin_iva=_decimal(_text(awarded, "cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount")),
+        importe_con_iva=_decimal(_text(awarded, "cac:LegalMonetaryTotal/cbc:PayableAmount")),
+        empresas=empresas,
+    )
+
+
+def parse_entry(entry: ET.Element) -> Optional[Documento]:
+    """Convertir una entrada del feed en un Documento (None si no es una licitación)"""
+    status = entry.find("cac-place-ext:ContractFolderStatus", NS)
+    folder_id = _text(status, "cbc:ContractFolderID")
+    if status is None or not folder_id:
+        return None
+
+    project = status.find("cac:ProcurementProject", NS)
+    process = status.find("cac:TenderingProcess", NS)
+    updated = _text(entry, "atom:updated")
+    actualizado = datetime.fromisoformat(updated) if updated else datetime.now()
+    publicaciones = [
+        _date(issue.text) for issue in status.findall(
+            "cac-place-ext:ValidNoticeInfo/cac-place-ext:AdditionalPublicationStatus/"
+            "cac-place-ext:AdditionalPublicationDocumentReference/cbc:IssueDate", NS
+        )
+    ]
+    publicaciones = [value for value in publicaciones if value is not None]
+    link = entry.find("atom:link", NS)
+
+    documento = Documento(
+        contract_folder_id=folder_id[:100],
+        document_hash=hashlib.sha256(ET.tostring(status)).hexdigest(),
+        actualizado=actualizado,
+        organo=_parse_organo(status),
+        fecha_publicacion=min(publicaciones) if publicaciones else actualizado.date(),
+        estado=ESTADOS.get(_text(status, "cbc-place-ext:ContractFolderStatusCode")),
+        objeto_contrato=_text(project, "cbc:Name") or _text(entry, "atom:title") or folder_id,
+        tipo_contrato=TIPOS_CONTRATO.get(_text(project, "cbc:TypeCode")),
+        subtipo_contrato=_text(project, "cbc:SubTypeCode"),
+        valor_estimado=_decimal(_text(project, "cac:BudgetAmount/cbc:EstimatedOverallContractAmount")),
+        presupuesto_base_sin_iva=_decimal(_text(project, "cac:BudgetAmount/cbc:TaxExclusiveAmount")),
+        presupuesto_base_con_iva=_decimal(_text(project, "cac:BudgetAmount/cbc:TotalAmount")),
+        plazo_ejecucion_dias=_duration_days(project),
+        tipo_procedimiento=PROCEDIMIENTOS.get(_text(process, "cbc:ProcedureCode")),
+        tramitacion=TRAMITACIONES.get(_text(process, "cbc:UrgencyCode")),
+        usa_subasta_electronica=_bool(_text(process, "cac:AuctionTerms/cbc:AuctionConstraintIndicator")),
+        url_expediente=link.get("href") if link is not None else None,
+        url_pliego_administrativo=_text(status, "cac:LegalDocumentReference/cac:Attachment/cac:ExternalReference/cbc:URI"),
+        url_pliego_tecnico=_text(status, "cac:TechnicalDocumentReference/cac:Attachment/cac:ExternalReference/cbc:URI"),
+        fecha_limite_ofertas=_date(_text(process, "cac:TenderSubmissionDeadlinePeriod/cbc:EndDate")),
+        cpvs=_cpvs(project),
+    )
+
+    for lot in status.findall("cac:ProcurementProjectLot", NS):
+        lot_project = lot.find("cac:ProcurementProject", NS)
+        documento.lotes.append(Lote(
+            numero_lote=_text(lot, "cbc:ID") or str(len(documento.lotes) + 1),
+            objeto_lote=_text(lot_project, "cbc:Name"),
+            cpvs=_cpvs(lot_project) or documento.cpvs,
+            importe_lote_sin_iva=_decimal(_text(lot_project, "cac:BudgetAmount/cbc:TaxExclusiveAmount")),
+            importe_lote_con_iva=_decimal(_text(lot_project, "cac:BudgetAmount/cbc:TotalAmount")),
+            plazo_ejecucion_dias=_duration_days(lot_project),
+        ))
+    if not documento.lotes:
+        # Licitación sin lotes: un lote único con los datos del contrato
+        documento.lotes.append(Lote(
+            numero_lote="1",
+            objeto_lote=documento.objeto_contrato,
+            cpvs=documento.cpvs,
+            importe_lote_sin_iva=documento.presupuesto_base_sin_iva,
+            importe_lote_con_iva=documento.presupuesto_base_con_iva,
+            plazo_ejecucion_dias=documento.plazo_ejecucion_dias,
+        ))
+
+    lot_numbers = {lote.numero_lote for lote in documento.lotes}
+    for result in status.findall("cac:TenderResult", NS):
+        resultado = _parse_resultado(result, documento.lotes[0].numero_lote)
+        if resultado is not None and resultado.numero_lote in lot_numbers:
+            documento.resultados.append(resultado)
+    return documento
+
+
+def iter_feed(path: str) -> Iterator[Documento]:
+    """Recorrer un fichero Atom entrada a entrada sin cargarlo entero en memoria"""
+    context = ET.iterparse(path, events=("start", "end"))
+    root = None
+    for event, elem in context:
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == ENTRY_TAG:
+            documento = parse_entry(elem)
+            if documento is not None:
+                yield documento
+            root.clear()
+
+
+def parse_feed(index: int, path: str, batch_size: int, batches) -> int:
+    """Analizar un fichero y enviar sus documentos en lotes (punto de entrada de los procesos de trabajo).
+
+    Cada lote se pone en la cola como (index, documentos) y al terminar, también si
+    falla, se pone (index, None). La cola está acotada: si el escritor va por detrás el
+    proceso espera, así que la memoria no depende del tamaño del fichero.
+    """
+    entries = 0
+    batch: List[Documento] = []
+    try:
+        for documento in iter_feed(path):
+            batch.append(documento)
+            if len(batch) == batch_size:
+                batches.put((index, batch))
+                entries += len(batch)
+                batch = []
+        if batch:
+            batches.put((index, batch))
+            entries += len(batch)
+    finally:
+        batches.put((index, None))
+    return entries
+
+
+# --- escritura en la base de datos ---
+
+def id_fecha(value: date) -> int:
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+class DimensionCache:
+    """Caché clave natural -> clave subrogada para una dimensión"""
+
+    def __init__(self):
+        self.ids: Dict[Tuple[str, str], int] = {}
+
+    def missing(self, keys) -> list:
+        return [key for key in dict.fromkeys(keys) if key not in self.ids]
+
+
+class Loader:
+    """Escritor único: resuelve dimensiones y vuelca lotes de documentos con COPY"""
+
+    def __init__(self, conn: asyncpg.Connection):
+        self.conn = conn
+        self.organos = DimensionCache()
+        self.empresas = DimensionCache()
+        self.cpvs: set = set()
+        self.fechas: set = set()
+        self.stats = {"leidos": 0, "sin_cambios": 0, "nuevos": 0, "actualizados": 0}
+
+    async def preload(self):
+        """Cargar en memoria las dimensiones pequeñas"""
+        for row in await self.conn.fetch("SELECT id_organo, cod_dir3, nif, nombre FROM dw.dim_organo"):
+            if row["cod_dir3"]:
+                self.organos.ids[("dir3", row["cod_dir3"])] = row["id_organo"]
+            if row["nif"]:
+                self.organos.ids.setdefault(("nif", row["nif"]), row["id_organo"])
+            self.organos.ids.setdefault(("nombre", row["nombre"]), row["id_organo"])
+        self.cpvs = {row["codigo_cpv"] for row in await self.conn.fetch("SELECT codigo_cpv FROM dw.dim_cpv")}
+        self.fechas = {row["id_fecha"] for row in await self.conn.fetch("SELECT id_fecha FROM dw.dim_tiempo")}
+
+    async def _allocate(self, sequence: str, count: int) -> List[int]:
+        if count == 0:
+            return []
+        rows = await self.conn.fetch(
+            "SELECT nextval($1::regclass) as id FROM generate_series(1, $2)", sequence, count
+        )
+        return [row["id"] for row in rows]
+
+    async def _resolve_fechas(self, fechas):
+        missing = sorted({id_fecha(value): value for value in fechas if id_fecha(value) not in self.fechas}.items())
+        if missing:
+            await self.conn.executemany("""
+                INSERT INTO dw.dim_tiempo (id_fecha, fecha, anio, trimestre, mes, dia, nombre_mes, semana_anio)
+                VALUES ($1, $2, EXTRACT(YEAR FROM $2::date), EXTRACT(QUARTER FROM $2::date),
+                        EXTRACT(MONTH FROM $2::date), EXTRACT(DAY FROM $2::date),
+                        TRIM(TO_CHAR($2::date, 'TMMonth')), EXTRACT(WEEK FROM $2::date))
+                ON CONFLICT (id_fecha) DO NOTHING
+            """, missing)
+            self.fechas.update(key for key, _ in missing)
+
+    async def _resolve_cpvs(self, codes):
+        missing = sorted(set(codes) - self.cpvs)
+        if missing:
+            # Códigos que no están en el catálogo: se dan de alta sin jerarquía
+            await self.conn.executemany("""
+                INSERT INTO dw.dim_cpv (codigo_cpv, descripcion)
+                VALUES ($1::varchar, 'CPV ' || $1::varchar)
+                ON CONFLICT (codigo_cpv) DO NOTHING
+            """, [(code,) for code in missing])
+            self.cpvs.update(missing)
+
+    async def _resolve_organos(self, organos: List[Organo]):
+        by_key = {organo.key: organo for organo in organos}
+        missing = self.organos.missing(by_key)
+        if not missing:
+            return
+        for row in await self.conn.fetch("""
+            SELECT id_organo, cod_dir3, nif, nombre FROM dw.dim_organo
+            WHERE cod_dir3 = ANY($1) OR nif = ANY($2) OR nombre = ANY($3)
+        """, [v for k, v in missing if k == "dir3"], [v for k, v in missing if k == "nif"],
+                [v for k, v in missing if k == "nombre"]):
+            for key in (("dir3", row["cod_dir3"]), ("nif", row["nif"]), ("nombre", row["nombre"])):
+                if key in by_key:
+                    self.organos.ids[key] = row["id_organo"]
+        for key in self.organos.missing(missing):
+            organo = by_key[key]
+            self.organos.ids[key] = await self.conn.fetchval("""
+                INSERT INTO dw.dim_organo (
+                    cod_dir3, nif, nombre, tipo_administracion, comunidad_autonoma, provincia,
+                    municipio, codigo_postal, url_perfil_contratante, telefono_contacto, email_contacto
+                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+                RETURNING id_organo
+            """, organo.cod_dir3, organo.nif, organo.nombre, organo.tipo_administracion,
+                organo.comunidad_autonoma, organo.provincia, organo.municipio, organo.codigo_postal,
+                organo.url_perfil_contratante, organo.telefono_contacto, organo.email_contacto)
+
+    async def _resolve_empresas(self, empresas: List[Empresa]):
+        by_key = {empresa.key: empresa for empresa in empresas}
+        missing = self.empresas.missing(by_key)
+        if not missing:
+            return
+        for row in await self.conn.fetch("""
+            SELECT id_adjudicatario, nif, nombre FROM dw.dim_adjudicatario
+            WHERE nif = ANY($1) OR (nif IS NULL AND nombre = ANY($2))
+        """, [v for k, v in missing if k == "nif"], [v for k, v in missing if k == "nombre"]):
+            key = ("nif", row["nif"]) if row["nif"] else ("nombre", row["nombre"])
+            self.empresas.ids[key] = row["id_adjudicatario"]
+        new = [by_key[key] for key in self.empresas.missing(missing)]
+        if new:
+            rows = await self.conn.fetch("""
+                INSERT INTO dw.dim_adjudicatario (nif, nombre, es_pyme, provincia)
+                SELECT * FROM unnest($1::varchar[], $2::text[], $3::boolean[], $4::varchar[])
+                RETURNING id_adjudicatario, nif, nombre
+            """, [e.nif for e in new], [e.nombre for e in new], [e.es_pyme for e in new],
+                [e.provincia for e in new])
+            for row in rows:
+                key = ("nif", row["nif"]) if row["nif"] else ("nombre", row["nombre"])
+                self.empresas.ids[key] = row["id_adjudicatario"]
+
+    async def write_batch(self, documentos: List[Documento]):
+        """Escribir un lote de documentos en una única transacción"""
+        self.stats["leidos"] += len(documentos)
+        # Dentro del lote sólo cuenta la última versión de cada expediente
+        latest: Dict[str, Documento] = {}
+        for documento in documentos:
+            current = latest.get(documento.contract_folder_id)
+            if current is None or documento.actualizado >= current.actualizado:
+                latest[documento.contract_folder_id] = documento
+
+        async with self.conn.transaction():
+            existing = {
+                row["contract_folder_id"]: row for row in await self.conn.fetch("""
+                    SELECT DISTINCT ON (contract_folder_id)
+                        contract_folder_id, id_licitacion, version_expediente, document_hash, estado,
+                        id_organo, id_fecha_publicacion
+                    FROM dw.fact_licitacion
+                    WHERE contract_folder_id = ANY($1)
+                    ORDER BY contract_folder_id, version_expediente DESC
+                """, list(latest))
+            }
+            changed = [d for d in latest.values() if d.contract_folder_id not in existing
+                       or existing[d.contract_folder_id]["document_hash"] != d.document_hash]
+            self.stats["sin_cambios"] += len(documentos) - len(changed)
+            if not changed:
+                return
+
+            await self._resolve_organos([d.organo for d in changed])
+            await self._resolve_empresas([e for d in changed for r in d.resultados for e in r.empresas])
+            await self._resolve_cpvs([c for d in changed for c in d.cpvs + [c for lote in d.lotes for c in lote.cpvs]])
+            await self._resolve_fechas(
+                [d.fecha_publicacion for d in changed] + [d.actualizado.date() for d in changed]
+                + [r.fecha_adjudicacion for d in changed for r in d.resultados if r.fecha_adjudicacion]
+            )
+
+            new_ids = iter(await self._allocate(
+                "dw.fact_licitacion_id_licitacion_seq",
+                sum(1 for d in changed if d.contract_folder_id not in existing)
+            ))
+            ids, versions, updated_ids = {}, {}, []
+            for d in changed:
+                previous = existing.get(d.contract_folder_id)
+                if previous is None:
+                    ids[d.contract_folder_id] = next(new_ids)
+                    versions[d.contract_folder_id] = 1
+                else:
+                    ids[d.contract_folder_id] = previous["id_licitacion"]
+                    versions[d.contract_folder_id] = (previous["version_expediente"] or 1) + 1
+                    updated_ids.append(previous["id_licitacion"])
+            self.stats["nuevos"] += len(changed) - len(updated_ids)
+            self.stats["actualizados"] += len(updated_ids)
+
+            awarded = set()
+            if updated_ids:
+                # Adjudicaciones ya registradas: sólo las nuevas van al registro de cambios
+                awarded = {tuple(row) for row in await self.conn.fetch("""
+                    SELECT lot.id_licitacion, lot.numero_lote, r.id_adjudicatario
+                    FROM dw.fact_lote lot
+                    INNER JOIN dw.fact_resultado_lote r ON r.id_lote = lot.id_lote
+                    WHERE lot.id_licitacion = ANY($1) AND r.es_exito
+                """, updated_ids)}
+                # Las versiones nuevas sustituyen lotes, resultados y CPV de la anterior
+                await self.conn.execute("""
+                    WITH lotes AS (SELECT id_lote FROM dw.fact_lote WHERE id_licitacion = ANY($1)),
+                    resultados AS (
+                        SELECT id_resultado_lote FROM dw.fact_resultado_lote WHERE id_lote IN (SELECT id_lote FROM lotes)
+                    ),
+                    ute AS (
+                        DELETE FROM dw.rel_resultado_ute_participante
+                        WHERE id_resultado_lote IN (SELECT id_resultado_lote FROM resultados)
+                    )
+                    DELETE FROM dw.rel_lote_cpv WHERE id_lote IN (SELECT id_lote FROM lotes)
+                """, updated_ids)
+                await self.conn.execute("""
+                    DELETE FROM dw.fact_resultado_lote
+                    WHERE id_lote IN (SELECT id_lote FROM dw.fact_lote WHERE id_licitacion = ANY($1))
+                """, updated_ids)
+                await self.conn.execute("DELETE FROM dw.fact_lote WHERE id_licitacion = ANY($1)", updated_ids)
+                await self.conn.execute("DELETE FROM dw.rel_licitacion_cpv WHERE id_licitacion = ANY($1)", updated_ids)
+
+            await self._copy_facts(changed, ids, versions, existing, awarded)
+
+    async def _copy_facts(self, changed: List[Documento], ids: dict, versions: dict, existing: dict, awarded: set):
+        licitaciones, rel_cpv, eventos, diario, cambios = [], [], [], [], []
+        for d in changed:
+            id_licitacion = ids[d.contract_folder_id]
+            id_organo = self.organos.ids[d.organo.key]
+            id_fecha_publicacion = id_fecha(d.fecha_publicacion)
+            previous = existing.get(d.contract_folder_id)
+            lotes_con_resultado = {r.numero_lote for r in d.resultados}
+            licitaciones.append((
+                id_licitacion, d.contract_folder_id, versions[d.contract_folder_id],
+                id_organo, id_fecha_publicacion, d.fecha_publicacion,
+                d.estado, d.objeto_contrato, d.tipo_contrato, d.subtipo_contrato, d.valor_estimado,
+                d.presupuesto_base_sin_iva, d.presupuesto_base_con_iva, d.plazo_ejecucion_dias,
+                d.tipo_procedimiento, d.tramitacion, d.usa_subasta_electronica, len(d.lotes),
+                sum(r.numero_licitadores or 0 for r in d.resultados) if lotes_con_resultado else None,
+                d.url_expediente, d.url_pliego_administrativo, d.url_pliego_tecnico,
+                d.fecha_limite_ofertas,
+                (d.fecha_limite_ofertas - d.fecha_publicacion).days if d.fecha_limite_ofertas else None,
+                d.tramitacion in ("Urgente", "Emergencia"), len(d.lotes) > 1, d.document_hash,
+            ))
+            rel_cpv.extend((id_licitacion, code, i == 0) for i, code in enumerate(d.cpvs))
+            if previous is None or previous["estado"] != d.estado:
+                eventos.append((
+                    id_licitacion, id_fecha(d.actualizado.date()), d.actualizado.replace(tzinfo=None),
+                    "Publicación" if previous is None else "Cambio de estado", d.estado
+                ))
+            tipo = "alta" if previous is None else "estado" if previous["estado"] != d.estado else "modificacion"
+            cambios.append((id_licitacion, tipo, d.estado, None, None, None))
+            # Si cambia de organismo o de mes de publicación, el refresco también recalcula
+            # los KPIs del organismo anterior y las tendencias del mes anterior
+            organo_anterior = fecha_anterior = None
+            if previous is not None:
+                if previous["id_organo"] != id_organo:
+                    organo_anterior = previous["id_organo"]
+                if previous["id_fecha_publicacion"] // 100 != id_fecha_publicacion // 100:
+                    fecha_anterior = previous["id_fecha_publicacion"]
+            diario.append((id_licitacion, organo_anterior, fecha_anterior))
+
+        await self.conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS tmp_fact_licitacion
+            (LIKE dw.fact_licitacion INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+        """)
+        columns = [
+            "id_licitacion", "contract_folder_id", "version_expediente", "id_organo",
+            "id_fecha_publicacion", "fecha_publicacion", "estado", "objeto_contrato", "tipo_contrato",
+            "subtipo_contrato", "valor_estimado", "presupuesto_base_sin_iva", "presupuesto_base_con_iva",
+            "plazo_ejecucion_dias", "tipo_procedimiento", "tramitacion", "usa_subasta_electronica",
+            "num_lotes", "num_licitadores_total", "url_expediente", "url_pliego_administrativo",
+            "url_pliego_tecnico", "fecha_limite_ofertas", "dias_para_ofertar", "es_urgente",
+            "es_lote_multiple", "document_hash",
+        ]
+        await self.conn.copy_records_to_table("tmp_fact_licitacion", records=licitaciones, columns=columns)
+        assignments = ", ".join(f"{column} = t.{column}" for column in columns[1:])
+        await self.conn.execute(f"""
+            UPDATE dw.fact_licitacion l SET {assignments}
+            FROM tmp_fact_licitacion t WHERE l.id_licitacion = t.id_licitacion
+        """)
+        await self.conn.execute(f"""
+            INSERT INTO dw.fact_licitacion ({", ".join(columns)})
+            SELECT {", ".join(columns)} FROM tmp_fact_licitacion t
+            WHERE NOT EXISTS (SELECT 1 FROM dw.fact_licitacion l WHERE l.id_licitacion = t.id_licitacion)
+        """)
+
+        lot_ids = iter(await self._allocate("dw.fact_lote_id_lote_seq", sum(len(d.lotes) for d in changed)))
+        result_ids = iter(await self._allocate(
+            "dw.fact_resultado_lote_id_resultado_lote_seq", sum(len(d.resultados) for d in changed)
+        ))
+        lotes, rel_lote_cpv, resultados, ute = [], [], [], []
+        for d in changed:
+            id_licitacion = ids[d.contract_folder_id]
+            lote_ids = {}
+            for lote in d.lotes:
+                id_lote = next(lot_ids)
+                lote_ids[lote.numero_lote] = id_lote
+                lotes.append((
+                    id_lote, id_licitacion, lote.numero_lote[:50], lote.objeto_lote,
+                    lote.cpvs[0] if lote.cpvs else None, lote.importe_lote_sin_iva,
+                    lote.importe_lote_con_iva, lote.plazo_ejecucion_dias
+                ))
+                rel_lote_cpv.extend((id_lote, code, i == 0) for i, code in enumerate(lote.cpvs))
+            for r in d.resultados:
+                id_resultado = next(result_ids)
+                empresa_ids = [self.empresas.ids[e.key] for e in r.empresas]
+                es_ute = len(empresa_ids) > 1
+                resultados.append((
+                    id_resultado, lote_ids[r.numero_lote], empresa_ids[0],
+                    id_fecha(r.fecha_adjudicacion) if r.fecha_adjudicacion else None, r.fecha_adjudicacion,
+                    r.importe_sin_iva, r.importe_con_iva, r.numero_licitadores, r.resultado[:50],
+                    es_ute, " - ".join(e.nombre for e in r.empresas) if es_ute else None, r.es_exito
+                ))
+                if es_ute:
+                    ute.extend((id_resultado, empresa, i == 0) for i, empresa in enumerate(dict.fromkeys(empresa_ids)))
+                if r.es_exito and (id_licitacion, r.numero_lote[:50], empresa_ids[0]) not in awarded:
+                    cambios.append((
+                        id_licitacion, "adjudicacion", d.estado, r.numero_lote[:50], empresa_ids[0], r.importe_con_iva
+                    ))
+
+        await self.conn.copy_records_to_table(
+            "rel_licitacion_cpv", schema_name="dw", records=rel_cpv,
+            columns=["id_licitacion", "codigo_cpv", "es_principal"]
+        )
+        await self.conn.copy_records_to_table("fact_lote", schema_name="dw", records=lotes, columns=[
+            "id_lote", "id_licitacion", "numero_lote", "objeto_lote", "id_cpv_principal",
+            "importe_lote_sin_iva", "importe_lote_con_iva", "plazo_ejecucion_dias",
+        ])
+        await self.conn.copy_records_to_table(
+            "rel_lote_cpv", schema_name="dw", records=rel_lote_cpv,
+            columns=["id_lote", "codigo_cpv", "es_principal"]
+        )
+        await self.conn.copy_records_to_table("fact_resultado_lote", schema_name="dw", records=resultados, columns=[
+            "id_resultado_lote", "id_lote", "id_adjudicatario", "id_fecha_adjudicacion", "fecha_adjudicacion",
+            "importe_adjudicacion_sin_iva", "importe_adjudicacion_con_iva", "numero_licitadores", "resultado",
+            "es_ute", "nombre_ute_virtual", "es_exito",
+        ])
+        await self.conn.copy_records_to_table(
+            "rel_resultado_ute_participante", schema_name="dw", records=ute,
+            columns=["id_resultado_lote", "id_adjudicatario", "es_lider_ute"]
+        )
+        await self.conn.copy_records_to_table("fact_evento_licitacion", schema_name="dw", records=eventos, columns=[
+            "id_licitacion", "id_fecha_evento", "fecha_evento", "tipo_evento", "estado_resultante",
+        ])
+        await self.conn.copy_records_to_table(
+            "etl_licitacion_cargada", schema_name="dw", records=diario,
+            columns=["id_licitacion", "id_organo_anterior", "id_fecha_publicacion_anterior"]
+        )
+        await record_changes(self.conn, cambios)
+
+
+async def ingest(paths: List[str], workers: int = 4, batch_size: int = 500, refresh: bool = True):
+    """Analizar los ficheros en paralelo y escribir sus documentos por lotes"""
+    conn = await asyncpg.connect(**db.DB_CONFIG)
+    try:
+        loader = Loader(conn)
+        await loader.preload()
+        loop = asyncio.get_running_loop()
+        with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+            batches = manager.Queue(maxsize=2 * workers)
+            futures = [executor.submit(parse_feed, index, path, batch_size, batches) for index, path in enumerate(paths)]
+            pending = len(futures)
+            while pending:
+                try:
+                    index, documentos = await loop.run_in_executor(None, batches.get, True, 1)
+                except queue.Empty:
+                    # Un proceso que muere sin llegar a avisar (BrokenProcessPool) no deja esperando para siempre
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+                if documentos is not None:
+                    await loader.write_batch(documentos)
+                    continue
+                pending -= 1
+                entries = await loop.run_in_executor(None, futures[index].result)
+                logger.info("feed loaded", extra={"path": paths[index], "entries": entries})
+        logger.info("ingestion finished", extra=loader.stats)
+        if refresh:
+            from refresh import run_refresh
+            await run_refresh(conn)
+    finally:
+        await conn.close()
+
+
+def main():
+    metrics.configure_logging()
+    parser = argparse.ArgumentParser(description="Cargar feeds Atom de PLACSP en el esquema dw")
+    parser.add_argument("paths", nargs="+", help="ficheros .atom/.xml")
+    parser.add_argument("--workers", type=int, default=4, help="procesos de análisis en paralelo")
+    parser.add_argument("--batch-size", type=int, default=500, help="documentos por transacción")
+    parser.add_argument("--no-refresh", action="store_true", help="no refrescar las tablas precalculadas")
+    args = parser.parse_args()
+    asyncio.run(ingest(args.paths, args.workers, args.batch_size, not args.no_refresh))
+
+
+if __name__ == "__main__":
+    main()
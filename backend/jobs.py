@@ -0,0 +1,472 @@
+"""Informes pesados en segundo plano: cola, progreso y resultados comprimidos en disco.
+
+POST /api/jobs encola un informe (uno de REPORTS con sus parámetros) y devuelve su id.
+Cada proceso de la API ejecuta como mucho JOB_WORKERS a la vez, con un cursor de servidor
+sobre una conexión propia (db.dedicated_connection, en una réplica si la hay): un informe
+largo no ocupa conexiones del pool ni plazas de las sentencias pesadas de los endpoints
+interactivos. Las filas se escriben con gzip en JOBS_DIR; la compresión se hace en un hilo
+para no bloquear el bucle de eventos.
+
+El estado de cada trabajo es un JSON en JOBS_DIR junto a su resultado, así que con varios
+workers cualquiera responde por el progreso y sirve el fichero (admite Range). Los
+resultados caducan JOB_TTL_SECONDS después de terminar y, si el directorio pasa de
+JOB_SPOOL_MAX_BYTES, se borran primero los descargados hace más tiempo (LRU).
+"""
+import asyncio
+import fcntl
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+import db
+import metrics
+from export import CHUNK_WRITERS, EXPORT_FORMATS
+
+JOBS_DIR = Path(os.getenv("JOBS_DIR", os.path.join(tempfile.gettempdir(), "licitamonitor-jobs")))
+# Informes ejecutándose a la vez en cada proceso
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Informes en espera por proceso; con la cola llena POST /api/jobs responde 503
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Tiempo máximo de la sentencia de un informe (s); 0 = sin límite
+JOB_STATEMENT_TIMEOUT = float(os.getenv("JOB_STATEMENT_TIMEOUT", "3600"))
+# Vida de un resultado desde que termina (s)
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "86400"))
+# Tamaño máximo de los resultados en disco (bytes)
+JOB_SPOOL_MAX_BYTES = int(os.getenv("JOB_SPOOL_MAX_BYTES", str(2 * 1024 ** 3)))
+# Intervalo entre limpiezas del directorio (s)
+JOB_SWEEP_SECONDS = float(os.getenv("JOB_SWEEP_SECONDS", "300"))
+JOB_GZIP_LEVEL = int(os.getenv("JOB_GZIP_LEVEL", "6"))
+# Filas por lote leído del cursor
+CHUNK_SIZE = 5000
+# Como mucho una escritura del progreso en disco por intervalo (s)
+PROGRESS_INTERVAL = 1.0
+# Bloque de lectura al servir un resultado
+READ_SIZE = 64 * 1024
+MAX_COMPANIES = 1000
+
+FINISHED = ("done", "failed", "cancelled")
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+logger = logging.getLogger(__name__)
+
+
+class Report(NamedTuple):
+    """Informe que se puede pedir por POST /api/jobs"""
+    statement: db.Statement
+    # Parámetros de la sentencia a partir de los del trabajo (ValueError si no son válidos)
+    args: Callable[[dict], tuple]
+
+
+REPORTS: Dict[str, Report] = {}
+
+
+def register_report(name: str, statement: db.Statement, args: Callable[[dict], tuple]):
+    REPORTS[name] = Report(statement, args)
+
+
+# Adjudicaciones con detalle por lote de unas empresas (con grupo, también las de sus grupos
+# empresariales) desde una fecha
+AWARDS_REPORT_SQL = db.prepared("report_adjudicaciones", """
+    WITH empresa AS (
+        SELECT unnest($1::bigint[]) as id_adjudicatario
+        UNION
+        SELECT a.id_adjudicatario
+        FROM dw.dim_adjudicatario a
+        WHERE $2 AND a.id_grupo_empresarial IN (
+            SELECT g.id_grupo_empresarial FROM dw.dim_adjudicatario g
+            WHERE g.id_adjudicatario = ANY($1::bigint[])
+        )
+    )
+    SELECT
+        r.id_resultado_lote as id,
+        r.fecha_adjudicacion as "awardDate",
+        r.id_adjudicatario as "awardeeId",
+        a.nombre as awardee,
+        a.nif,
+        COALESCE(a.id_grupo_empresarial, a.id_adjudicatario) as "groupId",
+        l.id_licitacion as "tenderId",
+        l.objeto_contrato as title,
+        o.nombre as organism,
+        lot.numero_lote as lot,
+        lot.objeto_lote as "lotTitle",
+        lot.id_cpv_principal as cpv,
+        lot.importe_lote_con_iva::float as "lotBudget",
+        r.importe_adjudicacion_con_iva::float as amount,
+        l.url_expediente as url
+    FROM empresa e
+    INNER JOIN dw.fact_resultado_lote r ON r.id_adjudicatario = e.id_adjudicatario
+    INNER JOIN dw.dim_adjudicatario a ON a.id_adjudicatario = r.id_adjudicatario
+    INNER JOIN dw.fact_lote lot ON lot.id_lote = r.id_lote
+    INNER JOIN dw.fact_licitacion l ON l.id_licitacion = lot.id_licitacion
+    INNER JOIN dw.dim_organo o ON o.id_organo = l.id_organo
+    WHERE r.es_exito = true
+      AND r.fecha_adjudicacion >= $3
+      AND ($4::date IS NULL OR r.fecha_adjudicacion < $4)
+    ORDER BY r.fecha_adjudicacion, r.id_resultado_lote
+""", heavy=True, replica=True)
+
+
+def _awards_args(params: dict) -> tuple:
+    """adjudicatarios: ids; grupo: incluir sus grupos; desde/hasta: fechas ISO (por defecto 5 años)"""
+    companies = [int(company) for company in params.get("adjudicatarios") or []]
+    if not 0 < len(companies) <= MAX_COMPANIES:
+        raise ValueError(f"adjudicatarios debe tener entre 1 y {MAX_COMPANIES} ids")
+    desde = date.fromisoformat(params["desde"]) if params.get("desde") else date.today() - timedelta(days=5 * 365)
+    hasta = date.fromisoformat(params["hasta"]) if params.get("hasta") else None
+    return companies, bool(params.get("grupo", False)), desde, hasta
+
+
+register_report("adjudicaciones", AWARDS_REPORT_SQL, _awards_args)
+
+
+class JobQueueFull(Exception):
+    """La cola de informes de este proceso está llena"""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _path(job_id: str, suffix: str) -> Path:
+    return JOBS_DIR / f"{job_id}{suffix}"
+
+
+def read_job(job_id: str) -> Optional[dict]:
+    """Estado de un trabajo (de cualquier proceso), o None si no existe o ha caducado"""
+    if not _JOB_ID.match(job_id):
+        return None
+    try:
+        return json.loads(_path(job_id, ".json").read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def _save(job: dict):
+    """Escribir el estado de forma atómica (los lectores nunca ven un JSON a medias)"""
+    tmp = _path(job["id"], f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(job), encoding="utf-8")
+    os.replace(tmp, _path(job["id"], ".json"))
+
+
+def _remove(job_id: str):
+    for suffix in (".json", ".gz", ".part", ".cancel"):
+        _path(job_id, suffix).unlink(missing_ok=True)
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+def job_out(job: dict) -> dict:
+    """Trabajo en el formato de la API"""
+    out = {key: value for key, value in job.items() if key != "pid"}
+    for key in ("createdAt", "startedAt", "finishedAt", "accessedAt"):
+        out[key] = _iso(job.get(key))
+    out["resultUrl"] = f"/api/jobs/{job['id']}/result" if job["status"] == "done" else None
+    return out
+
+
+def _progress(job: dict) -> Optional[float]:
+    """Fracción hecha según las filas estimadas por el planificador (1 sólo al terminar).
+
+    Si ya se han escrito más filas de las estimadas se desconoce (None).
+    """
+    if not job.get("estimatedRows") or job["rows"] > job["estimatedRows"]:
+        return None
+    return round(min(job["rows"] / job["estimatedRows"], 0.99), 4)
+
+
+async def _estimate_rows(conn, sql: str, args: tuple) -> int:
+    plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep():
+    """Cerrar los trabajos de procesos que ya no existen y caducar resultados (TTL y LRU).
+
+    Con varios workers sólo limpia uno a la vez (bloqueo de fichero); los demás se la saltan.
+    """
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(JOBS_DIR / ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        now = time.time()
+        done = []
+        for path in JOBS_DIR.glob("*.json"):
+            job = read_job(path.stem)
+            if job is None:
+                continue
+            if job["status"] not in FINISHED:
+                if not _pid_alive(job["pid"]):
+                    _path(job["id"], ".part").unlink(missing_ok=True)
+                    job.update(status="failed", error="interrupted", finishedAt=now)
+                    _save(job)
+            elif now - job["finishedAt"] > JOB_TTL_SECONDS:
+                _remove(job["id"])
+            elif job["status"] == "done":
+                done.append(job)
+        total = sum(job["bytes"] for job in done)
+        for job in sorted(done, key=lambda job: job.get("accessedAt") or job["finishedAt"]):
+            if total <= JOB_SPOOL_MAX_BYTES:
+                break
+            _remove(job["id"])
+            total -= job["bytes"]
+            logger.info("job result evicted", extra={"job": job["id"], "bytes": job["bytes"]})
+        metrics.JOB_SPOOL_BYTES.set(total)
+
+
+class JobQueue:
+    """Cola y workers de informes de un proceso de la API"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, dict] = {}
+        self._cancelled: set = set()
+
+    async def start(self):
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        self._queue = asyncio.Queue(JOB_QUEUE_SIZE)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(JOB_WORKERS)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Los que seguían en cola no se van a ejecutar
+        while self._queue is not None and not self._queue.empty():
+            job = read_job(self._queue.get_nowait())
+            if job is not None and job["status"] == "queued":
+                job.update(status="failed", error="interrupted", finishedAt=time.time())
+                _save(job)
+        self._queue = None
+
+    def submit(self, report: str, params: dict, fmt: str) -> dict:
+        """Validar y encolar un informe; ValueError si no es válido, JobQueueFull si no cabe"""
+        if report not in REPORTS:
+            raise ValueError(f"report debe ser uno de: {', '.join(sorted(REPORTS))}")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"format debe ser uno de: {', '.join(EXPORT_FORMATS)}")
+        try:
+            REPORTS[report].args(params)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Parámetros no válidos para {report}: {e}")
+        if self._queue is None or self._queue.full():
+            raise JobQueueFull()
+        job = {
+            "id": uuid.uuid4().hex,
+            "report": report,
+            "params": params,
+            "format": fmt,
+            "status": "queued",
+            "progress": 0.0,
+            "rows": 0,
+            "estimatedRows": None,
+            "bytes": 0,
+            "error": None,
+            "createdAt": time.time(),
+            "startedAt": None,
+            "finishedAt": None,
+            "accessedAt": None,
+            "pid": os.getpid(),
+        }
+        _save(job)
+        self._queue.put_nowait(job["id"])
+        self._gauges()
+        return job
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        """Cancelar un trabajo pendiente (en cualquier proceso) o borrar uno terminado"""
+        job = read_job(job_id)
+        if job is None:
+            return None
+        if job["status"] in FINISHED:
+            _remove(job_id)
+        else:
+            # El proceso que lo ejecuta comprueba la marca entre lotes
+            self._cancelled.add(job_id)
+            _path(job_id, ".cancel").touch()
+        return job
+
+    def _is_cancelled(self, job_id: str) -> bool:
+        return job_id in self._cancelled or _path(job_id, ".cancel").exists()
+
+    def _gauges(self):
+        metrics.JOBS.set(self._queue.qsize() if self._queue is not None else 0, "queued")
+        metrics.JOBS.set(len(self._running), "running")
+
+    async def _sweeper(self):
+        while True:
+            try:
+                await asyncio.to_thread(sweep)
+            except Exception:
+                logger.exception("error sweeping job results")
+            await asyncio.sleep(JOB_SWEEP_SECONDS)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = read_job(job_id)
+            if job is not None and job["status"] == "queued":
+                await self._run(job)
+            self._gauges()
+
+    async def _run(self, job: dict):
+        report = REPORTS[job["report"]]
+        write_chunk = CHUNK_WRITERS[job["format"]]
+        part = _path(job["id"], ".part")
+        started = time.monotonic()
+        job.update(status="running", startedAt=time.time())
+        self._running[job["id"]] = job
+        self._gauges()
+        try:
+            if self._is_cancelled(job["id"]):
+                raise _Cancelled()
+            _save(job)
+            args = report.args(job["params"])
+            async with db.dedicated_connection(report.statement.replica, JOB_STATEMENT_TIMEOUT) as conn:
+                job["estimatedRows"] = await _estimate_rows(conn, report.statement.sql, args)
+                _save(job)
+                spool = await asyncio.to_thread(gzip.open, part, "wb", JOB_GZIP_LEVEL)
+                try:
+                    # Los cursores de servidor necesitan una transacción abierta
+                    async with conn.transaction(readonly=True):
+                        cursor = await conn.cursor(report.statement.sql, *args)
+                        saved = time.monotonic()
+                        while True:
+                            rows = await cursor.fetch(CHUNK_SIZE)
+                            if not rows:
+                                break
+                            await asyncio.to_thread(spool.write, write_chunk(rows, job["rows"] == 0))
+                            job["rows"] += len(rows)
+                            if time.monotonic() - saved >= PROGRESS_INTERVAL:
+                                if self._is_cancelled(job["id"]):
+                                    raise _Cancelled()
+                                job["progress"] = _progress(job)
+                                _save(job)
+                                saved = time.monotonic()
+                finally:
+                    await asyncio.to_thread(spool.close)
+            result = _path(job["id"], ".gz")
+            os.replace(part, result)
+            job.update(status="done", progress=1.0, bytes=result.stat().st_size)
+        except _Cancelled:
+            job["status"] = "cancelled"
+        except asyncio.CancelledError:
+            job.update(status="failed", error="interrupted")
+            raise
+        except Exception as e:
+            logger.exception("error in report job", extra={"job": job["id"], "report": job["report"]})
+            job.update(status="failed", error=str(e))
+        finally:
+            if job["status"] != "done":
+                part.unlink(missing_ok=True)
+            _path(job["id"], ".cancel").unlink(missing_ok=True)
+            self._cancelled.discard(job["id"])
+            job["finishedAt"] = time.time()
+            _save(job)
+            self._running.pop(job["id"], None)
+            elapsed = time.monotonic() - started
+            metrics.JOBS_FINISHED.inc(job["report"], job["status"])
+            metrics.JOB_SECONDS.observe(elapsed, job["report"])
+            logger.info("report job finished", extra={
+                "job": job["id"], "report": job["report"], "status": job["status"],
+                "rows": job["rows"], "bytes": job["bytes"], "seconds": round(elapsed, 2),
+            })
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Rango (inicio, fin incluido) de una cabecera Range de un solo rango; None = fichero entero.
+
+    Un rango fuera del fichero es un 416; los que no se entienden (varios rangos,
+    otras unidades) se ignoran, como permite la RFC 9110.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416, detail="Rango no satisfacible", headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+async def _read(file: BinaryIO, start: int, end: int):
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await asyncio.to_thread(file.read, min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def result_response(job: dict, range_header: Optional[str], if_range: Optional[str]) -> StreamingResponse:
+    """Resultado comprimido de un trabajo terminado, entero o el rango de bytes pedido"""
+    try:
+        file = open(_path(job["id"], ".gz"), "rb")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="El resultado ha caducado")
+    size = os.fstat(file.fileno()).st_size
+    etag = f'"{job["id"]}-{size}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{job["report"]}-{job["id"][:8]}.{job["format"]}.gz"',
+    }
+    # If-Range: sólo se sirve el rango si el cliente tiene esta misma versión.
+    # El fichero ya está abierto (su tamaño es el del que se va a servir): se cierra con el 416
+    try:
+        byte_range = parse_range(range_header, size) if range_header and if_range in (None, etag) else None
+    except HTTPException:
+        file.close()
+        raise
+    start, end = byte_range or (0, size - 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    job["accessedAt"] = time.time()
+    _save(job)
+    return StreamingResponse(
+        _read(file, start, end), status_code=206 if byte_range else 200,
+        media_type="application/gzip", headers=headers,
+    )
+
+
+job_queue = JobQueue()
@@ -1,21 +1,79 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime, date
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import os
-from dotenv import load_dotenv
+from datetime import date, datetime
+
+import db
+import metrics
+from analytics import analytics_store, organism_volume, top_companies
+from cache import cached, response_cache
+from changes import CHANGE_TYPES, CHANGES_SQL, HEAD_SQL, MAX_BATCH_SIZE
+from graph import EDGE_TYPES, network_graph
+from normalize import normalize_name, normalize_nif
+from export import stream_export
+from jobs import FINISHED, JobQueueFull, job_out, job_queue, read_job, register_report, result_response
+from pagination import decode_cursor, next_cursor_headers, page_size
+from responses import (
+    CompressionMiddleware, ETagMiddleware, FastJSONResponse, columnar, columnar_from_dicts, json_response
+)
+from subscriptions import (
+    CREATE_SUBSCRIPTION_SQL, DELETE_SUBSCRIPTION_SQL, INBOX_SQL, SUBSCRIPTION_SQL, SUBSCRIPTIONS_SQL,
+    UPDATE_SUBSCRIPTION_SQL, match_broker, match_subscriptions, subscription_out, subscription_params
+)
+
+metrics.configure_logging()
+logger = logging.getLogger("licitamonitor")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.init_pool()
+    await match_broker.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await match_broker.stop()
+    await db.close_pool()
 
-load_dotenv(".env.local")
 
 app = FastAPI(
     title="Galicia Tender Intel API",
     description="API para gestión de licitaciones de Galicia",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
+# GET cuyo resultado sólo cambia con la marca de agua (o el día): admiten If-None-Match.
+# La analítica no: responde con la instantánea cargada, que se renueva después de la marca
+ETAG_ROUTES = {
+    "/api/tenders/active",
+    "/api/tenders/deserted",
+    "/api/market/organisms",
+    "/api/market/cpv",
+    "/api/trends",
+    "/api/competition/top",
+    "/api/competition/network",
+    "/api/dashboard/{view}",
+    "/api/adjudicatarios/search",
+    "/api/adjudicatarios/{adjudicatario_id}/tenders",
+}
+
+# Se añaden antes que CORS para quedar por dentro: el 304 y la compresión
+# también llevan las cabeceras CORS
+app.add_middleware(ETagMiddleware, routes=ETAG_ROUTES)
+app.add_middleware(CompressionMiddleware)
+
 # Configurar CORS
 app.add_middleware(
     CORSMiddleware,
@@ -23,20 +81,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
-# Configuración de base de datos
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST", "192.168.31.11"),
-    "port": os.getenv("DB_PORT", "5432"),
-    "database": os.getenv("DB_NAME", "licitaciones_espana"),
-    "user": os.getenv("DB_USER", "admin"),
-    "password": os.getenv("DB_PASSWORD", "admin")
-}
 
-def get_db_connection():
-    """Crear conexión a la base de datos"""
-    return psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Etiquetar por plantilla de ruta (/api/tenders/{tender_id}) y no por URL concreta
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, request.method, str(status))
 
 # Modelos
 class Tender(BaseModel):
@@ -48,18 +109,35 @@ class Tender(BaseModel):
     deadline: Optional[date] = None
     status: str = "open"
 
+class Subscription(BaseModel):
+    """Suscripción a licitaciones nuevas; los filtros vacíos no restringen"""
+    id: Optional[int] = None
+    name: str
+    email: Optional[str] = None
+    cpvs: List[str] = []                      # incluye los CPV descendientes
+    organisms: List[int] = []
+    provinces: List[str] = []
+    budget_min: Optional[float] = None
+    budget_max: Optional[float] = None
+    deadline_days_min: Optional[int] = None   # días para presentar ofertas
+    deadline_days_max: Optional[int] = None
+    active: bool = True
+    created_at: Optional[datetime] = None
+
+class JobRequest(BaseModel):
+    """Informe en segundo plano: report es uno de jobs.REPORTS y params sus filtros"""
+    report: str
+    params: dict = {}
+    format: str = "ndjson"
+
 # Endpoints
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Galicia Tender Intel API", "status": "running"}
 
-@app.get("/api/tenders/active")
-def get_active_tenders():
-    """Obtener licitaciones activas (abiertas y con plazo vigente)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+# Listados paginados por cursor: $1/$2 son la clave de la última fila de la página
+# anterior y el límite NULL se usa en las exportaciones completas
+ACTIVE_TENDERS_SQL = db.prepared("tenders_active", """
             SELECT 
                 l.id_licitacion as id,
                 l.objeto_contrato as title,
@@ -68,96 +146,127 @@ def get_active_tenders():
                 COALESCE(l.presupuesto_base_con_iva, l.presupuesto_base_sin_iva, l.valor_estimado, 0) as budget,
                 l.fecha_limite_ofertas as deadline,
                 COALESCE(l.estado, 'open') as status,
-                l.url_expediente as url
+                l.url_expediente as url,
+                e.importe_estimado::FLOAT as "estimatedAward",
+                e.importe_min::FLOAT as "estimatedAwardMin",
+                e.importe_max::FLOAT as "estimatedAwardMax",
+                e.baja_p50::FLOAT as "expectedDiscount",
+                e.baja_p25::FLOAT as "discountP25",
+                e.baja_p75::FLOAT as "discountP75",
+                e.muestras as "estimateSamples",
+                e.nivel as "estimateBasis"
             FROM dw.fact_licitacion l
             INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
+            LEFT JOIN dw.estimacion_licitacion e ON e.id_licitacion = l.id_licitacion
             WHERE l.fecha_limite_ofertas IS NOT NULL
               AND l.fecha_limite_ofertas >= CURRENT_DATE
-            ORDER BY l.fecha_limite_ofertas ASC
-            LIMIT 100
-        """)
-        tenders = cursor.fetchall()
-        print(f"Active tenders found: {len(tenders)}")
-        return tenders
+              AND ($1::date IS NULL OR (l.fecha_limite_ofertas, l.id_licitacion) > ($1::date, $2::bigint))
+              AND ($3::text IS NULL OR o.comunidad_autonoma = $3)
+              AND ($4::text IS NULL OR o.provincia = $4)
+            ORDER BY l.fecha_limite_ofertas ASC, l.id_licitacion ASC
+            LIMIT $5
+        """, replica=True)
+
+@app.get("/api/tenders/active")
+async def get_active_tenders(
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    comunidad_autonoma: Optional[str] = None,
+    provincia: Optional[str] = None,
+    format: str = "json"
+):
+    """Obtener licitaciones activas (abiertas y con plazo vigente)
+
+    Incluye el importe de adjudicación estimado y el rango de baja esperado, precalculados
+    tras cada carga (estimates.py); son null si no hay historial con el que estimarlos.
+
+    Paginado por cursor: la cabecera X-Next-Cursor trae el cursor de la página siguiente.
+    Con format=columns se devuelve {columns, rows} con cada fila como array;
+    con format=ndjson|csv se exportan todas las filas en streaming.
+    """
+    if format not in ("json", "columns"):
+        return stream_export(
+            ACTIVE_TENDERS_SQL, (None, None, comunidad_autonoma, provincia, None), format, "licitaciones_activas"
+        )
+    deadline, last_id = decode_cursor(cursor, date, int)
+    limit = page_size(limit)
+    args = (deadline, last_id, comunidad_autonoma, provincia, limit)
+    try:
+        if format == "columns":
+            columns, rows = await db.fetch_columns(ACTIVE_TENDERS_SQL, *args)
+            headers = next_cursor_headers(rows, limit, "deadline", "id", columns=columns)
+            return json_response(columnar(columns, rows), headers)
+        tenders = await db.fetch(ACTIVE_TENDERS_SQL, *args)
+        logger.debug("active tenders", extra={"rows": len(tenders)})
+        return json_response(tenders, next_cursor_headers(tenders, limit, "deadline", "id"))
     except Exception as e:
-        print(f"Error in active tenders: {str(e)}")
+        logger.exception("error in active tenders")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
 
-@app.get("/api/tenders/deserted")
-def get_deserted_tenders():
-    """Obtener licitaciones desiertas o sin adjudicar"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+# Lee la clasificación precalculada en dw.licitacion_resultado (refresh.py)
+DESERTED_TENDERS_SQL = db.prepared("tenders_deserted", """
             SELECT 
                 l.id_licitacion as id,
                 l.objeto_contrato as title,
                 COALESCE(l.tipo_contrato, 'Sin tipo') as description,
                 o.nombre as organism,
                 COALESCE(l.presupuesto_base_con_iva, l.presupuesto_base_sin_iva, l.valor_estimado, 0) as budget,
-                l.fecha_limite_ofertas as deadline,
-                TO_CHAR(l.fecha_limite_ofertas, 'DD/MM/YYYY') as date,
+                lr.fecha_limite_ofertas as deadline,
+                TO_CHAR(lr.fecha_limite_ofertas, 'DD/MM/YYYY') as date,
                 COALESCE(l.estado, 'Desierta') as status,
                 l.num_licitadores_total,
-                CASE 
-                    WHEN l.estado ILIKE '%Anulad%' THEN 'Anulada'
-                    WHEN l.estado ILIKE '%Desestim%' THEN 'Desestimada'
-                    WHEN l.estado ILIKE '%Desiert%' THEN 'Declarada desierta'
-                    WHEN l.num_licitadores_total = 0 THEN 'Sin ofertas presentadas'
-                    WHEN EXISTS (
-                        SELECT 1 FROM dw.fact_lote lot
-                        INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                        WHERE lot.id_licitacion = l.id_licitacion 
-                          AND r.resultado ILIKE '%desiert%'
-                        LIMIT 1
-                    ) THEN 'Desierta'
-                    WHEN EXISTS (
-                        SELECT 1 FROM dw.fact_lote lot
-                        INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                        WHERE lot.id_licitacion = l.id_licitacion 
-                          AND r.resultado ILIKE '%inadmit%'
-                        LIMIT 1
-                    ) THEN 'Ofertas inadmitidas'
-                    ELSE 'Sin adjudicar'
-                END as reason,
+                lr.resultado as reason,
                 COALESCE(o.telefono_contacto, 'N/A') as phone,
                 COALESCE(o.email_contacto, 'N/A') as email,
                 l.url_expediente as url
-            FROM dw.fact_licitacion l
+            FROM dw.licitacion_resultado lr
+            INNER JOIN dw.fact_licitacion l ON lr.id_licitacion = l.id_licitacion
             INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
-            LEFT JOIN dw.fact_lote lot ON lot.id_licitacion = l.id_licitacion
-            LEFT JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote AND r.es_exito = true
-            WHERE r.id_resultado_lote IS NULL
-              AND l.fecha_limite_ofertas < CURRENT_DATE
-              AND l.fecha_limite_ofertas >= CURRENT_DATE - INTERVAL '90 days'
-            GROUP BY l.id_licitacion, o.nombre, o.telefono_contacto, o.email_contacto
-            ORDER BY l.fecha_limite_ofertas DESC
-            LIMIT 100
-        """)
-        tenders = cursor.fetchall()
-        print(f"Deserted tenders found: {len(tenders)}")
-        if len(tenders) > 0:
-            print(f"First deserted tender: {tenders[0]}")
-            print(f"Estado: {tenders[0]['status']}, Num licitadores: {tenders[0]['num_licitadores_total']}")
-        return tenders
+            WHERE NOT lr.adjudicada
+              AND lr.fecha_limite_ofertas < CURRENT_DATE
+              AND lr.fecha_limite_ofertas >= CURRENT_DATE - INTERVAL '90 days'
+              AND ($1::date IS NULL OR (lr.fecha_limite_ofertas, lr.id_licitacion) < ($1::date, $2::bigint))
+              AND ($3::text IS NULL OR o.comunidad_autonoma = $3)
+              AND ($4::text IS NULL OR o.provincia = $4)
+            ORDER BY lr.fecha_limite_ofertas DESC, lr.id_licitacion DESC
+            LIMIT $5
+        """, replica=True)
+
+@cached("tenders_deserted")
+async def fetch_deserted_tenders(
+    deadline: Optional[date],
+    last_id: Optional[int],
+    comunidad_autonoma: Optional[str],
+    provincia: Optional[str],
+    limit: int
+):
+    return await db.fetch(DESERTED_TENDERS_SQL, deadline, last_id, comunidad_autonoma, provincia, limit)
+
+@app.get("/api/tenders/deserted")
+async def get_deserted_tenders(
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    comunidad_autonoma: Optional[str] = None,
+    provincia: Optional[str] = None,
+    format: str = "json"
+):
+    """Obtener licitaciones desiertas o sin adjudicar (format=columns: filas como arrays)"""
+    if format not in ("json", "columns"):
+        return stream_export(
+            DESERTED_TENDERS_SQL, (None, None, comunidad_autonoma, provincia, None), format, "licitaciones_desiertas"
+        )
+    deadline, last_id = decode_cursor(cursor, date, int)
+    limit = page_size(limit)
+    try:
+        tenders = await fetch_deserted_tenders(deadline, last_id, comunidad_autonoma, provincia, limit)
+        logger.debug("deserted tenders", extra={"rows": len(tenders)})
+        headers = next_cursor_headers(tenders, limit, "deadline", "id")
+        return json_response(columnar_from_dicts(tenders) if format == "columns" else tenders, headers)
     except Exception as e:
-        print(f"Error in deserted tenders: {str(e)}")
+        logger.exception("error in deserted tenders")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
-
-@app.get("/api/tenders", response_model=List[Tender])
-def get_tenders():
-    """Obtener todas las licitaciones"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+
+TENDERS_SQL = db.prepared("tenders_list", """
             SELECT 
                 l.id_licitacion as id,
                 l.objeto_contrato as title,
@@ -168,105 +277,107 @@ def get_tenders():
                 l.estado as status
             FROM dw.fact_licitacion l
             INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
+            WHERE ($1::bigint IS NULL OR l.id_licitacion < $1)
+              AND ($2::text IS NULL OR o.comunidad_autonoma = $2)
+              AND ($3::text IS NULL OR o.provincia = $3)
+              AND ($4::int IS NULL OR (
+                    l.fecha_publicacion >= make_date($4, 1, 1)
+                    AND l.fecha_publicacion < make_date($4 + 1, 1, 1)
+              ))
             ORDER BY l.id_licitacion DESC
-            LIMIT 100
-        """)
-        tenders = cursor.fetchall()
-        return tenders
+            LIMIT $5
+        """, replica=True)
+
+# El listado completo también como informe en segundo plano (jobs.py)
+register_report("licitaciones", TENDERS_SQL, lambda params: (
+    None, params.get("comunidad_autonoma"), params.get("provincia"),
+    int(params["anio"]) if params.get("anio") else None, None
+))
+
+@app.get("/api/tenders")
+async def get_tenders(
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    comunidad_autonoma: Optional[str] = None,
+    provincia: Optional[str] = None,
+    anio: Optional[int] = None,
+    format: str = "json"
+):
+    """Obtener todas las licitaciones (anio filtra por año de publicación; format=columns: filas como arrays)"""
+    if format not in ("json", "columns"):
+        return stream_export(TENDERS_SQL, (None, comunidad_autonoma, provincia, anio, None), format, "licitaciones")
+    (last_id,) = decode_cursor(cursor, int)
+    limit = page_size(limit)
+    args = (last_id, comunidad_autonoma, provincia, anio, limit)
+    try:
+        if format == "columns":
+            columns, rows = await db.fetch_columns(TENDERS_SQL, *args)
+            return json_response(columnar(columns, rows), next_cursor_headers(rows, limit, "id", columns=columns))
+        tenders = await db.fetch(TENDERS_SQL, *args)
+        return json_response(tenders, next_cursor_headers(tenders, limit, "id"))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+TENDER_SQL = db.prepared("tender_get", "SELECT * FROM tenders WHERE id = $1")
 
 @app.get("/api/tenders/{tender_id}", response_model=Tender)
-def get_tender(tender_id: int):
+async def get_tender(tender_id: int):
     """Obtener una licitación específica"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM tenders WHERE id = %s", (tender_id,))
-        tender = cursor.fetchone()
-        if not tender:
-            raise HTTPException(status_code=404, detail="Licitación no encontrada")
-        return tender
-    finally:
-        cursor.close()
-        conn.close()
+    tender = await db.fetchrow(TENDER_SQL, tender_id)
+    if not tender:
+        raise HTTPException(status_code=404, detail="Licitación no encontrada")
+    return tender
+
+CREATE_TENDER_SQL = db.prepared("tender_create", """INSERT INTO tenders (title, description, organization, budget, deadline, status) 
+               VALUES ($1, $2, $3, $4, $5, $6) RETURNING *""")
 
 @app.post("/api/tenders", response_model=Tender, status_code=201)
-def create_tender(tender: Tender):
+async def create_tender(tender: Tender):
     """Crear una nueva licitación"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """INSERT INTO tenders (title, description, organization, budget, deadline, status) 
-               VALUES (%s, %s, %s, %s, %s, %s) RETURNING *""",
-            (tender.title, tender.description, tender.organization, 
-             tender.budget, tender.deadline, tender.status)
+        new_tender = await db.fetchrow(
+            CREATE_TENDER_SQL,
+            tender.title, tender.description, tender.organization,
+            tender.budget, tender.deadline, tender.status
         )
-        new_tender = cursor.fetchone()
-        conn.commit()
         return new_tender
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+UPDATE_TENDER_SQL = db.prepared("tender_update", """UPDATE tenders 
+               SET title=$1, description=$2, organization=$3, budget=$4, deadline=$5, status=$6
+               WHERE id=$7 RETURNING *""")
 
 @app.put("/api/tenders/{tender_id}", response_model=Tender)
-def update_tender(tender_id: int, tender: Tender):
+async def update_tender(tender_id: int, tender: Tender):
     """Actualizar una licitación existente"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """UPDATE tenders 
-               SET title=%s, description=%s, organization=%s, budget=%s, deadline=%s, status=%s
-               WHERE id=%s RETURNING *""",
-            (tender.title, tender.description, tender.organization,
-             tender.budget, tender.deadline, tender.status, tender_id)
+        updated_tender = await db.fetchrow(
+            UPDATE_TENDER_SQL,
+            tender.title, tender.description, tender.organization,
+            tender.budget, tender.deadline, tender.status, tender_id
         )
-        updated_tender = cursor.fetchone()
-        if not updated_tender:
-            raise HTTPException(status_code=404, detail="Licitación no encontrada")
-        conn.commit()
-        return updated_tender
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+    if not updated_tender:
+        raise HTTPException(status_code=404, detail="Licitación no encontrada")
+    return updated_tender
+
+DELETE_TENDER_SQL = db.prepared("tender_delete", "DELETE FROM tenders WHERE id = $1 RETURNING id")
 
 @app.delete("/api/tenders/{tender_id}")
-def delete_tender(tender_id: int):
+async def delete_tender(tender_id: int):
     """Eliminar una licitación"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("DELETE FROM tenders WHERE id = %s RETURNING id", (tender_id,))
-        deleted = cursor.fetchone()
-        if not deleted:
-            raise HTTPException(status_code=404, detail="Licitación no encontrada")
-        conn.commit()
-        return {"message": "Licitación eliminada"}
+        deleted = await db.fetchrow(DELETE_TENDER_SQL, tender_id)
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Licitación no encontrada")
+    return {"message": "Licitación eliminada"}
 
-@app.get("/api/market/organisms")
-def get_organisms():
-    """Obtener KPIs de organismos"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+# Lee de dw.agg_organo_mes, mantenida por refresh.py tras cada carga
+ORGANISMS_SQL = db.prepared("market_organisms", """
             WITH organism_stats AS (
                 SELECT 
                     o.id_organo,
@@ -274,78 +385,241 @@ def get_organisms():
                     o.nombre,
                     o.tipo_administracion,
                     o.comunidad_autonoma,
-                    COUNT(DISTINCT l.id_licitacion) as total_licitaciones,
-                    COUNT(DISTINCT CASE 
-                        WHEN EXISTS (
-                            SELECT 1 FROM dw.fact_lote lot
-                            INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                            WHERE lot.id_licitacion = l.id_licitacion AND r.es_exito = true
-                        ) THEN l.id_licitacion 
-                    END) as licitaciones_adjudicadas,
-                    COALESCE(SUM(l.presupuesto_base_con_iva), 0) as presupuesto_total,
-                    COALESCE(AVG(l.presupuesto_base_con_iva), 0) as presupuesto_medio,
-                    AVG(
-                        CASE 
-                            WHEN l.presupuesto_base_con_iva > 0 AND EXISTS (
-                                SELECT 1 FROM dw.fact_lote lot
-                                INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                                WHERE lot.id_licitacion = l.id_licitacion 
-                                  AND r.es_exito = true
-                                  AND r.importe_adjudicacion_con_iva IS NOT NULL
-                                  AND r.importe_adjudicacion_con_iva > 0
-                            ) THEN (
-                                SELECT 
-                                    ((l.presupuesto_base_con_iva - MIN(r.importe_adjudicacion_con_iva)) / l.presupuesto_base_con_iva * 100)
-                                FROM dw.fact_lote lot
-                                INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                                WHERE lot.id_licitacion = l.id_licitacion AND r.es_exito = true
-                            )
-                            ELSE NULL
-                        END
-                    ) as baja_media
-                FROM dw.dim_organo o
-                LEFT JOIN dw.fact_licitacion l ON o.id_organo = l.id_organo
+                    SUM(k.total_licitaciones) as total_licitaciones,
+                    SUM(k.licitaciones_adjudicadas) as licitaciones_adjudicadas,
+                    SUM(k.presupuesto_total) as presupuesto_total,
+                    SUM(k.presupuesto_num) as presupuesto_num,
+                    SUM(k.baja_suma) as baja_suma,
+                    SUM(k.baja_suma_cuadrados) as baja_suma_cuadrados,
+                    SUM(k.baja_num) as baja_num,
+                    MIN(k.baja_min) as baja_min,
+                    MAX(k.baja_max) as baja_max
+                FROM dw.agg_organo_mes k
+                INNER JOIN dw.dim_organo o ON k.id_organo = o.id_organo
+                WHERE ($1::text IS NULL OR o.comunidad_autonoma = $1)
+                  AND ($2::text IS NULL OR o.tipo_administracion = $2)
+                  AND ($3::date IS NULL OR k.mes >= date_trunc('month', $3::date))
+                  AND ($4::date IS NULL OR k.mes <= $4::date)
                 GROUP BY o.id_organo, o.nif, o.nombre, o.tipo_administracion, o.comunidad_autonoma
-                HAVING COUNT(l.id_licitacion) > 0
+                HAVING SUM(k.total_licitaciones) > 0
             )
             SELECT 
                 COALESCE(nif, SUBSTRING(nombre, 1, 20)) as name,
                 nombre as "fullName",
                 COALESCE(tipo_administracion, 'N/A') as tipo_administracion,
                 COALESCE(comunidad_autonoma, 'N/A') as comunidad_autonoma,
-                total_licitaciones as "totalTenders",
+                total_licitaciones::INTEGER as "totalTenders",
                 presupuesto_total::FLOAT as "totalVolume",
-                presupuesto_medio::FLOAT as "avgBudget",
                 CASE 
-                    WHEN total_licitaciones > 0 
-                    THEN ROUND((licitaciones_adjudicadas::NUMERIC / total_licitaciones::NUMERIC * 100), 1)::FLOAT
-                    ELSE 0 
-                END as "successRate",
-                COALESCE(ROUND(baja_media::NUMERIC, 2)::FLOAT, 0) as "avgDiscount"
+                    WHEN presupuesto_num > 0 THEN (presupuesto_total / presupuesto_num)::FLOAT
+                    ELSE 0
+                END as "avgBudget",
+                ROUND((licitaciones_adjudicadas::NUMERIC / total_licitaciones::NUMERIC * 100), 1)::FLOAT as "successRate",
+                CASE 
+                    WHEN baja_num > 0 THEN ROUND(baja_suma / baja_num, 2)::FLOAT
+                    ELSE 0
+                END as "avgDiscount",
+                CASE 
+                    WHEN baja_num > 1
+                    THEN ROUND(SQRT(GREATEST((baja_suma_cuadrados - baja_suma * baja_suma / baja_num) / (baja_num - 1), 0)), 2)::FLOAT
+                END as "discountStdDev",
+                ROUND(baja_min, 2)::FLOAT as "minDiscount",
+                ROUND(baja_max, 2)::FLOAT as "maxDiscount"
             FROM organism_stats
             WHERE presupuesto_total > 0
             ORDER BY presupuesto_total DESC
-            LIMIT 20
-        """)
-        organisms = cursor.fetchall()
-        print(f"Organisms found: {len(organisms)}")
-        if len(organisms) > 0:
-            print(f"First organism: {organisms[0]}")
+            LIMIT $5
+        """, heavy=True, replica=True)
+
+@cached("market_organisms")
+async def fetch_organisms(
+    comunidad_autonoma: Optional[str] = None,
+    tipo_administracion: Optional[str] = None,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    limit: int = 20
+):
+    try:
+        organisms = await db.fetch(
+            ORGANISMS_SQL, comunidad_autonoma, tipo_administracion, desde, hasta, min(limit, 500)
+        )
+        logger.debug("organisms", extra={"rows": len(organisms)})
         return organisms
     except Exception as e:
-        print(f"Error in organisms: {str(e)}")
+        logger.exception("error in organisms")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
 
-@app.get("/api/competition/top")
-def get_top_competitors():
-    """Obtener competidores principales (empresas con más adjudicaciones)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.get("/api/market/organisms")
+async def get_organisms(
+    comunidad_autonoma: Optional[str] = None,
+    tipo_administracion: Optional[str] = None,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    limit: int = 20
+):
+    """Obtener KPIs de organismos (el rango de fechas se aplica por mes de publicación)"""
+    return json_response(await fetch_organisms(comunidad_autonoma, tipo_administracion, desde, hasta, limit))
+
+# Lee de dw.agg_cpv (totales acumulados por nivel de la jerarquía, refresh.py)
+_CPV_INDICATORS = """
+                c.codigo_cpv as code,
+                c.descripcion as description,
+                c.nivel as level,
+                COALESCE(a.total_licitaciones, 0) as "totalTenders",
+                COALESCE(a.num_lotes, 0) as lots,
+                ROUND(a.presupuesto_suma / NULLIF(a.presupuesto_num, 0), 2)::FLOAT as "avgBudget",
+                ROUND(a.baja_suma / NULLIF(a.baja_num, 0), 2)::FLOAT as "avgDiscount",
+                ROUND(a.licitadores_suma::NUMERIC / NULLIF(a.licitadores_num, 0), 1)::FLOAT as "avgBidders"
+"""
+
+CPV_CHILDREN_SQL = db.prepared("market_cpv", f"""
+            SELECT {_CPV_INDICATORS},
+                EXISTS (SELECT 1 FROM dw.dim_cpv h WHERE h.codigo_padre = c.codigo_cpv) as "hasChildren"
+            FROM dw.dim_cpv c
+            INNER JOIN dw.agg_cpv a ON a.codigo_cpv = c.codigo_cpv
+            WHERE (($1::varchar IS NULL AND c.codigo_padre IS NULL) OR c.codigo_padre = $1)
+              AND a.total_licitaciones >= GREATEST($2, 1)
+            ORDER BY a.total_licitaciones DESC, c.codigo_cpv
+            LIMIT $3
+        """, replica=True)
+
+# Camino desde la raíz hasta el código (incluido), con sus indicadores
+CPV_PATH_SQL = db.prepared("market_cpv_path", f"""
+            SELECT {_CPV_INDICATORS}
+            FROM dw.cpv_antecesor p
+            INNER JOIN dw.dim_cpv c ON c.codigo_cpv = p.codigo_antecesor
+            LEFT JOIN dw.agg_cpv a ON a.codigo_cpv = c.codigo_cpv
+            WHERE p.codigo_cpv = $1
+            ORDER BY p.distancia DESC
+        """, replica=True)
+
+@cached("market_cpv")
+async def fetch_cpv_indicators(parent: Optional[str] = None, min_tenders: int = 1, limit: int = 100):
+    try:
+        path = await db.fetch(CPV_PATH_SQL, parent) if parent is not None else []
+        children = await db.fetch(CPV_CHILDREN_SQL, parent, min_tenders, min(limit, 1000))
+    except Exception as e:
+        logger.exception("error in cpv indicators")
+        raise HTTPException(status_code=500, detail=str(e))
+    if parent is not None and not path:
+        raise HTTPException(status_code=404, detail="Código CPV no encontrado")
+    logger.debug("cpv indicators", extra={"parent": parent, "rows": len(children)})
+    return {"path": path, "children": children}
+
+@app.get("/api/market/cpv")
+async def get_cpv_indicators(
+    parent: Optional[str] = None,
+    min_tenders: int = 1,
+    limit: int = 100
+):
+    """Obtener indicadores sectoriales por CPV con navegación por la jerarquía
+
+    Sin parent devuelve los códigos raíz (divisiones); con parent, sus hijos directos.
+    path es el camino desde la raíz hasta parent, con sus propios indicadores.
+    """
+    return json_response(await fetch_cpv_indicators(parent, min_tenders, limit))
+
+# Lee del cubo dw.agg_tendencia_mes (refresh.py). Cada dimensión sólo entra en la
+# agrupación si su parámetro es true, así una única sentencia resuelve cualquier subconjunto.
+TRENDS_SQL = db.prepared("trends", """
+            WITH cubo AS (
+                SELECT
+                    date_trunc($1, mes)::date as periodo,
+                    CASE WHEN $2 THEN id_organo END as id_organo,
+                    CASE WHEN $3 THEN division_cpv END as division_cpv,
+                    CASE WHEN $4 THEN tipo_contrato END as tipo_contrato,
+                    SUM(total_licitaciones) as total_licitaciones,
+                    SUM(presupuesto_total) as presupuesto_total,
+                    SUM(adjudicado_total) as adjudicado_total,
+                    SUM(licitaciones_adjudicadas) as licitaciones_adjudicadas,
+                    SUM(baja_suma) as baja_suma,
+                    SUM(baja_num) as baja_num,
+                    SUM(licitadores_suma) as licitadores_suma,
+                    SUM(licitadores_num) as licitadores_num
+                FROM dw.agg_tendencia_mes
+                WHERE ($5::date IS NULL OR mes >= date_trunc('month', $5::date))
+                  AND ($6::date IS NULL OR mes <= $6::date)
+                  AND ($7::bigint IS NULL OR id_organo = $7)
+                  AND ($8::varchar IS NULL OR division_cpv = $8)
+                  AND ($9::varchar IS NULL OR tipo_contrato = $9)
+                GROUP BY 1, 2, 3, 4
+            )
+            SELECT
+                c.periodo as period,
+                c.id_organo as "organismId",
+                o.nombre as organism,
+                c.division_cpv as "cpvDivision",
+                cpv.descripcion as "cpvDescription",
+                c.tipo_contrato as "contractType",
+                c.total_licitaciones::INTEGER as tenders,
+                c.presupuesto_total::FLOAT as budget,
+                c.adjudicado_total::FLOAT as awarded,
+                c.licitaciones_adjudicadas::INTEGER as "awardedTenders",
+                ROUND(c.baja_suma / NULLIF(c.baja_num, 0), 2)::FLOAT as "avgDiscount",
+                c.licitadores_suma::INTEGER as bidders,
+                ROUND(c.licitadores_suma::NUMERIC / NULLIF(c.licitadores_num, 0), 1)::FLOAT as "avgBidders"
+            FROM cubo c
+            LEFT JOIN dw.dim_organo o ON o.id_organo = c.id_organo
+            LEFT JOIN dw.dim_cpv cpv ON cpv.codigo_cpv = c.division_cpv
+            ORDER BY c.periodo, c.presupuesto_total DESC
+            LIMIT $10
+        """, replica=True)
+
+TREND_GRANULARITIES = {"mes": "month", "trimestre": "quarter", "anio": "year"}
+TREND_DIMENSIONS = ("organismo", "cpv", "tipo_contrato")
+
+@cached("trends")
+async def fetch_trends(
+    group_by: str = "",
+    granularity: str = "mes",
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    organismo: Optional[int] = None,
+    cpv: Optional[str] = None,
+    tipo_contrato: Optional[str] = None,
+    limit: int = 5000
+):
+    dimensions = {dimension for dimension in group_by.split(",") if dimension}
+    if not dimensions <= set(TREND_DIMENSIONS):
+        raise HTTPException(status_code=400, detail=f"group_by admite: {', '.join(TREND_DIMENSIONS)}")
+    if granularity not in TREND_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity debe ser una de: {', '.join(TREND_GRANULARITIES)}")
+    # El cubo guarda la división (dos primeros dígitos) del CPV principal
+    division = cpv[:2].ljust(8, "0") if cpv else None
     try:
-        cursor.execute("""
+        trends = await db.fetch(
+            TRENDS_SQL, TREND_GRANULARITIES[granularity],
+            *(dimension in dimensions for dimension in TREND_DIMENSIONS),
+            desde, hasta, organismo, division, tipo_contrato, min(limit, 50000)
+        )
+        logger.debug("trends", extra={"group_by": group_by, "rows": len(trends)})
+        return trends
+    except Exception as e:
+        logger.exception("error in trends")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/trends")
+async def get_trends(
+    group_by: str = "",
+    granularity: str = "mes",
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    organismo: Optional[int] = None,
+    cpv: Optional[str] = None,
+    tipo_contrato: Optional[str] = None,
+    limit: int = 5000
+):
+    """Series temporales de licitaciones, presupuesto, importe adjudicado, baja media y licitadores
+
+    - group_by: dimensiones separadas por comas (organismo, cpv, tipo_contrato); vacío = total
+    - granularity: mes, trimestre o anio
+    - cpv filtra por la división del CPV principal (se usan sus dos primeros dígitos)
+    """
+    return json_response(await fetch_trends(
+        group_by, granularity, desde, hasta, organismo, cpv, tipo_contrato, limit
+    ))
+
+TOP_COMPETITORS_SQL = db.prepared("competition_top", """
             SELECT 
                 a.nombre as name,
                 COALESCE(a.es_pyme, false) as "isPyme",
@@ -362,224 +636,561 @@ def get_top_competitors():
             HAVING COUNT(DISTINCT r.id_resultado_lote) > 0
             ORDER BY "totalAmount" DESC
             LIMIT 20
-        """)
-        competitors = cursor.fetchall()
-        print(f"Competitors found: {len(competitors)}")
-        if len(competitors) > 0:
-            print(f"First competitor: {competitors[0]}")
+        """, heavy=True, replica=True)
+
+# Igual que TOP_COMPETITORS_SQL sumando las empresas de cada grupo empresarial (entities.py);
+# se agrega primero por empresa (índice parcial de resultados con éxito) y después por grupo.
+# El nombre y la provincia son los de la empresa del grupo con más adjudicaciones
+TOP_COMPETITOR_GROUPS_SQL = db.prepared("competition_top_groups", """
+            WITH empresa AS (
+                SELECT
+                    r.id_adjudicatario,
+                    COUNT(*) as wins,
+                    SUM(r.importe_adjudicacion_con_iva) as total
+                FROM dw.fact_resultado_lote r
+                WHERE r.es_exito = true
+                  AND r.importe_adjudicacion_con_iva IS NOT NULL
+                  AND r.importe_adjudicacion_con_iva > 0
+                GROUP BY r.id_adjudicatario
+            )
+            SELECT
+                (array_agg(a.nombre ORDER BY e.wins DESC, a.id_adjudicatario))[1] as name,
+                bool_and(COALESCE(a.es_pyme, false)) as "isPyme",
+                COALESCE((array_agg(a.provincia ORDER BY e.wins DESC, a.id_adjudicatario))[1], 'N/A') as location,
+                SUM(e.wins)::bigint as wins,
+                COALESCE(SUM(e.total), 0)::FLOAT as "totalAmount",
+                COALESCE(SUM(e.total) / SUM(e.wins), 0)::FLOAT as "avgBid",
+                COALESCE(a.id_grupo_empresarial, a.id_adjudicatario) as "groupId",
+                COUNT(*) as members
+            FROM empresa e
+            INNER JOIN dw.dim_adjudicatario a ON a.id_adjudicatario = e.id_adjudicatario
+            GROUP BY COALESCE(a.id_grupo_empresarial, a.id_adjudicatario)
+            ORDER BY "totalAmount" DESC
+            LIMIT 20
+        """, heavy=True, replica=True)
+
+COMPETITOR_GROUPINGS = ("empresa", "grupo")
+
+@cached("competition_top")
+async def fetch_top_competitors(agrupar: str = "empresa"):
+    if agrupar not in COMPETITOR_GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"agrupar debe ser uno de: {', '.join(COMPETITOR_GROUPINGS)}")
+    try:
+        competitors = await db.fetch(TOP_COMPETITOR_GROUPS_SQL if agrupar == "grupo" else TOP_COMPETITORS_SQL)
+        logger.debug("competitors", extra={"rows": len(competitors)})
         return competitors
     except Exception as e:
-        print(f"Error in competitors: {str(e)}")
+        logger.exception("error in competitors")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
 
-@app.get("/api/competition/network")
-def get_competition_network():
-    """Obtener red de competencia (empresas que compiten frecuentemente)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.get("/api/competition/top")
+async def get_top_competitors(agrupar: str = "empresa"):
+    """Obtener competidores principales (empresas con más adjudicaciones)
+
+    - agrupar: "empresa" o "grupo" (suma las filas de la misma empresa, ver entities.py)
+    """
+    return json_response(await fetch_top_competitors(agrupar))
+
+@cached("competition_network")
+async def fetch_competition_network(
+    top: int = 30,
+    min_weight: int = 2,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    centro: Optional[int] = None,
+    tipo: str = "competencia",
+    max_links: int = 50,
+    agrupar: str = "empresa"
+):
+    if tipo not in EDGE_TYPES:
+        raise HTTPException(status_code=400, detail=f"tipo debe ser uno de: {', '.join(EDGE_TYPES)}")
+    if agrupar not in COMPETITOR_GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"agrupar debe ser uno de: {', '.join(COMPETITOR_GROUPINGS)}")
     try:
-        # Obtener nodos (empresas con adjudicaciones)
-        cursor.execute("""
-            WITH top_companies AS (
-                SELECT 
-                    a.id_adjudicatario,
-                    a.nombre,
-                    COUNT(DISTINCT r.id_resultado_lote) as wins,
-                    COALESCE(a.es_pyme, false) as es_pyme,
-                    COALESCE(SUM(r.importe_adjudicacion_con_iva), 0) as total_amount
-                FROM dw.dim_adjudicatario a
-                INNER JOIN dw.fact_resultado_lote r ON a.id_adjudicatario = r.id_adjudicatario
-                WHERE r.es_exito = true
-                GROUP BY a.id_adjudicatario, a.nombre, a.es_pyme
-                HAVING COUNT(DISTINCT r.id_resultado_lote) >= 1
-                ORDER BY wins DESC
-                LIMIT 30
-            )
-            SELECT 
-                nombre as id,
-                nombre as name,
-                wins,
-                es_pyme as "isPyme",
-                total_amount as "totalAmount"
-            FROM top_companies
-        """)
-        nodes = cursor.fetchall()
-        
-        print(f"Network nodes found: {len(nodes)}")
-        
-        if len(nodes) == 0:
-            return {"nodes": [], "links": []}
-        
-        # Crear lista de nombres de nodos para filtrar enlaces
-        node_names = [node['name'] for node in nodes]
-        
-        # Crear enlaces basados en competencia (empresas que ganan lotes de la misma licitación)
-        # Excluimos licitaciones con muchos adjudicatarios (marcos de acuerdo) para evitar distorsiones
-        print("Creating links based on common tenders")
-        cursor.execute("""
-            WITH top_companies AS (
-                SELECT 
-                    a.id_adjudicatario,
-                    a.nombre
-                FROM dw.dim_adjudicatario a
-                INNER JOIN dw.fact_resultado_lote r ON a.id_adjudicatario = r.id_adjudicatario
-                WHERE r.es_exito = true
-                GROUP BY a.id_adjudicatario, a.nombre
-                HAVING COUNT(DISTINCT r.id_resultado_lote) >= 1
-                ORDER BY COUNT(DISTINCT r.id_resultado_lote) DESC
-                LIMIT 30
-            ),
-            licitaciones_validas AS (
-                -- Excluir licitaciones con más de 3 adjudicatarios diferentes (marcos de acuerdo)
-                SELECT lot.id_licitacion
-                FROM dw.fact_lote lot
-                INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
-                WHERE r.es_exito = true
-                GROUP BY lot.id_licitacion
-                HAVING COUNT(DISTINCT r.id_adjudicatario) <= 3
-            )
-            SELECT 
-                a1.nombre as source,
-                a2.nombre as target,
-                COUNT(DISTINCT lot1.id_licitacion) as value
-            FROM dw.fact_resultado_lote r1
-            INNER JOIN dw.fact_lote lot1 ON r1.id_lote = lot1.id_lote
-            INNER JOIN licitaciones_validas lv ON lot1.id_licitacion = lv.id_licitacion
-            INNER JOIN dw.dim_adjudicatario a1 ON r1.id_adjudicatario = a1.id_adjudicatario
-            INNER JOIN dw.fact_lote lot2 ON lot1.id_licitacion = lot2.id_licitacion
-            INNER JOIN dw.fact_resultado_lote r2 ON lot2.id_lote = r2.id_lote
-            INNER JOIN dw.dim_adjudicatario a2 ON r2.id_adjudicatario = a2.id_adjudicatario
-            INNER JOIN top_companies tc1 ON a1.id_adjudicatario = tc1.id_adjudicatario
-            INNER JOIN top_companies tc2 ON a2.id_adjudicatario = tc2.id_adjudicatario
-            WHERE r1.id_adjudicatario < r2.id_adjudicatario
-              AND r1.es_exito = true
-              AND r2.es_exito = true
-            GROUP BY a1.nombre, a2.nombre
-            HAVING COUNT(DISTINCT lot1.id_licitacion) >= 2
-            ORDER BY value DESC
-            LIMIT 50
-        """)
-        links = cursor.fetchall()
-        
-        # Filtrar enlaces adicionales en Python por seguridad
-        filtered_links = [
-            link for link in links 
-            if link['source'] in node_names and link['target'] in node_names
-        ]
-        
-        print(f"Network links found: {len(filtered_links)}")
-        
-        return {"nodes": nodes, "links": filtered_links}
+        await network_graph.sync()
+        network = network_graph.network(
+            top=min(top, 500), min_weight=min_weight, desde=desde, hasta=hasta,
+            centro=centro, tipo=tipo, max_links=min(max_links, 5000), agrupar=agrupar
+        )
+        logger.debug("network", extra={"nodes": len(network["nodes"]), "links": len(network["links"])})
+        return network
     except Exception as e:
-        print(f"Error in network: {str(e)}")
+        logger.exception("error in network")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+@app.get("/api/competition/network")
+async def get_competition_network(
+    top: int = 30,
+    min_weight: int = 2,
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    centro: Optional[int] = None,
+    tipo: str = "competencia",
+    max_links: int = 50,
+    agrupar: str = "empresa"
+):
+    """Obtener red de competencia (empresas que compiten frecuentemente)
+
+    - tipo: "competencia" (ganan lotes de la misma licitación) o "ute" (socios en UTEs)
+    - centro: id de adjudicatario para obtener su red ego
+    - desde/hasta: ventana temporal (granularidad mensual)
+    - agrupar: "empresa" o "grupo" (un nodo por grupo empresarial)
+    """
+    return json_response(await fetch_competition_network(
+        top, min_weight, desde, hasta, centro, tipo, max_links, agrupar
+    ))
+
+# Componentes de cada vista del panel: clave en la respuesta -> endpoint cacheado
+DASHBOARD_VIEWS = {
+    "competition": {
+        "topCompetitors": fetch_top_competitors,
+        "network": fetch_competition_network,
+    },
+    "market": {
+        "organisms": fetch_organisms,
+        "topCompetitors": fetch_top_competitors,
+    },
+}
+
+@app.get("/api/dashboard/{view}")
+async def get_dashboard(view: str):
+    """Obtener todos los datos de una vista del panel en una sola respuesta
+
+    Los componentes se consultan en paralelo, cada uno con su conexión del pool;
+    las peticiones idénticas simultáneas comparten la misma consulta (ver cache.cached).
+    """
+    components = DASHBOARD_VIEWS.get(view)
+    if components is None:
+        raise HTTPException(status_code=404, detail=f"view debe ser una de: {', '.join(DASHBOARD_VIEWS)}")
+    results = await asyncio.gather(*(component() for component in components.values()))
+    return json_response(dict(zip(components, results)))
+
+# Lee de dw.busqueda_adjudicatario (nombres normalizados, índices de prefijo y trigramas).
+# La ruta elige la sentencia según la búsqueda; cada una filtra sólo con predicados que
+# sus índices resuelven también en el plan genérico, sin ramas del tipo "$1 = ''"
+_SEARCH_COLUMNS = """
+            b.id_adjudicatario as id,
+            b.nombre,
+            b.nif,
+            b.es_pyme as "isPyme",
+            COALESCE(b.provincia, 'N/A') as provincia,
+            b.total_wins as "totalWins",
+            b.total_amount::FLOAT as "totalAmount",
+            CASE
+                WHEN b.total_wins > 0 THEN (b.total_amount / b.total_wins)::FLOAT
+                ELSE 0
+            END as "avgAmount"
+"""
+
+# Con menos de SEARCH_MIN_SUBSTRING caracteres no hay trigramas que buscar en el índice GIN
+# (la subcadena y la similitud recorrerían toda la tabla): sólo prefijo, con los btree
+SEARCH_MIN_SUBSTRING = 3
+
+# Un NIF con al menos cuatro dígitos seguidos también se busca como subcadena
+SEARCH_NIF_DIGITS = re.compile(r"[0-9]{4}")
+
+# Prefijo como rango de text_pattern_ops, [$1, $2) en el nombre y [$3, $4) en el NIF:
+# LIKE $1 || '%' sólo usa el btree cuando el plan conoce el valor del parámetro
+SEARCH_ADJUDICATARIOS_PREFIX_SQL = db.prepared("adjudicatarios_search_prefix", f"""
+            SELECT {_SEARCH_COLUMNS}
+            FROM dw.busqueda_adjudicatario b
+            WHERE (b.nombre_normalizado ~>=~ $1 AND b.nombre_normalizado ~<~ $2)
+               OR (b.nif_normalizado ~>=~ $3 AND b.nif_normalizado ~<~ $4)
+            ORDER BY
+                b.nif_normalizado = $3 DESC,
+                b.total_amount DESC
+            LIMIT $5
+        """, replica=True)
+
+# Subcadena y errores tipográficos en el nombre (GIN de trigramas) y prefijo del NIF
+SEARCH_ADJUDICATARIOS_SQL = db.prepared("adjudicatarios_search", f"""
+            SELECT {_SEARCH_COLUMNS}
+            FROM dw.busqueda_adjudicatario b
+            WHERE b.nombre_normalizado LIKE '%' || $1 || '%'
+               OR $1 <% b.nombre_normalizado
+               OR (b.nif_normalizado ~>=~ $2 AND b.nif_normalizado ~<~ $3)
+            ORDER BY
+                b.nif_normalizado = $2 DESC,
+                b.nombre_normalizado LIKE $1 || '%' DESC,
+                word_similarity($1, b.nombre_normalizado) DESC,
+                b.total_amount DESC
+            LIMIT $4
+        """, replica=True)
+
+# Como la anterior, pero con la subcadena del NIF (GIN de trigramas) en lugar del prefijo
+SEARCH_ADJUDICATARIOS_NIF_SQL = db.prepared("adjudicatarios_search_nif", f"""
+            SELECT {_SEARCH_COLUMNS}
+            FROM dw.busqueda_adjudicatario b
+            WHERE b.nombre_normalizado LIKE '%' || $1 || '%'
+               OR $1 <% b.nombre_normalizado
+               OR b.nif_normalizado LIKE '%' || $2 || '%'
+            ORDER BY
+                b.nif_normalizado = $2 DESC,
+                b.nombre_normalizado LIKE $1 || '%' DESC,
+                word_similarity($1, b.nombre_normalizado) DESC,
+                b.total_amount DESC
+            LIMIT $3
+        """, replica=True)
+
+def prefix_end(prefix: str) -> str:
+    """Límite superior (excluido) de los textos que empiezan por prefix ('' si está vacío: rango sin filas)"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else ""
 
 @app.get("/api/adjudicatarios/search")
-def search_adjudicatarios(q: str = ""):
-    """Buscar adjudicatarios por nombre o NIF"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def search_adjudicatarios(q: str = "", limit: int = 50):
+    """Buscar adjudicatarios por nombre o NIF (prefijo, subcadena o con errores tipográficos).
+
+    Las búsquedas de uno o dos caracteres sólo buscan por prefijo; sin texto no devuelve nada.
+    """
+    name, nif = normalize_name(q), normalize_nif(q)
+    if not name and not nif:
+        return json_response([])
+    limit = min(limit, 200)
+    if max(len(name), len(nif)) < SEARCH_MIN_SUBSTRING:
+        statement, args = SEARCH_ADJUDICATARIOS_PREFIX_SQL, (name, prefix_end(name), nif, prefix_end(nif), limit)
+    elif SEARCH_NIF_DIGITS.search(nif):
+        statement, args = SEARCH_ADJUDICATARIOS_NIF_SQL, (name, nif, limit)
+    else:
+        statement, args = SEARCH_ADJUDICATARIOS_SQL, (name, nif, prefix_end(nif), limit)
     try:
-        cursor.execute("""
-            SELECT 
-                a.id_adjudicatario as id,
-                a.nombre,
-                a.nif,
-                COALESCE(a.es_pyme, false) as "isPyme",
-                COALESCE(a.provincia, 'N/A') as provincia,
-                COUNT(DISTINCT r.id_resultado_lote) as "totalWins",
-                COALESCE(SUM(r.importe_adjudicacion_con_iva), 0)::FLOAT as "totalAmount",
-                COALESCE(AVG(r.importe_adjudicacion_con_iva), 0)::FLOAT as "avgAmount"
-            FROM dw.dim_adjudicatario a
-            LEFT JOIN dw.fact_resultado_lote r ON a.id_adjudicatario = r.id_adjudicatario AND r.es_exito = true
-            WHERE a.nombre ILIKE %s OR a.nif ILIKE %s
-            GROUP BY a.id_adjudicatario, a.nombre, a.nif, a.es_pyme, a.provincia
-            ORDER BY "totalAmount" DESC
-            LIMIT 50
-        """, (f'%{q}%', f'%{q}%'))
-        results = cursor.fetchall()
-        print(f"Search results for '{q}': {len(results)}")
-        return results
+        results = await db.fetch(statement, *args)
+        logger.debug("adjudicatario search", extra={"q": q, "rows": len(results)})
+        return json_response(results)
     except Exception as e:
-        print(f"Error searching adjudicatarios: {str(e)}")
+        logger.exception("error searching adjudicatarios")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
 
-@app.get("/api/adjudicatarios/{adjudicatario_id}/tenders")
-def get_adjudicatario_tenders(adjudicatario_id: int):
-    """Obtener licitaciones ganadas por un adjudicatario, agrupando marcos de acuerdo"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            WITH licitaciones_agrupadas AS (
-                SELECT 
-                    l.objeto_contrato,
-                    MIN(l.id_licitacion) as id_representativa,
-                    COUNT(DISTINCT l.id_licitacion) as num_licitaciones,
-                    MAX(o.nombre) as organism,
-                    MIN(r.fecha_adjudicacion) as primera_adjudicacion,
-                    SUM(r.importe_adjudicacion_con_iva) as importe_total,
-                    SUM(lot.importe_lote_con_iva) as presupuesto_total,
-                    COUNT(DISTINCT lot.id_lote) as total_lotes,
-                    MAX(l.url_expediente) as url
-                FROM dw.fact_resultado_lote r
-                INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
-                INNER JOIN dw.fact_licitacion l ON lot.id_licitacion = l.id_licitacion
-                INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
-                WHERE r.id_adjudicatario = %s
-                  AND r.es_exito = true
-                GROUP BY l.objeto_contrato
-            )
+# Lee de dw.agg_adjudicatario_cluster: licitaciones ya agrupadas en marcos de acuerdo
+# y contratos recurrentes por clusters.py
+ADJUDICATARIO_TENDERS_SQL = db.prepared("adjudicatario_tenders", """
             SELECT 
-                id_representativa as id,
+                g.id_licitacion as id,
+                g.id_cluster as cluster,
                 CASE 
-                    WHEN num_licitaciones > 1 
-                    THEN objeto_contrato || ' [Marco: ' || num_licitaciones || ' licitaciones]'
-                    ELSE objeto_contrato
+                    WHEN g.num_licitaciones > 1 
+                    THEN g.objeto_contrato || ' [Marco: ' || g.num_licitaciones || ' licitaciones]'
+                    ELSE g.objeto_contrato
                 END as title,
-                organism,
-                TO_CHAR(primera_adjudicacion, 'DD/MM/YYYY') as fecha_adjudicacion,
-                COALESCE(importe_total, 0) as importe,
-                COALESCE(presupuesto_total, 0) as presupuesto_base,
+                o.nombre as organism,
+                TO_CHAR(g.primera_adjudicacion, 'DD/MM/YYYY') as fecha_adjudicacion,
+                g.fecha_orden,
+                COALESCE(g.importe_total, 0) as importe,
+                COALESCE(g.presupuesto_total, 0) as presupuesto_base,
                 CASE 
-                    WHEN presupuesto_total > 0 
-                    THEN ROUND(((presupuesto_total - importe_total) / presupuesto_total * 100), 2)
+                    WHEN g.presupuesto_total > 0 
+                    THEN ROUND(((g.presupuesto_total - g.importe_total) / g.presupuesto_total * 100), 2)
                     ELSE 0
                 END as descuento,
-                url,
-                total_lotes as num_lotes,
-                num_licitaciones as agrupadas
-            FROM licitaciones_agrupadas
-            ORDER BY primera_adjudicacion DESC
-            LIMIT 100
-        """, (adjudicatario_id,))
-        tenders = cursor.fetchall()
-        print(f"Tenders won by adjudicatario {adjudicatario_id}: {len(tenders)} (grouped)")
-        return tenders
+                g.url_expediente as url,
+                g.num_lotes,
+                g.num_licitaciones as agrupadas
+            FROM dw.agg_adjudicatario_cluster g
+            INNER JOIN dw.dim_organo o ON g.id_organo = o.id_organo
+            WHERE g.id_adjudicatario = $1
+              AND ($2::date IS NULL OR (g.fecha_orden, g.id_cluster) < ($2::date, $3::bigint))
+            ORDER BY g.fecha_orden DESC, g.id_cluster DESC
+            LIMIT $4
+        """, replica=True)
+
+@app.get("/api/adjudicatarios/{adjudicatario_id}/tenders")
+async def get_adjudicatario_tenders(
+    adjudicatario_id: int,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    format: str = "json"
+):
+    """Obtener licitaciones ganadas por un adjudicatario, agrupando marcos de acuerdo
+
+    Paginado por cursor (cabecera X-Next-Cursor); format=columns devuelve las filas como arrays
+    y format=ndjson|csv exporta el historial completo.
+    """
+    if format not in ("json", "columns"):
+        return stream_export(
+            ADJUDICATARIO_TENDERS_SQL, (adjudicatario_id, None, None, None), format,
+            f"adjudicatario_{adjudicatario_id}"
+        )
+    fecha_orden, last_cluster = decode_cursor(cursor, date, int)
+    limit = page_size(limit)
+    args = (adjudicatario_id, fecha_orden, last_cluster, limit)
+    try:
+        if format == "columns":
+            columns, rows = await db.fetch_columns(ADJUDICATARIO_TENDERS_SQL, *args)
+            headers = next_cursor_headers(rows, limit, "fecha_orden", "cluster", columns=columns)
+            return json_response(columnar(columns, rows), headers)
+        tenders = await db.fetch(ADJUDICATARIO_TENDERS_SQL, *args)
+        logger.debug("adjudicatario tenders", extra={"adjudicatario": adjudicatario_id, "rows": len(tenders)})
+        return json_response(tenders, next_cursor_headers(tenders, limit, "fecha_orden", "cluster"))
     except Exception as e:
-        print(f"Error getting adjudicatario tenders: {str(e)}")
+        logger.exception("error getting adjudicatario tenders")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conn.close()
+
+@app.get("/api/changes")
+async def get_changes(since: int = 0, limit: int = 1000, tipo: Optional[str] = None, format: str = "json"):
+    """Cambios posteriores al cursor since: altas, cambios de estado, nuevas versiones y adjudicaciones
+
+    Devuelve {cursor, hasMore, changes}; el cliente guarda cursor y vuelve a pedir con
+    since=cursor. tipo filtra por alta, estado, modificacion y/o adjudicacion (separados
+    por comas); con format=columns, changes es {columns, rows}.
+    """
+    if format not in ("json", "columns"):
+        raise HTTPException(status_code=400, detail="Formato no soportado: json o columns")
+    tipos = [value.strip() for value in tipo.split(",") if value.strip()] if tipo else None
+    if tipos and not set(tipos) <= set(CHANGE_TYPES):
+        raise HTTPException(status_code=400, detail=f"Tipo no válido: {', '.join(CHANGE_TYPES)}")
+    limit = max(1, min(limit, MAX_BATCH_SIZE))
+    try:
+        columns, rows = await db.fetch_columns(CHANGES_SQL, since, tipos, limit)
+        logger.debug("changes", extra={"since": since, "rows": len(rows)})
+        return json_response({
+            "cursor": rows[-1][0] if rows else since,
+            "hasMore": len(rows) == limit,
+            "changes": columnar(columns, rows) if format == "columns" else [dict(zip(columns, row)) for row in rows],
+        })
+    except Exception as e:
+        logger.exception("error getting changes")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/changes/head")
+async def get_changes_head():
+    """Cursor actual del registro de cambios (para empezar a sincronizar tras una carga completa)"""
+    try:
+        return {"cursor": await db.fetchval(HEAD_SQL)}
+    except Exception as e:
+        logger.exception("error getting changes head")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    """Encolar un informe pesado; devuelve el trabajo, cuyo progreso se consulta en /api/jobs/{id}"""
+    try:
+        job = job_queue.submit(request.report, request.params, request.format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFull:
+        raise HTTPException(status_code=503, detail="Cola de informes llena", headers={"Retry-After": "60"})
+    return FastJSONResponse(job_out(job), status_code=202, headers={"Location": f"/api/jobs/{job['id']}"})
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Estado y progreso de un informe (filas escritas y fracción estimada)"""
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return json_response(job_out(job))
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str, range: Optional[str] = Header(None), if_range: Optional[str] = Header(None)):
+    """Resultado del informe comprimido con gzip; admite Range para descargas parciales o reanudadas"""
+    job = read_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"El informe no ha terminado (estado: {job['status']})")
+    return result_response(job, range, if_range)
+
+@app.delete("/api/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Cancelar un informe pendiente o borrar el resultado de uno terminado"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return {"message": "Informe eliminado" if job["status"] in FINISHED else "Informe cancelado"}
+
+def _check_subscription(subscription: Subscription):
+    for low, high in ((subscription.budget_min, subscription.budget_max),
+                      (subscription.deadline_days_min, subscription.deadline_days_max)):
+        if low is not None and high is not None and low > high:
+            raise HTTPException(status_code=400, detail="El mínimo no puede ser mayor que el máximo")
+
+async def _save_subscription(statement: db.Statement, *args) -> Optional[dict]:
+    """Guardar una suscripción y buscar sus coincidencias entre las licitaciones abiertas ya
+    cargadas en la misma transacción: si falla la búsqueda no queda guardada a medias"""
+    async with db.connection() as conn:
+        async with conn.transaction():
+            row = await db.fetchrow(statement, *args, conn=conn)
+            if row:
+                await match_subscriptions(conn, None, row["id_suscripcion"])
+    return row
+
+@app.get("/api/subscriptions", response_model=List[Subscription])
+async def get_subscriptions():
+    """Obtener todas las suscripciones"""
+    try:
+        return [subscription_out(row) for row in await db.fetch(SUBSCRIPTIONS_SQL)]
+    except Exception as e:
+        logger.exception("error in subscriptions")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/subscriptions/{subscription_id}", response_model=Subscription)
+async def get_subscription(subscription_id: int):
+    """Obtener una suscripción por ID"""
+    try:
+        row = await db.fetchrow(SUBSCRIPTION_SQL, subscription_id)
+    except Exception as e:
+        logger.exception("error getting subscription")
+        raise HTTPException(status_code=500, detail=str(e))
+    if not row:
+        raise HTTPException(status_code=404, detail="Suscripción no encontrada")
+    return subscription_out(row)
+
+@app.post("/api/subscriptions", response_model=Subscription, status_code=201)
+async def create_subscription(subscription: Subscription):
+    """Crear una suscripción; se evalúa al momento contra las licitaciones abiertas"""
+    _check_subscription(subscription)
+    try:
+        row = await _save_subscription(CREATE_SUBSCRIPTION_SQL, *subscription_params(subscription.model_dump()))
+        return subscription_out(row)
+    except Exception as e:
+        logger.exception("error creating subscription")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/api/subscriptions/{subscription_id}", response_model=Subscription)
+async def update_subscription(subscription_id: int, subscription: Subscription):
+    """Actualizar una suscripción (las coincidencias anteriores se conservan)"""
+    _check_subscription(subscription)
+    try:
+        row = await _save_subscription(
+            UPDATE_SUBSCRIPTION_SQL, subscription_id, *subscription_params(subscription.model_dump())
+        )
+    except Exception as e:
+        logger.exception("error updating subscription")
+        raise HTTPException(status_code=500, detail=str(e))
+    if not row:
+        raise HTTPException(status_code=404, detail="Suscripción no encontrada")
+    return subscription_out(row)
+
+@app.delete("/api/subscriptions/{subscription_id}")
+async def delete_subscription(subscription_id: int):
+    """Eliminar una suscripción y su buzón"""
+    try:
+        deleted = await db.fetchrow(DELETE_SUBSCRIPTION_SQL, subscription_id)
+    except Exception as e:
+        logger.exception("error deleting subscription")
+        raise HTTPException(status_code=500, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Suscripción no encontrada")
+    return {"message": "Suscripción eliminada"}
+
+@app.get("/api/subscriptions/{subscription_id}/matches")
+async def get_subscription_matches(subscription_id: int, after: int = 0, limit: int = 100):
+    """Buzón de coincidencias posteriores a la coincidencia after (en orden de llegada)"""
+    try:
+        matches = await db.fetch(INBOX_SQL, subscription_id, after, page_size(limit))
+        logger.debug("subscription matches", extra={"subscription": subscription_id, "rows": len(matches)})
+        return matches
+    except Exception as e:
+        logger.exception("error in subscription matches")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/subscriptions/{subscription_id}/stream")
+async def stream_subscription_matches(
+    subscription_id: int,
+    after: int = 0,
+    last_event_id: Optional[int] = Header(None)
+):
+    """Coincidencias en tiempo real (Server-Sent Events)
+
+    Al conectar se envían las pendientes desde after (o desde la cabecera Last-Event-ID
+    al reconectar) y después cada coincidencia nueva según se carga.
+    """
+    if await db.fetchrow(SUBSCRIPTION_SQL, subscription_id) is None:
+        raise HTTPException(status_code=404, detail="Suscripción no encontrada")
+
+    async def events():
+        async for match in match_broker.stream(subscription_id, last_event_id or after):
+            if match is None:
+                yield ": keepalive\n\n"
+            else:
+                data = json.dumps(jsonable_encoder(match), ensure_ascii=False)
+                yield f"id: {match['id']}\nevent: match\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Consultas sobre la instantánea columnar (analytics.py): no leen la base de datos
+@app.get("/api/analytics/companies")
+async def get_analytics_companies(
+    anio: Optional[int] = None,
+    cpv: Optional[str] = None,
+    provincia: Optional[str] = None,
+    comunidad_autonoma: Optional[str] = None,
+    tipo_contrato: Optional[str] = None,
+    order: str = "amount",
+    limit: int = 20
+):
+    """Ranking de adjudicatarios para cualquier combinación de filtros (cpv filtra por prefijo)"""
+    if order not in ("amount", "wins"):
+        raise HTTPException(status_code=400, detail="order debe ser 'amount' o 'wins'")
+    try:
+        snapshot = await analytics_store.get()
+        return json_response(await asyncio.to_thread(
+            top_companies, snapshot, anio, cpv, provincia, comunidad_autonoma, tipo_contrato, min(limit, 1000), order
+        ))
+    except Exception as e:
+        logger.exception("error in analytics companies")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/organisms")
+async def get_analytics_organisms(
+    anio: Optional[int] = None,
+    cpv: Optional[str] = None,
+    provincia: Optional[str] = None,
+    comunidad_autonoma: Optional[str] = None,
+    tipo_contrato: Optional[str] = None,
+    min_tenders: int = 1,
+    limit: int = 100
+):
+    """Volumen licitado frente a tasa de éxito de los organismos del filtro"""
+    try:
+        snapshot = await analytics_store.get()
+        return json_response(await asyncio.to_thread(
+            organism_volume, snapshot, anio, cpv, provincia, comunidad_autonoma, tipo_contrato,
+            min(limit, 5000), min_tenders
+        ))
+    except Exception as e:
+        logger.exception("error in analytics organisms")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/snapshot")
+async def get_analytics_snapshot():
+    """Estado de la instantánea columnar en este proceso"""
+    snapshot = await analytics_store.get()
+    return {
+        "watermark": snapshot.watermark,
+        "loadedAt": snapshot.loaded_at,
+        "awards": snapshot.rows("awards"),
+        "tenders": snapshot.rows("tenders"),
+        "companies": snapshot.rows("companies"),
+        "organisms": snapshot.rows("organisms"),
+    }
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "healthy"}
 
 @app.get("/api/health")
-def api_health_check():
-    return {"status": "healthy"}
+async def api_health_check():
+    """Estado del servicio y de las réplicas de lectura.
+
+    degraded: hay réplicas configuradas pero ninguna disponible (caídas o con más retraso
+    que DB_REPLICA_MAX_LAG), así que todas las lecturas van al primario.
+    """
+    replicas = db.replica_status()
+    degraded = bool(replicas) and not any(replica["healthy"] for replica in replicas)
+    return {"status": "degraded" if degraded else "healthy", "replicas": replicas}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas del proceso en formato de exposición de Prometheus"""
+    for state, value in db.pool_stats().items():
+        metrics.DB_POOL_CONNECTIONS.set(value, state)
+    metrics.CACHE_ENTRIES.set(len(response_cache))
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Con varios workers cada proceso crea sus propios pools (DB_POOL_MAX conexiones por worker)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
@@ -0,0 +1,179 @@
+"""Métricas en memoria del proceso en formato de exposición de Prometheus."""
+import json
+import logging
+import os
+from typing import Dict, List, Sequence, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" (legible) o "json" (una línea JSON por evento, con los campos de extra=)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# Segundos
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event.update({key: value for key, value in vars(record).items() if key not in _RESERVED})
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str, ensure_ascii=False)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(f"{key}={value}" for key, value in vars(record).items() if key not in _RESERVED)
+        if fields:
+            line = line.split("\n", 1)
+            line[0] = f"{line[0]} {fields}"
+            line = "\n".join(line)
+        return line
+
+
+def configure_logging():
+    """Configurar el logging raíz según LOG_LEVEL y LOG_FORMAT"""
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histograma acumulativo con cubetas fijas"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # etiquetas -> [recuento por cubeta..., suma, total]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+REGISTRY: list = []
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Duración de las peticiones HTTP", ("endpoint", "method", "status")
+)
+DB_STATEMENT_SECONDS = Histogram(
+    "db_statement_duration_seconds", "Duración de las sentencias SQL", ("statement",)
+)
+DB_STATEMENT_ROWS = Histogram(
+    "db_statement_rows", "Filas devueltas por sentencia SQL", ("statement",), buckets=ROW_BUCKETS
+)
+DB_STATEMENT_ERRORS = Counter("db_statement_errors_total", "Sentencias SQL fallidas", ("statement",))
+DB_SLOW_QUERIES = Counter("db_slow_queries_total", "Sentencias por encima del umbral de consulta lenta", ("statement",))
+DB_POOL_ACQUIRE_SECONDS = Histogram("db_pool_acquire_seconds", "Espera para obtener una conexión del pool")
+DB_POOL_CONNECTIONS = Gauge("db_pool_connections", "Conexiones del pool por estado", ("state",))
+DB_REPLICA_HEALTHY = Gauge("db_replica_healthy", "Réplica disponible para lecturas (1) o no (0)", ("replica",))
+DB_REPLICA_LAG_SECONDS = Gauge("db_replica_lag_seconds", "Retraso de replicación (-1 si no responde)", ("replica",))
+DB_HEAVY_QUEUE_SECONDS = Histogram(
+    "db_heavy_queue_seconds", "Espera de las sentencias pesadas por el control de admisión", ("statement",)
+)
+DB_HEAVY_QUERIES = Gauge("db_heavy_queries", "Sentencias pesadas por estado", ("state",))
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Consultas a la caché de respuestas por resultado", ("endpoint", "result")
+)
+CACHE_ENTRIES = Gauge("cache_entries", "Entradas en la caché de respuestas local")
+JOBS = Gauge("jobs", "Informes en segundo plano de este proceso por estado", ("state",))
+JOBS_FINISHED = Counter("jobs_finished_total", "Informes terminados por resultado", ("report", "status"))
+JOB_SECONDS = Histogram(
+    "job_duration_seconds", "Duración de los informes en segundo plano", ("report",),
+    buckets=(1, 5, 15, 30, 60, 300, 900, 1800, 3600)
+)
+JOB_SPOOL_BYTES = Gauge("job_spool_bytes", "Bytes de resultados de informes en disco")
+
+
+def render() -> str:
+    """Texto de exposición de todas las métricas registradas"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,64 @@
+"""Aplicar las migraciones SQL de backend/migrations en orden.
+
+Cada migración se aplica en una transacción. Las que empiezan por la línea
+"-- migrate: no-transaction" (índices con CREATE INDEX CONCURRENTLY, que no admite
+transacciones) se ejecutan sentencia a sentencia en modo autocommit; deben poder
+repetirse (IF NOT EXISTS) por si una falla a medias.
+
+Uso: python migrate.py
+"""
+import asyncio
+import logging
+from pathlib import Path
+from typing import List
+
+import asyncpg
+
+import metrics
+from db import DB_CONFIG
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+NO_TRANSACTION = "-- migrate: no-transaction"
+
+logger = logging.getLogger(__name__)
+
+
+async def pending_migrations(conn: asyncpg.Connection):
+    """Devolver las migraciones que aún no se han aplicado, en orden"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS dw.schema_migrations (
+            version text PRIMARY KEY,
+            aplicada_en timestamptz NOT NULL DEFAULT now()
+        )
+    """)
+    applied = {row["version"] for row in await conn.fetch("SELECT version FROM dw.schema_migrations")}
+    return [path for path in sorted(MIGRATIONS_DIR.glob("*.sql")) if path.stem not in applied]
+
+
+def split_statements(sql: str) -> List[str]:
+    """Separar un script en sentencias (sin comentarios; basta para scripts de índices)"""
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+async def migrate():
+    conn = await asyncpg.connect(**DB_CONFIG)
+    try:
+        for path in await pending_migrations(conn):
+            logger.info("applying migration", extra={"migration": path.name})
+            sql = path.read_text(encoding="utf-8")
+            if sql.startswith(NO_TRANSACTION):
+                for statement in split_statements(sql):
+                    await conn.execute(statement)
+                await conn.execute("INSERT INTO dw.schema_migrations (version) VALUES ($1)", path.stem)
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute("INSERT INTO dw.schema_migrations (version) VALUES ($1)", path.stem)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    metrics.configure_logging()
+    asyncio.run(migrate())
@@ -0,0 +1,35 @@
+-- Marcas de agua de los procesos de refresco incremental (refresh.py)
+CREATE TABLE IF NOT EXISTS dw.etl_marca (
+    proceso varchar(50) PRIMARY KEY,
+    id_licitacion bigint NOT NULL DEFAULT 0,
+    id_resultado_lote bigint NOT NULL DEFAULT 0,
+    id_carga bigint NOT NULL DEFAULT 0,
+    actualizado_en timestamptz NOT NULL DEFAULT now()
+);
+
+-- Diario de licitaciones insertadas o modificadas por las cargas ETL.
+-- Permite detectar cambios en licitaciones existentes (nuevas versiones del expediente).
+CREATE TABLE IF NOT EXISTS dw.etl_licitacion_cargada (
+    id_carga bigserial PRIMARY KEY,
+    id_licitacion bigint NOT NULL,
+    cargada_en timestamptz NOT NULL DEFAULT now()
+);
+
+-- KPIs de organismos por mes de publicación.
+-- Se guardan sumas y recuentos (no medias) para poder agregar cualquier rango de meses.
+CREATE TABLE IF NOT EXISTS dw.agg_organo_mes (
+    id_organo bigint NOT NULL REFERENCES dw.dim_organo (id_organo),
+    mes date NOT NULL,
+    total_licitaciones integer NOT NULL,
+    licitaciones_adjudicadas integer NOT NULL,
+    presupuesto_total numeric(20,2) NOT NULL,
+    presupuesto_num integer NOT NULL,
+    baja_suma numeric NOT NULL,
+    baja_suma_cuadrados numeric NOT NULL,
+    baja_num integer NOT NULL,
+    baja_min numeric,
+    baja_max numeric,
+    PRIMARY KEY (id_organo, mes)
+);
+
+CREATE INDEX IF NOT EXISTS idx_agg_organo_mes_mes ON dw.agg_organo_mes USING btree (mes);
@@ -0,0 +1,28 @@
+-- Índice de búsqueda de adjudicatarios: nombre/NIF normalizados y totales precalculados
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS dw.busqueda_adjudicatario (
+    id_adjudicatario bigint PRIMARY KEY REFERENCES dw.dim_adjudicatario (id_adjudicatario),
+    nombre text NOT NULL,
+    nif varchar(15),
+    es_pyme boolean NOT NULL DEFAULT false,
+    provincia varchar(100),
+    nombre_normalizado text NOT NULL,
+    nif_normalizado varchar(20) NOT NULL DEFAULT '',
+    total_wins integer NOT NULL DEFAULT 0,
+    total_amount numeric(20,2) NOT NULL DEFAULT 0
+);
+
+-- Autocompletado por prefijo
+CREATE INDEX IF NOT EXISTS idx_busqueda_adj_nombre_prefijo
+    ON dw.busqueda_adjudicatario USING btree (nombre_normalizado text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_busqueda_adj_nif_prefijo
+    ON dw.busqueda_adjudicatario USING btree (nif_normalizado text_pattern_ops);
+
+-- Subcadenas y tolerancia a errores tipográficos
+CREATE INDEX IF NOT EXISTS idx_busqueda_adj_nombre_trgm
+    ON dw.busqueda_adjudicatario USING gin (nombre_normalizado gin_trgm_ops);
+
+-- Listado sin filtro ordenado por importe
+CREATE INDEX IF NOT EXISTS idx_busqueda_adj_importe
+    ON dw.busqueda_adjudicatario USING btree (total_amount DESC);
@@ -0,0 +1,3 @@
+-- Índice para la paginación por cursor de los listados por plazo de presentación
+CREATE INDEX IF NOT EXISTS idx_licitacion_fecha_limite_id
+    ON dw.fact_licitacion USING btree (fecha_limite_ofertas, id_licitacion);
@@ -0,0 +1,16 @@
+-- Resultado final de cada licitación, calculado una vez por refresh.py
+-- (vista de licitaciones desiertas y tasa de éxito de los organismos)
+CREATE TABLE IF NOT EXISTS dw.licitacion_resultado (
+    id_licitacion bigint PRIMARY KEY REFERENCES dw.fact_licitacion (id_licitacion),
+    fecha_limite_ofertas date,
+    adjudicada boolean NOT NULL,
+    resultado varchar(30) NOT NULL
+);
+
+-- Licitaciones no adjudicadas por plazo: la vista de desiertas es un recorrido de rango
+CREATE INDEX IF NOT EXISTS idx_licitacion_resultado_no_adjudicada
+    ON dw.licitacion_resultado USING btree (fecha_limite_ofertas, id_licitacion)
+    WHERE NOT adjudicada;
+
+CREATE INDEX IF NOT EXISTS idx_licitacion_resultado_resultado_fecha
+    ON dw.licitacion_resultado USING btree (resultado, fecha_limite_ofertas);
@@ -0,0 +1,3 @@
+-- La clasificación de resultados y los KPIs de organismos recorren los resultados
+-- de cada licitación por lote: sin este índice cada licitación lee la tabla entera
+CREATE INDEX IF NOT EXISTS idx_resultado_lote ON dw.fact_resultado_lote USING btree (id_lote);
@@ -0,0 +1,35 @@
+-- Agrupación de licitaciones relacionadas del mismo organismo (marcos de acuerdo,
+-- contratos que se vuelven a licitar cada año...), calculada por refresh.py.
+-- id_cluster es el id_licitacion del primer expediente publicado del grupo.
+CREATE TABLE IF NOT EXISTS dw.licitacion_cluster (
+    id_licitacion bigint PRIMARY KEY REFERENCES dw.fact_licitacion (id_licitacion),
+    id_organo bigint NOT NULL,
+    id_cluster bigint NOT NULL,
+    objeto_normalizado text NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_licitacion_cluster_organo ON dw.licitacion_cluster USING btree (id_organo);
+CREATE INDEX IF NOT EXISTS idx_licitacion_cluster_cluster ON dw.licitacion_cluster USING btree (id_cluster);
+
+-- Historial de adjudicaciones de cada empresa ya agrupado por cluster
+CREATE TABLE IF NOT EXISTS dw.agg_adjudicatario_cluster (
+    id_adjudicatario bigint NOT NULL,
+    id_cluster bigint NOT NULL,
+    id_organo bigint NOT NULL,
+    id_licitacion bigint NOT NULL,          -- primera licitación ganada del grupo
+    objeto_contrato text NOT NULL,
+    num_licitaciones integer NOT NULL,
+    num_lotes integer NOT NULL,
+    primera_adjudicacion date,
+    -- primera_adjudicacion o, si falta, la primera publicación: clave de orden de la paginación
+    fecha_orden date NOT NULL,
+    importe_total numeric(18,2),
+    presupuesto_total numeric(18,2),
+    url_expediente text,
+    PRIMARY KEY (id_adjudicatario, id_cluster)
+);
+
+CREATE INDEX IF NOT EXISTS idx_agg_adjudicatario_cluster_orden
+    ON dw.agg_adjudicatario_cluster USING btree (id_adjudicatario, fecha_orden DESC, id_cluster DESC);
+CREATE INDEX IF NOT EXISTS idx_agg_adjudicatario_cluster_organo
+    ON dw.agg_adjudicatario_cluster USING btree (id_organo);
@@ -0,0 +1,36 @@
+-- Suscripciones a licitaciones nuevas y su buzón de coincidencias (subscriptions.py).
+-- Los filtros vacíos se guardan como '*' (o 0 en organismos) para que todas las
+-- condiciones sean solapamientos de arrays resolubles con los índices GIN, y los
+-- rangos sin límite como '(,)'.
+CREATE TABLE IF NOT EXISTS dw.suscripcion (
+    id_suscripcion bigserial PRIMARY KEY,
+    nombre text NOT NULL,
+    email varchar(255),
+    -- CPV suscritos: coinciden también todos sus descendientes (dim_cpv.codigo_padre)
+    cpvs varchar(9)[] NOT NULL DEFAULT '{*}',
+    organos bigint[] NOT NULL DEFAULT '{0}',
+    provincias varchar(100)[] NOT NULL DEFAULT '{*}',
+    presupuesto numrange NOT NULL DEFAULT '(,)',
+    -- Días para presentar ofertas (fact_licitacion.dias_para_ofertar)
+    plazo int4range NOT NULL DEFAULT '(,)',
+    activa boolean NOT NULL DEFAULT true,
+    creada_en timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_suscripcion_cpvs ON dw.suscripcion USING gin (cpvs);
+CREATE INDEX IF NOT EXISTS idx_suscripcion_organos ON dw.suscripcion USING gin (organos);
+CREATE INDEX IF NOT EXISTS idx_suscripcion_provincias ON dw.suscripcion USING gin (provincias);
+CREATE INDEX IF NOT EXISTS idx_suscripcion_presupuesto ON dw.suscripcion USING gist (presupuesto);
+CREATE INDEX IF NOT EXISTS idx_suscripcion_plazo ON dw.suscripcion USING gist (plazo);
+
+CREATE TABLE IF NOT EXISTS dw.suscripcion_coincidencia (
+    id_coincidencia bigserial PRIMARY KEY,
+    id_suscripcion bigint NOT NULL REFERENCES dw.suscripcion (id_suscripcion) ON DELETE CASCADE,
+    id_licitacion bigint NOT NULL REFERENCES dw.fact_licitacion (id_licitacion),
+    creada_en timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (id_suscripcion, id_licitacion)
+);
+
+-- Lectura del buzón de una suscripción a partir de la última coincidencia vista
+CREATE INDEX IF NOT EXISTS idx_suscripcion_coincidencia_buzon
+    ON dw.suscripcion_coincidencia USING btree (id_suscripcion, id_coincidencia);
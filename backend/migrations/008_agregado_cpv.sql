@@ -0,0 +1,57 @@
+-- Indicadores sectoriales por CPV acumulados en todos los niveles de la jerarquía
+-- (sustituye a la vista mv_indicadores_cpv, que agregaba los lotes en cada lectura
+-- y sólo por código hoja). Los mantiene refresh.py.
+
+-- Clausura de dim_cpv.codigo_padre: cada código con todos sus antecesores (y él mismo)
+CREATE TABLE IF NOT EXISTS dw.cpv_antecesor (
+    codigo_cpv varchar(9) NOT NULL,
+    codigo_antecesor varchar(9) NOT NULL,
+    distancia smallint NOT NULL,
+    PRIMARY KEY (codigo_cpv, codigo_antecesor)
+);
+
+CREATE INDEX IF NOT EXISTS idx_cpv_padre ON dw.dim_cpv USING btree (codigo_padre);
+
+-- Aportación de cada licitación a cada código (hoja o antecesor) en el que tiene lotes.
+-- Permite restar lo anterior y sumar lo nuevo cuando se recarga una licitación.
+CREATE TABLE IF NOT EXISTS dw.cpv_licitacion (
+    codigo_cpv varchar(9) NOT NULL,
+    id_licitacion bigint NOT NULL,
+    num_lotes integer NOT NULL,
+    presupuesto_suma numeric NOT NULL,
+    presupuesto_num integer NOT NULL,
+    baja_suma numeric NOT NULL,
+    baja_num integer NOT NULL,
+    licitadores_suma bigint NOT NULL,
+    licitadores_num integer NOT NULL,
+    PRIMARY KEY (codigo_cpv, id_licitacion)
+);
+
+CREATE INDEX IF NOT EXISTS idx_cpv_licitacion_licitacion ON dw.cpv_licitacion USING btree (id_licitacion);
+
+-- Totales por código: las medias son suma / num, así que se actualizan por diferencias
+CREATE TABLE IF NOT EXISTS dw.agg_cpv (
+    codigo_cpv varchar(9) PRIMARY KEY,
+    total_licitaciones integer NOT NULL,
+    num_lotes integer NOT NULL,
+    presupuesto_suma numeric NOT NULL,
+    presupuesto_num integer NOT NULL,
+    baja_suma numeric NOT NULL,
+    baja_num integer NOT NULL,
+    licitadores_suma bigint NOT NULL,
+    licitadores_num integer NOT NULL
+);
+
+-- Misma interfaz que la vista anterior, ahora leyendo los totales mantenidos
+DROP VIEW IF EXISTS dw.mv_indicadores_cpv;
+CREATE VIEW dw.mv_indicadores_cpv AS
+SELECT
+    cpv.codigo_cpv,
+    cpv.descripcion,
+    a.total_licitaciones::bigint as total_licitaciones,
+    ROUND(a.baja_suma / NULLIF(a.baja_num, 0), 2) as baja_media_sector_pct,
+    ROUND(a.presupuesto_suma / NULLIF(a.presupuesto_num, 0), 0) as presupuesto_medio,
+    ROUND(a.licitadores_suma::numeric / NULLIF(a.licitadores_num, 0), 1) as competidores_promedio
+FROM dw.agg_cpv a
+INNER JOIN dw.dim_cpv cpv ON cpv.codigo_cpv = a.codigo_cpv
+WHERE a.total_licitaciones > 0;
@@ -0,0 +1,24 @@
+-- Cubo de tendencias: organismo x división CPV x tipo de contrato x mes de publicación
+-- (mes según dw.dim_tiempo). Guarda sumas y recuentos para poder agregar por cualquier
+-- subconjunto de dimensiones y periodo. Lo mantiene refresh.py recalculando los meses cargados.
+CREATE TABLE IF NOT EXISTS dw.agg_tendencia_mes (
+    id_organo bigint NOT NULL REFERENCES dw.dim_organo (id_organo),
+    -- División del CPV principal de la licitación ('45000000'); '' si no tiene CPV
+    division_cpv varchar(9) NOT NULL,
+    -- '' si la licitación no tiene tipo de contrato
+    tipo_contrato varchar(50) NOT NULL,
+    mes date NOT NULL,
+    total_licitaciones integer NOT NULL,
+    presupuesto_total numeric(20,2) NOT NULL,
+    adjudicado_total numeric(20,2) NOT NULL,
+    licitaciones_adjudicadas integer NOT NULL,
+    baja_suma numeric NOT NULL,
+    baja_num integer NOT NULL,
+    licitadores_suma bigint NOT NULL,
+    licitadores_num integer NOT NULL,
+    PRIMARY KEY (id_organo, division_cpv, tipo_contrato, mes)
+);
+
+CREATE INDEX IF NOT EXISTS idx_agg_tendencia_mes_mes ON dw.agg_tendencia_mes USING btree (mes);
+CREATE INDEX IF NOT EXISTS idx_agg_tendencia_mes_division
+    ON dw.agg_tendencia_mes USING btree (division_cpv, mes);
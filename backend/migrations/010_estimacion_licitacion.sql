@@ -0,0 +1,19 @@
+-- Estimación del importe de adjudicación de las licitaciones con plazo vigente (estimates.py).
+-- Se recalcula entera tras cada carga a partir de las bajas históricas.
+CREATE TABLE IF NOT EXISTS dw.estimacion_licitacion (
+    id_licitacion bigint PRIMARY KEY REFERENCES dw.fact_licitacion (id_licitacion) ON DELETE CASCADE,
+    -- Cuartiles de la baja (%) de las adjudicaciones comparables
+    baja_p25 numeric(7,2) NOT NULL,
+    baja_p50 numeric(7,2) NOT NULL,
+    baja_p75 numeric(7,2) NOT NULL,
+    -- Presupuesto aplicando la baja mediana y el rango intercuartílico (NULL sin presupuesto)
+    importe_estimado numeric(18,2),
+    importe_min numeric(18,2),
+    importe_max numeric(18,2),
+    muestras integer NOT NULL,
+    -- Distribución usada: cpv_organo_procedimiento (con el CPV o antecesor en codigo_cpv),
+    -- organo_procedimiento, procedimiento o global
+    nivel varchar(30) NOT NULL,
+    codigo_cpv varchar(9),
+    calculada_en timestamptz NOT NULL DEFAULT now()
+);
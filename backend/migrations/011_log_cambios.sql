@@ -0,0 +1,40 @@
+-- Registro de cambios para sincronización incremental (/api/changes).
+-- Lo escribe ingest.py en la misma transacción que los hechos; id_cambio es el cursor
+-- monótono que guardan los clientes. tipo: alta, estado, modificacion o adjudicacion.
+CREATE TABLE IF NOT EXISTS dw.log_cambios (
+    id_cambio bigserial PRIMARY KEY,
+    id_licitacion bigint NOT NULL REFERENCES dw.fact_licitacion (id_licitacion) ON DELETE CASCADE,
+    tipo varchar(20) NOT NULL,
+    -- Estado de la licitación tras el cambio
+    estado varchar(50),
+    -- Sólo en adjudicacion: lote, adjudicatario (líder si es UTE) e importe con IVA
+    numero_lote varchar(50),
+    id_adjudicatario bigint,
+    importe numeric(18,2),
+    registrado_en timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_log_cambios_licitacion ON dw.log_cambios USING btree (id_licitacion);
+
+-- Histórico ya cargado, en orden cronológico: un cliente que empieza en since=0 obtiene
+-- todas las licitaciones, sus cambios de estado y sus adjudicaciones
+INSERT INTO dw.log_cambios (id_licitacion, tipo, estado, numero_lote, id_adjudicatario, importe, registrado_en)
+SELECT id_licitacion, tipo, estado, numero_lote, id_adjudicatario, importe, registrado_en
+FROM (
+    SELECT l.id_licitacion, 'alta' as tipo, l.estado, NULL as numero_lote, NULL::bigint as id_adjudicatario,
+           NULL::numeric as importe, l.fecha_publicacion::timestamptz as registrado_en, 0 as orden
+    FROM dw.fact_licitacion l
+    UNION ALL
+    SELECT e.id_licitacion, 'estado', e.estado_resultante, NULL, NULL, NULL, e.fecha_evento::timestamptz, 1
+    FROM dw.fact_evento_licitacion e
+    WHERE e.tipo_evento IS DISTINCT FROM 'Publicación'
+    UNION ALL
+    SELECT lot.id_licitacion, 'adjudicacion', l.estado, lot.numero_lote, r.id_adjudicatario,
+           r.importe_adjudicacion_con_iva, COALESCE(r.fecha_adjudicacion, l.fecha_publicacion)::timestamptz, 2
+    FROM dw.fact_resultado_lote r
+    INNER JOIN dw.fact_lote lot ON lot.id_lote = r.id_lote
+    INNER JOIN dw.fact_licitacion l ON l.id_licitacion = lot.id_licitacion
+    WHERE r.es_exito
+) historico
+WHERE NOT EXISTS (SELECT 1 FROM dw.log_cambios)
+ORDER BY registrado_en, orden, id_licitacion;
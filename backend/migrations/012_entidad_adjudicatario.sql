@@ -0,0 +1,20 @@
+-- Resolución de entidades de adjudicatarios (entities.py): claves de bloque de cada empresa
+-- ya resuelta y tamaño de cada bloque, para resolver sólo las nuevas en cada refresco.
+-- El resultado se guarda en dim_adjudicatario.id_grupo_empresarial (menor id del grupo).
+CREATE TABLE IF NOT EXISTS dw.entidad_adjudicatario (
+    id_adjudicatario bigint PRIMARY KEY REFERENCES dw.dim_adjudicatario (id_adjudicatario) ON DELETE CASCADE,
+    -- Tokens del nombre sin forma jurídica, separados por espacios
+    nombre_normalizado text NOT NULL,
+    -- '' si no tiene NIF válido
+    nif_normalizado varchar(20) NOT NULL DEFAULT '',
+    es_ute boolean NOT NULL DEFAULT false,
+    -- 'tok:<token>', 'par:<token> <token>', 'nif:<NIF sin control>'; con prefijo 'ute:' para las UTE
+    claves text[] NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_entidad_adjudicatario_claves ON dw.entidad_adjudicatario USING gin (claves);
+
+CREATE TABLE IF NOT EXISTS dw.bloque_adjudicatario (
+    clave text PRIMARY KEY,
+    miembros integer NOT NULL
+);
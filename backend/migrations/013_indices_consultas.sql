@@ -0,0 +1,32 @@
+-- migrate: no-transaction
+-- Índices para los predicados más frecuentes de las consultas de la API y de refresh.py.
+-- Se crean con CONCURRENTLY para no bloquear la carga en producción; si una sentencia
+-- falla deja el índice como INVALID y hay que borrarlo (DROP INDEX) antes de reintentar.
+-- bench/plans.py comprueba que los planes siguen usándolos.
+
+-- Resultados con éxito por lote (grafo de competencia, clasificación de resultados):
+-- sólo las filas adjudicadas y con las columnas que se leen, para recorrerlo sin ir a la tabla
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_resultado_exito_lote
+    ON dw.fact_resultado_lote USING btree (id_lote)
+    INCLUDE (id_adjudicatario, importe_adjudicacion_con_iva, fecha_adjudicacion)
+    WHERE es_exito;
+
+-- Ranking de competidores: adjudicaciones con importe de cada empresa, sólo índice
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_resultado_exito_adjudicatario
+    ON dw.fact_resultado_lote USING btree (id_adjudicatario)
+    INCLUDE (id_resultado_lote, importe_adjudicacion_con_iva)
+    WHERE es_exito AND importe_adjudicacion_con_iva > 0;
+
+-- Lotes de una licitación con su importe (resultados, KPIs, exportaciones)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_lote_licitacion_importe
+    ON dw.fact_lote USING btree (id_licitacion)
+    INCLUDE (id_lote, numero_lote, importe_lote_con_iva);
+
+-- Búsqueda de adjudicatarios por parte del NIF (p. ej. sólo los dígitos)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_busqueda_adj_nif_trgm
+    ON dw.busqueda_adjudicatario USING gin (nif_normalizado gin_trgm_ops);
+
+-- Sustituidos por los anteriores: un btree sobre un booleano no filtra nada y el de
+-- lotes por licitación queda cubierto por idx_lote_licitacion_importe
+DROP INDEX CONCURRENTLY IF EXISTS dw.idx_resultado_exito;
+DROP INDEX CONCURRENTLY IF EXISTS dw.idx_lote_licitacion;
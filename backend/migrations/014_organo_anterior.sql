@@ -0,0 +1,8 @@
+-- Organismo anterior de las licitaciones que una nueva versión del expediente cambia de
+-- organismo: refresh.py recalcula también sus KPIs (agg_organo_mes).
+ALTER TABLE dw.etl_licitacion_cargada ADD COLUMN IF NOT EXISTS id_organo_anterior bigint;
+
+-- Sólo las filas con cambio de organismo, que son pocas
+CREATE INDEX IF NOT EXISTS idx_licitacion_cargada_organo_anterior
+    ON dw.etl_licitacion_cargada USING btree (id_licitacion)
+    WHERE id_organo_anterior IS NOT NULL;
@@ -0,0 +1,7 @@
+-- Fecha de publicación anterior de las licitaciones cuya nueva versión del expediente la
+-- cambia: refresh.py recalcula también el mes anterior del cubo de tendencias (agg_tendencia_mes).
+ALTER TABLE dw.etl_licitacion_cargada ADD COLUMN IF NOT EXISTS id_fecha_publicacion_anterior integer;
+
+CREATE INDEX IF NOT EXISTS idx_licitacion_cargada_fecha_anterior
+    ON dw.etl_licitacion_cargada USING btree (id_licitacion)
+    WHERE id_fecha_publicacion_anterior IS NOT NULL;
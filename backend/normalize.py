@@ -0,0 +1,85 @@
+"""Normalización de textos para búsqueda y comparación (nombres, NIF, títulos)."""
+import re
+import unicodedata
+from typing import List
+
+# Formas jurídicas que se eliminan al final de los nombres de empresa,
+# expresadas como secuencias de tokens tras quitar la puntuación
+LEGAL_SUFFIXES = [
+    ("sociedad", "limitada", "unipersonal"),
+    ("sociedad", "limitada", "laboral"),
+    ("sociedad", "limitada", "profesional"),
+    ("sociedad", "limitada"),
+    ("sociedad", "anonima", "unipersonal"),
+    ("sociedad", "anonima", "laboral"),
+    ("sociedad", "anonima"),
+    ("sociedad", "cooperativa"),
+    ("s", "l", "u"), ("s", "l", "l"), ("s", "l", "p"), ("s", "l"),
+    ("s", "a", "u"), ("s", "a", "l"), ("s", "a"),
+    ("s", "coop"), ("s", "c"),
+    ("slu",), ("sll",), ("slp",), ("sl",), ("sau",), ("sal",), ("sa",),
+    ("scoop",), ("coop",), ("ute",), ("cb",), ("c", "b"),
+]
+
+# Palabras que no distinguen un contrato de otro en el objeto del contrato:
+# artículos y preposiciones, y referencias a lotes, expedientes o periodos
+TITLE_STOPWORDS = {
+    "a", "al", "con", "de", "del", "e", "el", "en", "la", "las", "lo", "los", "o", "para", "por", "se",
+    "su", "sus", "u", "un", "una", "y",
+    "lote", "lotes", "expediente", "exp", "expte", "ref", "n", "no", "num", "numero",
+    "ano", "anos", "anualidad", "ejercicio", "periodo", "prorroga",
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre",
+    "octubre", "noviembre", "diciembre",
+}
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_HAS_DIGIT = re.compile(r"[0-9]")
+
+
+def strip_accents(text: str) -> str:
+    """Eliminar tildes y diacríticos (ñ -> n, ç -> c)"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokens(text: str) -> List[str]:
+    """Minúsculas, sin tildes ni puntuación, separado en palabras"""
+    return _NON_ALNUM.sub(" ", strip_accents(text or "").lower()).split()
+
+
+def strip_legal_suffix(words: List[str]) -> List[str]:
+    """Quitar formas jurídicas al final (p.ej. "s l", "sa", "sociedad limitada")"""
+    changed = True
+    while changed and words:
+        changed = False
+        for suffix in LEGAL_SUFFIXES:
+            if len(words) > len(suffix) and tuple(words[-len(suffix):]) == suffix:
+                words = words[:-len(suffix)]
+                changed = True
+                break
+    return words
+
+
+def normalize_name(name: str) -> str:
+    """Normalizar un nombre de empresa para indexarlo y buscarlo"""
+    return " ".join(strip_legal_suffix(tokens(name)))
+
+
+def normalize_nif(nif: str) -> str:
+    """Normalizar un NIF/CIF: mayúsculas, sin separadores ni prefijo de país"""
+    value = re.sub(r"[^A-Z0-9]", "", strip_accents(nif or "").upper())
+    if value.startswith("ES") and len(value) > 9:
+        value = value[2:]
+    return value
+
+
+def normalize_title(title: str) -> str:
+    """Normalizar el objeto de un contrato para comparar licitaciones recurrentes.
+
+    Quita palabras vacías, números (años, nº de lote o de expediente) y los
+    códigos alfanuméricos, de modo que "Suministro de gasóleo 2023 - Lote 2"
+    y "SUMINISTRO GASOLEO (2024)" quedan iguales.
+    """
+    return " ".join(
+        word for word in tokens(title) if word not in TITLE_STOPWORDS and not _HAS_DIGIT.search(word)
+    )
@@ -0,0 +1,45 @@
+"""Paginación por cursor (keyset) para los listados."""
+import base64
+import json
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(*values: Any) -> str:
+    """Codificar la clave de la última fila de una página como cursor opaco"""
+    payload = [value.isoformat() if isinstance(value, date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], *types: type) -> Tuple[Any, ...]:
+    """Decodificar un cursor; devuelve una tupla de None si no hay cursor"""
+    if not cursor:
+        return (None,) * len(types)
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if len(values) != len(types):
+            raise ValueError("longitud incorrecta")
+        return tuple(
+            None if value is None else date.fromisoformat(value) if kind is date else kind(value)
+            for value, kind in zip(values, types)
+        )
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Cursor inválido: {str(e)}")
+
+
+def page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def next_cursor_headers(rows: list, limit: int, *keys: str, columns: Optional[List[str]] = None) -> Dict[str, str]:
+    """Cabecera X-Next-Cursor si la página está completa (filas como dicts, o tuplas con sus columns)"""
+    if len(rows) != limit or not rows:
+        return {}
+    last = rows[-1] if columns is None else dict(zip(columns, rows[-1]))
+    return {"X-Next-Cursor": encode_cursor(*(last[key] for key in keys))}
+
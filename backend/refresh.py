@@ -0,0 +1,447 @@
+"""Refresco incremental de las tablas precalculadas tras cada carga ETL.
+
+Cada proceso guarda en dw.etl_marca hasta dónde ha procesado las licitaciones,
+los resultados y el diario de cargas, y en la siguiente ejecución sólo recalcula
+lo afectado por las filas nuevas.
+
+Uso: python refresh.py [--full]
+"""
+import argparse
+import asyncio
+import logging
+from typing import List, Optional
+
+import asyncpg
+
+import db
+import metrics
+from clusters import refresh_tender_clusters
+from entities import refresh_company_groups
+from estimates import refresh_award_estimates
+from search import refresh_search_index
+from subscriptions import refresh_subscription_matches
+
+logger = logging.getLogger(__name__)
+
+CURRENT_MARKS_SQL = """
+    SELECT
+        COALESCE((SELECT MAX(id_licitacion) FROM dw.fact_licitacion), 0) as id_licitacion,
+        COALESCE((SELECT MAX(id_resultado_lote) FROM dw.fact_resultado_lote), 0) as id_resultado_lote,
+        COALESCE((SELECT MAX(id_carga) FROM dw.etl_licitacion_cargada), 0) as id_carga
+"""
+
+TOUCHED_SQL = """
+    SELECT id_licitacion FROM dw.fact_licitacion
+    WHERE id_licitacion > $1 AND id_licitacion <= $2
+    UNION
+    SELECT lot.id_licitacion
+    FROM dw.fact_resultado_lote r
+    INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+    WHERE r.id_resultado_lote > $3 AND r.id_resultado_lote <= $4
+    UNION
+    SELECT id_licitacion FROM dw.etl_licitacion_cargada
+    WHERE id_carga > $5 AND id_carga <= $6
+"""
+
+# Proceso ficticio cuya marca se escribe cuando han terminado todos los pasos
+REFRESH_DONE = "refresco_completo"
+
+SAVE_MARKS_SQL = """
+    INSERT INTO dw.etl_marca (proceso, id_licitacion, id_resultado_lote, id_carga, actualizado_en)
+    VALUES ($1, $2, $3, $4, now())
+    ON CONFLICT (proceso) DO UPDATE SET
+        id_licitacion = EXCLUDED.id_licitacion,
+        id_resultado_lote = EXCLUDED.id_resultado_lote,
+        id_carga = EXCLUDED.id_carga,
+        actualizado_en = EXCLUDED.actualizado_en
+"""
+
+# Clasificación del resultado de cada licitación (antes calculada en cada consulta
+# de la vista de desiertas con EXISTS y ILIKE por fila)
+TENDER_OUTCOME_SQL = """
+    INSERT INTO dw.licitacion_resultado (id_licitacion, fecha_limite_ofertas, adjudicada, resultado)
+    SELECT
+        l.id_licitacion,
+        l.fecha_limite_ofertas,
+        COALESCE(res.adjudicada, false),
+        CASE
+            WHEN res.adjudicada THEN 'Adjudicada'
+            WHEN l.estado ILIKE '%Anulad%' THEN 'Anulada'
+            WHEN l.estado ILIKE '%Desestim%' THEN 'Desestimada'
+            WHEN l.estado ILIKE '%Desiert%' THEN 'Declarada desierta'
+            WHEN l.num_licitadores_total = 0 THEN 'Sin ofertas presentadas'
+            WHEN res.desierta THEN 'Desierta'
+            WHEN res.inadmitida THEN 'Ofertas inadmitidas'
+            ELSE 'Sin adjudicar'
+        END
+    FROM dw.fact_licitacion l
+    LEFT JOIN LATERAL (
+        SELECT
+            bool_or(r.es_exito) as adjudicada,
+            bool_or(r.resultado ILIKE '%desiert%') as desierta,
+            bool_or(r.resultado ILIKE '%inadmit%') as inadmitida
+        FROM dw.fact_lote lot
+        INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
+        WHERE lot.id_licitacion = l.id_licitacion
+    ) res ON true
+    WHERE $1::bigint[] IS NULL OR l.id_licitacion = ANY($1)
+    ON CONFLICT (id_licitacion) DO UPDATE SET
+        fecha_limite_ofertas = EXCLUDED.fecha_limite_ofertas,
+        adjudicada = EXCLUDED.adjudicada,
+        resultado = EXCLUDED.resultado
+"""
+
+# Organismos de las licitaciones afectadas y aquellos de los que alguna se ha movido
+# (id_organo_anterior del diario), cuyos KPIs también han cambiado
+_KPI_ORGANISMS = """
+    SELECT id_organo FROM dw.fact_licitacion
+    WHERE $1::bigint[] IS NULL OR id_licitacion = ANY($1)
+    UNION
+    SELECT id_organo_anterior FROM dw.etl_licitacion_cargada
+    WHERE id_licitacion = ANY($1) AND id_organo_anterior IS NOT NULL
+"""
+
+ORGANISM_KPIS_DELETE_SQL = f"""
+    DELETE FROM dw.agg_organo_mes
+    WHERE $1::bigint[] IS NULL
+       OR id_organo IN (SELECT id_organo FROM ({_KPI_ORGANISMS}) organos)
+"""
+
+ORGANISM_KPIS_INSERT_SQL = f"""
+    WITH organos AS ({_KPI_ORGANISMS}),
+    licitaciones AS (
+        SELECT
+            l.id_organo,
+            date_trunc('month', l.fecha_publicacion)::date as mes,
+            l.presupuesto_base_con_iva as presupuesto,
+            lr.adjudicada,
+            CASE
+                WHEN l.presupuesto_base_con_iva > 0 AND res.con_importe
+                THEN (l.presupuesto_base_con_iva - res.importe_minimo) / l.presupuesto_base_con_iva * 100
+            END as baja
+        FROM dw.fact_licitacion l
+        INNER JOIN organos USING (id_organo)
+        INNER JOIN dw.licitacion_resultado lr ON lr.id_licitacion = l.id_licitacion
+        LEFT JOIN LATERAL (
+            SELECT
+                bool_or(r.es_exito AND r.importe_adjudicacion_con_iva > 0) as con_importe,
+                MIN(r.importe_adjudicacion_con_iva) FILTER (WHERE r.es_exito) as importe_minimo
+            FROM dw.fact_lote lot
+            INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
+            WHERE lot.id_licitacion = l.id_licitacion
+        ) res ON true
+    )
+    INSERT INTO dw.agg_organo_mes (
+        id_organo, mes, total_licitaciones, licitaciones_adjudicadas,
+        presupuesto_total, presupuesto_num,
+        baja_suma, baja_suma_cuadrados, baja_num, baja_min, baja_max
+    )
+    SELECT
+        id_organo,
+        mes,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE adjudicada),
+        COALESCE(SUM(presupuesto), 0),
+        COUNT(presupuesto),
+        COALESCE(SUM(baja), 0),
+        COALESCE(SUM(baja * baja), 0),
+        COUNT(baja),
+        MIN(baja),
+        MAX(baja)
+    FROM licitaciones
+    GROUP BY id_organo, mes
+"""
+
+# Clausura de la jerarquía de CPV para los códigos que aún no la tienen
+CPV_CLOSURE_SQL = """
+    WITH RECURSIVE nuevos AS (
+        SELECT c.codigo_cpv FROM dw.dim_cpv c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM dw.cpv_antecesor a WHERE a.codigo_cpv = c.codigo_cpv AND a.codigo_antecesor = c.codigo_cpv
+        )
+    ),
+    cadena AS (
+        SELECT codigo_cpv, codigo_cpv as codigo_antecesor, 0 as distancia FROM nuevos
+        UNION ALL
+        SELECT cadena.codigo_cpv, c.codigo_padre, cadena.distancia + 1
+        FROM cadena
+        INNER JOIN dw.dim_cpv c ON c.codigo_cpv = cadena.codigo_antecesor
+        WHERE c.codigo_padre IS NOT NULL AND cadena.distancia < 10
+    )
+    INSERT INTO dw.cpv_antecesor (codigo_cpv, codigo_antecesor, distancia)
+    SELECT codigo_cpv, codigo_antecesor, distancia FROM cadena
+    ON CONFLICT DO NOTHING
+"""
+
+_CPV_TOTALS = """
+    COUNT(*) as total_licitaciones,
+    SUM(num_lotes) as num_lotes,
+    SUM(presupuesto_suma) as presupuesto_suma,
+    SUM(presupuesto_num) as presupuesto_num,
+    SUM(baja_suma) as baja_suma,
+    SUM(baja_num) as baja_num,
+    SUM(licitadores_suma) as licitadores_suma,
+    SUM(licitadores_num) as licitadores_num
+"""
+
+# Restar de los totales lo que aportaban las licitaciones afectadas antes de recalcularlas
+CPV_SUBTRACT_SQL = f"""
+    UPDATE dw.agg_cpv a SET
+        total_licitaciones = a.total_licitaciones - s.total_licitaciones,
+        num_lotes = a.num_lotes - s.num_lotes,
+        presupuesto_suma = a.presupuesto_suma - s.presupuesto_suma,
+        presupuesto_num = a.presupuesto_num - s.presupuesto_num,
+        baja_suma = a.baja_suma - s.baja_suma,
+        baja_num = a.baja_num - s.baja_num,
+        licitadores_suma = a.licitadores_suma - s.licitadores_suma,
+        licitadores_num = a.licitadores_num - s.licitadores_num
+    FROM (
+        SELECT codigo_cpv, {_CPV_TOTALS}
+        FROM dw.cpv_licitacion
+        WHERE id_licitacion = ANY($1)
+        GROUP BY codigo_cpv
+    ) s
+    WHERE a.codigo_cpv = s.codigo_cpv
+"""
+
+# Cada lote cuenta una vez en cada código de su camino hasta la raíz, aunque tenga
+# varios CPV bajo el mismo antecesor
+CPV_CONTRIBUTIONS_SQL = """
+    WITH lotes AS (
+        SELECT DISTINCT a.codigo_antecesor as codigo_cpv, lot.id_licitacion, lot.id_lote, lot.importe_lote_con_iva
+        FROM dw.fact_lote lot
+        INNER JOIN dw.rel_lote_cpv rc ON rc.id_lote = lot.id_lote
+        INNER JOIN dw.cpv_antecesor a ON a.codigo_cpv = rc.codigo_cpv
+        WHERE $1::bigint[] IS NULL OR lot.id_licitacion = ANY($1)
+    ),
+    resultados AS (
+        SELECT
+            r.id_lote,
+            SUM(100.0 * (lot.importe_lote_con_iva - r.importe_adjudicacion_con_iva) / lot.importe_lote_con_iva)
+                FILTER (WHERE r.es_exito AND lot.importe_lote_con_iva > 0) as baja_suma,
+            COUNT(r.importe_adjudicacion_con_iva)
+                FILTER (WHERE r.es_exito AND lot.importe_lote_con_iva > 0) as baja_num,
+            SUM(r.numero_licitadores) as licitadores_suma,
+            COUNT(r.numero_licitadores) as licitadores_num
+        FROM dw.fact_resultado_lote r
+        INNER JOIN dw.fact_lote lot ON r.id_lote = lot.id_lote
+        WHERE $1::bigint[] IS NULL OR lot.id_licitacion = ANY($1)
+        GROUP BY r.id_lote
+    )
+    INSERT INTO dw.cpv_licitacion (
+        codigo_cpv, id_licitacion, num_lotes, presupuesto_suma, presupuesto_num,
+        baja_suma, baja_num, licitadores_suma, licitadores_num
+    )
+    SELECT
+        l.codigo_cpv,
+        l.id_licitacion,
+        COUNT(*),
+        COALESCE(SUM(l.importe_lote_con_iva), 0),
+        COUNT(l.importe_lote_con_iva),
+        COALESCE(SUM(res.baja_suma), 0),
+        COALESCE(SUM(res.baja_num), 0),
+        COALESCE(SUM(res.licitadores_suma), 0),
+        COALESCE(SUM(res.licitadores_num), 0)
+    FROM lotes l
+    LEFT JOIN resultados res ON res.id_lote = l.id_lote
+    GROUP BY l.codigo_cpv, l.id_licitacion
+"""
+
+CPV_ADD_SQL = f"""
+    INSERT INTO dw.agg_cpv (
+        codigo_cpv, total_licitaciones, num_lotes, presupuesto_suma, presupuesto_num,
+        baja_suma, baja_num, licitadores_suma, licitadores_num
+    )
+    SELECT codigo_cpv, {_CPV_TOTALS}
+    FROM dw.cpv_licitacion
+    WHERE $1::bigint[] IS NULL OR id_licitacion = ANY($1)
+    GROUP BY codigo_cpv
+    ON CONFLICT (codigo_cpv) DO UPDATE SET
+        total_licitaciones = dw.agg_cpv.total_licitaciones + EXCLUDED.total_licitaciones,
+        num_lotes = dw.agg_cpv.num_lotes + EXCLUDED.num_lotes,
+        presupuesto_suma = dw.agg_cpv.presupuesto_suma + EXCLUDED.presupuesto_suma,
+        presupuesto_num = dw.agg_cpv.presupuesto_num + EXCLUDED.presupuesto_num,
+        baja_suma = dw.agg_cpv.baja_suma + EXCLUDED.baja_suma,
+        baja_num = dw.agg_cpv.baja_num + EXCLUDED.baja_num,
+        licitadores_suma = dw.agg_cpv.licitadores_suma + EXCLUDED.licitadores_suma,
+        licitadores_num = dw.agg_cpv.licitadores_num + EXCLUDED.licitadores_num
+"""
+
+
+# Meses (según dim_tiempo) con licitaciones publicadas entre las afectadas, más los meses
+# en que se publicaron antes de cambiar de fecha (diario); el cubo de tendencias se
+# recalcula por mes completo
+_TREND_MONTHS = """
+    SELECT t.anio, t.mes
+    FROM dw.fact_licitacion l
+    INNER JOIN dw.dim_tiempo t ON t.id_fecha = l.id_fecha_publicacion
+    WHERE $1::bigint[] IS NULL OR l.id_licitacion = ANY($1)
+    UNION
+    SELECT t.anio, t.mes
+    FROM dw.etl_licitacion_cargada c
+    INNER JOIN dw.dim_tiempo t ON t.id_fecha = c.id_fecha_publicacion_anterior
+    WHERE c.id_licitacion = ANY($1) AND c.id_fecha_publicacion_anterior IS NOT NULL
+"""
+
+TRENDS_DELETE_SQL = f"""
+    DELETE FROM dw.agg_tendencia_mes
+    WHERE $1::bigint[] IS NULL
+       OR mes IN (SELECT make_date(anio, mes, 1) FROM ({_TREND_MONTHS}) meses)
+"""
+
+TRENDS_INSERT_SQL = f"""
+    WITH meses AS ({_TREND_MONTHS}),
+    licitaciones AS (
+        SELECT
+            l.id_organo,
+            COALESCE(LEFT(cpv.codigo_cpv, 2) || '000000', '') as division_cpv,
+            COALESCE(l.tipo_contrato, '') as tipo_contrato,
+            make_date(t.anio, t.mes, 1) as mes,
+            l.presupuesto_base_con_iva as presupuesto,
+            res.adjudicado,
+            CASE
+                WHEN l.presupuesto_base_con_iva > 0 AND res.con_importe
+                THEN (l.presupuesto_base_con_iva - res.importe_minimo) / l.presupuesto_base_con_iva * 100
+            END as baja,
+            l.num_licitadores_total as licitadores
+        FROM meses
+        INNER JOIN dw.dim_tiempo t ON t.anio = meses.anio AND t.mes = meses.mes
+        INNER JOIN dw.fact_licitacion l ON l.id_fecha_publicacion = t.id_fecha
+        LEFT JOIN LATERAL (
+            SELECT rc.codigo_cpv FROM dw.rel_licitacion_cpv rc
+            WHERE rc.id_licitacion = l.id_licitacion
+            ORDER BY rc.es_principal DESC NULLS LAST, rc.codigo_cpv
+            LIMIT 1
+        ) cpv ON true
+        LEFT JOIN LATERAL (
+            SELECT
+                SUM(r.importe_adjudicacion_con_iva) FILTER (WHERE r.es_exito) as adjudicado,
+                bool_or(r.es_exito AND r.importe_adjudicacion_con_iva > 0) as con_importe,
+                MIN(r.importe_adjudicacion_con_iva) FILTER (WHERE r.es_exito) as importe_minimo
+            FROM dw.fact_lote lot
+            INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
+            WHERE lot.id_licitacion = l.id_licitacion
+        ) res ON true
+    )
+    INSERT INTO dw.agg_tendencia_mes (
+        id_organo, division_cpv, tipo_contrato, mes, total_licitaciones,
+        presupuesto_total, adjudicado_total, licitaciones_adjudicadas,
+        baja_suma, baja_num, licitadores_suma, licitadores_num
+    )
+    SELECT
+        id_organo,
+        division_cpv,
+        tipo_contrato,
+        mes,
+        COUNT(*),
+        COALESCE(SUM(presupuesto), 0),
+        COALESCE(SUM(adjudicado), 0),
+        COUNT(adjudicado),
+        COALESCE(SUM(baja), 0),
+        COUNT(baja),
+        COALESCE(SUM(licitadores), 0),
+        COUNT(licitadores)
+    FROM licitaciones
+    GROUP BY id_organo, division_cpv, tipo_contrato, mes
+"""
+
+async def pending_licitaciones(conn: asyncpg.Connection, proceso: str, full: bool = False):
+    """Devolver las licitaciones afectadas desde el último refresco del proceso.
+
+    Devuelve (ids, marcas); ids es None cuando hay que recalcular todo
+    (primera ejecución o --full).
+    """
+    current = await conn.fetchrow(CURRENT_MARKS_SQL)
+    marks = (current["id_licitacion"], current["id_resultado_lote"], current["id_carga"])
+    previous = await conn.fetchrow(
+        "SELECT id_licitacion, id_resultado_lote, id_carga FROM dw.etl_marca WHERE proceso = $1",
+        proceso
+    )
+    if full or previous is None:
+        return None, marks
+    rows = await conn.fetch(
+        TOUCHED_SQL,
+        previous["id_licitacion"], marks[0],
+        previous["id_resultado_lote"], marks[1],
+        previous["id_carga"], marks[2]
+    )
+    return [row["id_licitacion"] for row in rows], marks
+
+
+async def refresh_tender_outcomes(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Reclasificar el resultado de las licitaciones afectadas"""
+    await conn.execute(TENDER_OUTCOME_SQL, licitaciones)
+
+
+async def refresh_organism_kpis(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Recalcular los KPIs mensuales de los organismos con licitaciones afectadas (o que las tenían)"""
+    await conn.execute(ORGANISM_KPIS_DELETE_SQL, licitaciones)
+    await conn.execute(ORGANISM_KPIS_INSERT_SQL, licitaciones)
+
+
+async def refresh_cpv_indicators(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Actualizar los indicadores de los códigos CPV (y sus antecesores) de las licitaciones afectadas"""
+    await conn.execute(CPV_CLOSURE_SQL)
+    if licitaciones is None:
+        await conn.execute("TRUNCATE dw.cpv_licitacion, dw.agg_cpv")
+    else:
+        await conn.execute(CPV_SUBTRACT_SQL, licitaciones)
+        await conn.execute("DELETE FROM dw.cpv_licitacion WHERE id_licitacion = ANY($1)", licitaciones)
+    await conn.execute(CPV_CONTRIBUTIONS_SQL, licitaciones)
+    await conn.execute(CPV_ADD_SQL, licitaciones)
+
+
+async def refresh_trends(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Recalcular el cubo de tendencias en los meses de publicación (actuales y previos) de las afectadas"""
+    await conn.execute(TRENDS_DELETE_SQL, licitaciones)
+    await conn.execute(TRENDS_INSERT_SQL, licitaciones)
+
+
+# Procesos de refresco en orden de ejecución (los KPIs usan la clasificación de resultados)
+REFRESH_STEPS = [
+    ("resultado_licitaciones", refresh_tender_outcomes),
+    ("kpi_organos", refresh_organism_kpis),
+    ("indicadores_cpv", refresh_cpv_indicators),
+    ("tendencias", refresh_trends),
+    ("estimaciones", refresh_award_estimates),
+    ("grupos_empresariales", refresh_company_groups),
+    ("clusters_licitaciones", refresh_tender_clusters),
+    ("busqueda_adjudicatarios", refresh_search_index),
+    ("suscripciones", refresh_subscription_matches),
+]
+
+
+async def run_refresh(conn: asyncpg.Connection, full: bool = False):
+    """Ejecutar todos los procesos de refresco, cada uno en su propia transacción.
+
+    Al terminar guarda la marca REFRESH_DONE con lo que han procesado todos los pasos
+    (las del primero: los siguientes ven como mínimo las mismas filas); la caché y los
+    ETag se invalidan con ella, no con las tablas de hechos.
+    """
+    done = None
+    for proceso, step in REFRESH_STEPS:
+        async with conn.transaction():
+            licitaciones, marks = await pending_licitaciones(conn, proceso, full)
+            if licitaciones is None or licitaciones:
+                await step(conn, licitaciones)
+            await conn.execute(SAVE_MARKS_SQL, proceso, *marks)
+        done = done or marks
+        affected = "all" if licitaciones is None else len(licitaciones)
+        logger.info("refreshed", extra={"proceso": proceso, "tenders": affected})
+    await conn.execute(SAVE_MARKS_SQL, REFRESH_DONE, *done)
+
+
+async def main():
+    metrics.configure_logging()
+    parser = argparse.ArgumentParser(description="Refrescar tablas precalculadas")
+    parser.add_argument("--full", action="store_true", help="recalcular todo desde cero")
+    args = parser.parse_args()
+    conn = await asyncpg.connect(**db.DB_CONFIG)
+    try:
+        await run_refresh(conn, full=args.full)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
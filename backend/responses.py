@@ -0,0 +1,145 @@
+"""Serialización y entrega de respuestas: JSON con orjson, compresión y ETag por marca de agua."""
+import hashlib
+from datetime import date
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+import orjson
+from fastapi.responses import JSONResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import cache
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # brotli es opcional: sin él sólo se comprime con gzip
+    BrotliMiddleware = None
+
+# Respuestas más pequeñas no compensan el coste de comprimir
+COMPRESS_MIN_SIZE = 1024
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(value: Any):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def dumps(value: Any) -> bytes:
+    """Serializar a JSON; fechas, datetimes y arrays de NumPy de forma nativa, Decimal como número"""
+    return orjson.dumps(value, default=_default, option=_OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializada con orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> FastJSONResponse:
+    """Devolver content sin pasar por jsonable_encoder de FastAPI (que recorre cada valor en Python)"""
+    return FastJSONResponse(content, headers=headers)
+
+
+def columnar(columns: List[str], rows: List[tuple]) -> dict:
+    """Formato por columnas: los nombres una sola vez y cada fila como array"""
+    return {"columns": columns, "rows": rows}
+
+
+def columnar_from_dicts(rows: List[dict]) -> dict:
+    return columnar(list(rows[0]) if rows else [], [tuple(row.values()) for row in rows])
+
+
+class CompressionMiddleware:
+    """Brotli o gzip según Accept-Encoding (brotli sólo si está instalado brotli-asgi).
+
+    Los flujos Server-Sent Events no se comprimen: el compresor retendría los
+    eventos hasta llenar su búfer. Tampoco los resultados de los informes (jobs.py),
+    que ya están comprimidos y se sirven por rangos de bytes.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and not _is_event_stream(scope) and not _is_precompressed(scope):
+            await self.compressed(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+def _is_event_stream(scope: Scope) -> bool:
+    accept = dict(scope["headers"]).get(b"accept", b"")
+    return b"text/event-stream" in accept or scope["path"].endswith("/stream")
+
+
+def _is_precompressed(scope: Scope) -> bool:
+    return scope["path"].startswith("/api/jobs/") and scope["path"].endswith("/result")
+
+
+def _encoding(scope: Scope) -> str:
+    """Codificación que elegirá CompressionMiddleware (forma parte de la representación)"""
+    accept = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+    if BrotliMiddleware is not None and "br" in accept:
+        return "br"
+    return "gzip" if "gzip" in accept else "identity"
+
+
+class ETagMiddleware:
+    """ETag fuerte para los GET de las rutas indicadas, derivado de la marca de agua.
+
+    La marca es la que guarda refresh.py al terminar (ver cache.WATERMARK_SQL), así
+    que no cambia mientras una carga está a medio refrescar. Hasta el siguiente
+    refresco completo (o el cambio de día, del que dependen los filtros por plazo)
+    la misma URL devuelve los mismos datos: si el cliente envía If-None-Match con
+    la etiqueta vigente se responde 304 sin ejecutar nada.
+    """
+
+    def __init__(self, app: ASGIApp, routes: set):
+        self.app = app
+        self.routes = routes
+
+    def _route_path(self, scope: Scope) -> Optional[str]:
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", None)
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET" or self._route_path(scope) not in self.routes:
+            await self.app(scope, receive, send)
+            return
+        watermark = await cache.current_watermark()
+        key = "|".join((
+            watermark, date.today().isoformat(), scope["path"],
+            scope["query_string"].decode("latin-1"), _encoding(scope),
+        ))
+        etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:24] + '"'
+        headers = dict(scope["headers"])
+        if etag in headers.get(b"if-none-match", b"").decode("latin-1"):
+            await send({
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [(b"etag", etag.encode()), (b"cache-control", b"no-cache")],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"etag", etag.encode()), (b"cache-control", b"no-cache")
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
@@ -0,0 +1,78 @@
+"""Mantenimiento del índice de búsqueda de adjudicatarios (dw.busqueda_adjudicatario)."""
+from typing import List, Optional
+
+import asyncpg
+
+from normalize import normalize_name, normalize_nif
+
+BATCH_SIZE = 5000
+
+# Adjudicatarios con resultados en las licitaciones afectadas, más los dados de alta
+# después del último refresco. $1 NULL = todos.
+SEARCH_COMPANIES_SQL = """
+    WITH afectados AS (
+        SELECT DISTINCT r.id_adjudicatario
+        FROM dw.fact_lote lot
+        INNER JOIN dw.fact_resultado_lote r ON lot.id_lote = r.id_lote
+        WHERE lot.id_licitacion = ANY($1)
+        UNION
+        SELECT id_adjudicatario FROM dw.dim_adjudicatario
+        WHERE id_adjudicatario > (
+            SELECT COALESCE(MAX(id_adjudicatario), 0) FROM dw.busqueda_adjudicatario
+        )
+    )
+    SELECT
+        a.id_adjudicatario,
+        a.nombre,
+        a.nif,
+        COALESCE(a.es_pyme, false) as es_pyme,
+        a.provincia,
+        COALESCE(t.total_wins, 0) as total_wins,
+        COALESCE(t.total_amount, 0) as total_amount
+    FROM dw.dim_adjudicatario a
+    LEFT JOIN LATERAL (
+        SELECT
+            COUNT(*) as total_wins,
+            SUM(r.importe_adjudicacion_con_iva) as total_amount
+        FROM dw.fact_resultado_lote r
+        WHERE r.id_adjudicatario = a.id_adjudicatario AND r.es_exito = true
+    ) t ON true
+    WHERE $1::bigint[] IS NULL OR a.id_adjudicatario IN (SELECT id_adjudicatario FROM afectados)
+"""
+
+SEARCH_UPSERT_SQL = """
+    INSERT INTO dw.busqueda_adjudicatario
+    SELECT * FROM tmp_busqueda_adjudicatario
+    ON CONFLICT (id_adjudicatario) DO UPDATE SET
+        nombre = EXCLUDED.nombre,
+        nif = EXCLUDED.nif,
+        es_pyme = EXCLUDED.es_pyme,
+        provincia = EXCLUDED.provincia,
+        nombre_normalizado = EXCLUDED.nombre_normalizado,
+        nif_normalizado = EXCLUDED.nif_normalizado,
+        total_wins = EXCLUDED.total_wins,
+        total_amount = EXCLUDED.total_amount
+"""
+
+
+async def refresh_search_index(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Actualizar nombre normalizado y totales de los adjudicatarios afectados"""
+    await conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_busqueda_adjudicatario
+        (LIKE dw.busqueda_adjudicatario) ON COMMIT DELETE ROWS
+    """)
+    cursor = conn.cursor(SEARCH_COMPANIES_SQL, licitaciones, prefetch=BATCH_SIZE)
+    batch = []
+    async for row in cursor:
+        batch.append((
+            row["id_adjudicatario"], row["nombre"], row["nif"], row["es_pyme"], row["provincia"],
+            normalize_name(row["nombre"]), normalize_nif(row["nif"]),
+            row["total_wins"], row["total_amount"]
+        ))
+        if len(batch) >= BATCH_SIZE:
+            await conn.copy_records_to_table("tmp_busqueda_adjudicatario", records=batch)
+            batch = []
+    if batch:
+        await conn.copy_records_to_table("tmp_busqueda_adjudicatario", records=batch)
+    await conn.execute(SEARCH_UPSERT_SQL)
+    await conn.execute("TRUNCATE tmp_busqueda_adjudicatario")
@@ -0,0 +1,319 @@
+"""Suscripciones a licitaciones nuevas: evaluación en lote y entrega de coincidencias.
+
+Cada refresco evalúa las licitaciones afectadas (sólo las que siguen abiertas)
+contra todas las suscripciones activas en una única sentencia: los CPV de la
+licitación se amplían con sus antecesores en dim_cpv y se cruzan con los índices
+GIN de la suscripción; presupuesto y plazo se comprueban con índices GiST sobre
+rangos. El coste depende de suscripciones × licitaciones nuevas, no del tamaño
+de la tabla de hechos.
+
+Las coincidencias se guardan en dw.suscripcion_coincidencia (buzón consultable)
+y se anuncian con NOTIFY; MatchBroker las reparte a los clientes SSE conectados.
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import asyncpg
+
+import db
+
+NOTIFY_CHANNEL = "licitamonitor_coincidencias"
+# Segundos sin coincidencias tras los que se envía un comentario para mantener viva la conexión
+KEEPALIVE_SECONDS = 15
+RECONNECT_SECONDS = 5
+# Coincidencias pendientes por cliente; si se llena, el cliente vuelve a leer del buzón
+QUEUE_SIZE = 1000
+INBOX_PAGE_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+# $1 licitaciones a evaluar (NULL = todas las abiertas), $2 suscripción (NULL = todas).
+# Abiertas = con plazo de ofertas no vencido, como en /api/tenders/active (sin plazo no cuentan).
+# Devuelve el id de la última coincidencia nueva (NULL si no hay ninguna).
+MATCH_SQL = """
+    WITH RECURSIVE nuevas AS (
+        SELECT
+            l.id_licitacion,
+            l.id_organo,
+            COALESCE(o.provincia, '') as provincia,
+            COALESCE(l.presupuesto_base_con_iva, l.presupuesto_base_sin_iva, l.valor_estimado) as presupuesto,
+            l.dias_para_ofertar
+        FROM dw.fact_licitacion l
+        INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
+        WHERE l.fecha_limite_ofertas >= CURRENT_DATE
+          AND ($1::bigint[] IS NULL OR l.id_licitacion = ANY($1))
+    ),
+    cpv AS (
+        SELECT r.id_licitacion, r.codigo_cpv
+        FROM dw.rel_licitacion_cpv r
+        INNER JOIN nuevas n ON r.id_licitacion = n.id_licitacion
+        UNION
+        SELECT cpv.id_licitacion, c.codigo_padre
+        FROM cpv
+        INNER JOIN dw.dim_cpv c ON c.codigo_cpv = cpv.codigo_cpv
+        WHERE c.codigo_padre IS NOT NULL
+    ),
+    candidatas AS (
+        SELECT
+            n.*,
+            ARRAY(SELECT cpv.codigo_cpv FROM cpv WHERE cpv.id_licitacion = n.id_licitacion)
+                || '*'::varchar as cpvs
+        FROM nuevas n
+    ),
+    insertadas AS (
+        INSERT INTO dw.suscripcion_coincidencia (id_suscripcion, id_licitacion)
+        SELECT s.id_suscripcion, c.id_licitacion
+        FROM candidatas c
+        INNER JOIN dw.suscripcion s
+            ON s.cpvs && c.cpvs::varchar(9)[]
+           AND s.organos && ARRAY[c.id_organo, 0]
+           AND s.provincias && ARRAY[c.provincia, '*']::varchar(100)[]
+           AND (s.presupuesto @> c.presupuesto OR s.presupuesto = '(,)'::numrange)
+           AND (s.plazo @> c.dias_para_ofertar OR s.plazo = '(,)'::int4range)
+        WHERE s.activa
+          AND ($2::bigint IS NULL OR s.id_suscripcion = $2)
+        ORDER BY c.id_licitacion, s.id_suscripcion
+        ON CONFLICT (id_suscripcion, id_licitacion) DO NOTHING
+        RETURNING id_coincidencia
+    )
+    SELECT MAX(id_coincidencia) FROM insertadas
+"""
+
+# Coincidencias con el resumen de la licitación, en orden de llegada
+_MATCH_COLUMNS = """
+    SELECT
+        c.id_coincidencia as id,
+        c.id_suscripcion as "subscriptionId",
+        c.creada_en as "matchedAt",
+        l.id_licitacion as "tenderId",
+        l.objeto_contrato as title,
+        o.nombre as organism,
+        o.provincia,
+        COALESCE(l.presupuesto_base_con_iva, l.presupuesto_base_sin_iva, l.valor_estimado) as budget,
+        l.fecha_limite_ofertas as deadline,
+        l.url_expediente as url
+    FROM dw.suscripcion_coincidencia c
+    INNER JOIN dw.fact_licitacion l ON c.id_licitacion = l.id_licitacion
+    INNER JOIN dw.dim_organo o ON l.id_organo = o.id_organo
+"""
+
+INBOX_SQL = db.prepared("subscription_inbox", _MATCH_COLUMNS + """
+    WHERE c.id_suscripcion = $1 AND c.id_coincidencia > $2
+    ORDER BY c.id_coincidencia
+    LIMIT $3
+""")
+
+NEW_MATCHES_SQL = db.prepared("subscription_new_matches", _MATCH_COLUMNS + """
+    WHERE c.id_coincidencia > $1 AND c.id_suscripcion = ANY($2::bigint[])
+    ORDER BY c.id_coincidencia
+""")
+
+_SUBSCRIPTION_COLUMNS = """
+    id_suscripcion, nombre, email, cpvs, organos, provincias, presupuesto, plazo, activa, creada_en
+"""
+
+SUBSCRIPTIONS_SQL = db.prepared("subscriptions_list", f"""
+    SELECT {_SUBSCRIPTION_COLUMNS} FROM dw.suscripcion ORDER BY id_suscripcion
+""")
+
+SUBSCRIPTION_SQL = db.prepared("subscription_get", f"""
+    SELECT {_SUBSCRIPTION_COLUMNS} FROM dw.suscripcion WHERE id_suscripcion = $1
+""")
+
+CREATE_SUBSCRIPTION_SQL = db.prepared("subscription_create", f"""
+    INSERT INTO dw.suscripcion (nombre, email, cpvs, organos, provincias, presupuesto, plazo, activa)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+    RETURNING {_SUBSCRIPTION_COLUMNS}
+""")
+
+UPDATE_SUBSCRIPTION_SQL = db.prepared("subscription_update", f"""
+    UPDATE dw.suscripcion
+    SET nombre = $2, email = $3, cpvs = $4, organos = $5, provincias = $6, presupuesto = $7, plazo = $8, activa = $9
+    WHERE id_suscripcion = $1
+    RETURNING {_SUBSCRIPTION_COLUMNS}
+""")
+
+DELETE_SUBSCRIPTION_SQL = db.prepared(
+    "subscription_delete", "DELETE FROM dw.suscripcion WHERE id_suscripcion = $1 RETURNING id_suscripcion"
+)
+
+LAST_MATCH_SQL = db.prepared(
+    "subscription_last_match", "SELECT COALESCE(MAX(id_coincidencia), 0) FROM dw.suscripcion_coincidencia"
+)
+
+
+def _range(lower, upper) -> asyncpg.Range:
+    """Rango cerrado [lower, upper]; None = sin límite"""
+    return asyncpg.Range(lower, upper, lower_inc=lower is not None, upper_inc=upper is not None)
+
+
+def _bounds(value: asyncpg.Range, step=None):
+    """Límites inclusivos de un rango (step=1 para rangos discretos, que se guardan como [a, b))"""
+    lower = None if value.lower_inf else value.lower
+    upper = None if value.upper_inf else value.upper
+    if upper is not None and step is not None and not value.upper_inc:
+        upper -= step
+    return lower, upper
+
+
+def subscription_params(data: dict) -> tuple:
+    """Parámetros de inserción/actualización a partir de los campos de la API"""
+    return (
+        data["name"],
+        data.get("email"),
+        data.get("cpvs") or ["*"],
+        data.get("organisms") or [0],
+        data.get("provinces") or ["*"],
+        _range(data.get("budget_min"), data.get("budget_max")),
+        _range(data.get("deadline_days_min"), data.get("deadline_days_max")),
+        data.get("active", True),
+    )
+
+
+def subscription_out(row: dict) -> dict:
+    """Fila de dw.suscripcion en el formato de la API"""
+    budget_min, budget_max = _bounds(row["presupuesto"])
+    days_min, days_max = _bounds(row["plazo"], step=1)
+    return {
+        "id": row["id_suscripcion"],
+        "name": row["nombre"],
+        "email": row["email"],
+        "cpvs": [code for code in row["cpvs"] if code != "*"],
+        "organisms": [organo for organo in row["organos"] if organo != 0],
+        "provinces": [provincia for provincia in row["provincias"] if provincia != "*"],
+        "budget_min": budget_min,
+        "budget_max": budget_max,
+        "deadline_days_min": days_min,
+        "deadline_days_max": days_max,
+        "active": row["activa"],
+        "created_at": row["creada_en"],
+    }
+
+
+async def match_subscriptions(conn: asyncpg.Connection, licitaciones: Optional[List[int]],
+                              suscripcion: Optional[int] = None) -> Optional[int]:
+    """Guardar las coincidencias nuevas y anunciarlas (NOTIFY se entrega al confirmar la transacción)"""
+    last = await conn.fetchval(MATCH_SQL, licitaciones, suscripcion)
+    if last is not None:
+        await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, str(last))
+    return last
+
+
+async def refresh_subscription_matches(conn: asyncpg.Connection, licitaciones: Optional[List[int]]):
+    """Evaluar las licitaciones afectadas contra todas las suscripciones activas"""
+    await match_subscriptions(conn, licitaciones)
+
+
+class _Listener:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.lagged = False
+
+
+class MatchBroker:
+    """Reparte las coincidencias anunciadas por NOTIFY a los clientes conectados.
+
+    Una única conexión escucha el canal y, por cada aviso, una única consulta
+    trae las coincidencias nuevas de las suscripciones con clientes conectados.
+    """
+
+    def __init__(self):
+        self._conn: Optional[asyncpg.Connection] = None
+        self._listeners: Dict[int, Set[_Listener]] = {}
+        self._last = 0
+        self._lock = asyncio.Lock()
+        self._tasks: set = set()
+        self._closing = False
+
+    async def start(self):
+        self._closing = False
+        try:
+            self._last = await db.fetchval(LAST_MATCH_SQL)
+            self._conn = await asyncpg.connect(**db.DB_CONFIG)
+            self._conn.add_termination_listener(self._on_terminate)
+            await self._conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.warning("subscription listener not available", extra={"error": str(e)})
+            self._conn = None
+            self._spawn(self._reconnect())
+
+    async def stop(self):
+        self._closing = True
+        for task in list(self._tasks):
+            task.cancel()
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _on_terminate(self, conn):
+        if not self._closing:
+            logger.warning("subscription listener connection lost")
+            self._spawn(self._reconnect())
+
+    async def _reconnect(self):
+        await asyncio.sleep(RECONNECT_SECONDS)
+        if not self._closing:
+            await self.start()
+            # Lo que haya llegado mientras tanto
+            await self._dispatch(None)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self._spawn(self._dispatch(int(payload)))
+
+    async def _dispatch(self, announced: Optional[int]):
+        async with self._lock:
+            if announced is not None and announced <= self._last:
+                return
+            if self._listeners:
+                rows = await db.fetch(NEW_MATCHES_SQL, self._last, list(self._listeners))
+                for row in rows:
+                    for listener in self._listeners.get(row["subscriptionId"], ()):
+                        try:
+                            listener.queue.put_nowait(row)
+                        except asyncio.QueueFull:
+                            listener.lagged = True
+                    self._last = max(self._last, row["id"])
+            if announced is not None:
+                self._last = max(self._last, announced)
+
+    async def stream(self, id_suscripcion: int, after: int) -> AsyncIterator[Optional[dict]]:
+        """Coincidencias de una suscripción posteriores a after; None cada KEEPALIVE_SECONDS sin novedades"""
+        listener = _Listener()
+        self._listeners.setdefault(id_suscripcion, set()).add(listener)
+        try:
+            catch_up = True
+            while True:
+                if catch_up or listener.lagged:
+                    # Pendientes del buzón (al conectar o si el cliente se ha quedado atrás)
+                    listener.lagged = False
+                    while True:
+                        rows = await db.fetch(INBOX_SQL, id_suscripcion, after, INBOX_PAGE_SIZE)
+                        for row in rows:
+                            after = row["id"]
+                            yield row
+                        if len(rows) < INBOX_PAGE_SIZE:
+                            break
+                    catch_up = False
+                try:
+                    row = await asyncio.wait_for(listener.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if row["id"] > after:
+                    after = row["id"]
+                    yield row
+        finally:
+            listeners = self._listeners.get(id_suscripcion)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[id_suscripcion]
+
+
+match_broker = MatchBroker()
@@ -0,0 +1,9 @@
+"""Pruebas de las funciones puras del backend (no necesitan base de datos).
+
+Uso: cd backend && python -m pytest -q
+"""
+import sys
+from pathlib import Path
+
+# Los módulos del backend se importan como de primer nivel (import db, import jobs...)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
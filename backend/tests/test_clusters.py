@@ -0,0 +1,78 @@
+import random
+from datetime import date, timedelta
+
+from clusters import CLUSTER_GAP_DAYS, CLUSTER_SIMILARITY, DEFAULT_DURATION_DAYS, cluster_tenders
+from normalize import normalize_title
+
+
+def _brute_force(tenders):
+    """cluster_tenders comparando cada licitación con todos los grupos (sin prefix filtering)"""
+    clusters, assigned = [], []
+    gap = timedelta(days=CLUSTER_GAP_DAYS)
+    for id_licitacion, published, duration, objeto in tenders:
+        title = normalize_title(objeto)
+        words = set(title.split())
+        end = published + timedelta(days=duration if duration and duration > 0 else DEFAULT_DURATION_DAYS)
+        best, best_score = None, CLUSTER_SIMILARITY
+        for cluster in clusters:
+            if cluster[2] + gap < published:
+                continue
+            score = len(words & cluster[1]) / len(words | cluster[1])
+            if score >= best_score:
+                best, best_score = cluster, score
+        if best is None:
+            best = [id_licitacion, words, end]
+            clusters.append(best)
+        elif end > best[2]:
+            best[2] = end
+        assigned.append((id_licitacion, best[0], title))
+    return assigned
+
+
+def test_recurring_contract_joins_first_tender():
+    result = cluster_tenders([
+        (1, date(2022, 1, 10), 365, "Suministro de gasóleo 2022 - Lote 1"),
+        (2, date(2022, 2, 1), 90, "Servicio de limpieza de edificios municipales"),
+        (3, date(2023, 1, 5), 365, "SUMINISTRO GASOLEO (2023)"),
+    ])
+    assert result == [
+        (1, 1, "suministro gasoleo"),
+        (2, 2, "servicio limpieza edificios municipales"),
+        (3, 1, "suministro gasoleo"),
+    ]
+
+
+def test_gap_after_period_starts_new_cluster():
+    first = date(2020, 1, 1)
+    late = first + timedelta(days=30 + CLUSTER_GAP_DAYS + 1)
+    result = cluster_tenders([
+        (1, first, 30, "Mantenimiento de ascensores"),
+        (2, late, 30, "Mantenimiento de ascensores"),
+    ])
+    assert [cluster for _, cluster, _ in result] == [1, 2]
+
+
+def test_tender_without_duration_uses_default_period():
+    first = date(2020, 1, 1)
+    within = first + timedelta(days=DEFAULT_DURATION_DAYS + CLUSTER_GAP_DAYS)
+    result = cluster_tenders([
+        (1, first, None, "Mantenimiento de ascensores"),
+        (2, within, 0, "Mantenimiento de ascensores"),
+    ])
+    assert [cluster for _, cluster, _ in result] == [1, 1]
+
+
+def test_prefix_filtering_matches_brute_force():
+    rng = random.Random(7)
+    vocabulary = ["limpieza", "edificios", "municipales", "suministro", "gasoleo", "mantenimiento",
+                  "ascensores", "vigilancia", "seguridad", "alumbrado", "publico", "obras", "reforma",
+                  "colegio", "piscina", "jardineria", "parques", "transporte", "escolar", "comedor"]
+    tenders = []
+    published = date(2015, 1, 1)
+    for id_licitacion in range(1, 600):
+        published += timedelta(days=rng.randint(0, 20))
+        base = rng.sample(vocabulary[:8], 4) if rng.random() < 0.6 else rng.sample(vocabulary, rng.randint(1, 6))
+        if rng.random() < 0.3:
+            base[rng.randrange(len(base))] = rng.choice(vocabulary)
+        tenders.append((id_licitacion, published, rng.choice([None, 30, 365, 730]), " de ".join(base)))
+    assert cluster_tenders(tenders) == _brute_force(tenders)
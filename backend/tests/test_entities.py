@@ -0,0 +1,80 @@
+import pytest
+
+from entities import UnionFind, _one_edit, company, name_similarity, score
+
+
+@pytest.mark.parametrize("a, b", [
+    ("construcciones", "construciones"),   # omisión
+    ("construcciones", "construccciones"),  # inserción
+    ("construcciones", "construcziones"),  # sustitución
+    ("construcciones", "construcicones"),  # transposición
+    ("gomez", "gomes"),
+])
+def test_one_edit_accepts_single_typo(a, b):
+    assert _one_edit(a, b)
+    assert _one_edit(b, a)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("construcciones", "construcioens"),  # dos erratas
+    ("construcciones", "constructora"),
+    ("perez", "lopez"),
+    ("gomez", "gomezzz"),                 # difieren en más de un carácter de longitud
+    ("sanz", "sans"),                     # demasiado cortas para admitir erratas
+    ("servicios", "erviciosx"),           # ni principio ni final en común
+])
+def test_one_edit_rejects(a, b):
+    assert not _one_edit(a, b)
+
+
+def test_name_similarity_is_jaccard_with_typos():
+    assert name_similarity(("construcciones", "perez"), ("construcciones", "perez")) == 1.0
+    assert name_similarity(("construcciones", "perez"), ("construciones", "perez")) == 1.0
+    assert name_similarity(("construcciones", "perez"), ("construcciones", "lopez")) == pytest.approx(1 / 3)
+    assert name_similarity(("obras", "gomez", "hermanos"), ("obras", "gomez")) == pytest.approx(2 / 3)
+
+
+def test_name_similarity_matches_each_token_once():
+    # Las dos "construciones" no pueden emparejarse con la misma palabra
+    assert name_similarity(("construciones", "construcciones"), ("construcciones", "madrid")) == pytest.approx(1 / 3)
+
+
+def test_company_strips_legal_suffix_and_builds_keys():
+    item = company(1, "Construcciones Pérez, S.L.", "b-12345678")
+    assert item.tokens == ("construcciones", "perez")
+    assert item.nif == "B12345678"
+    assert not item.es_ute
+    assert item.keys == {"tok:construcciones", "tok:perez", "par:construcciones perez", "nif:B1234567"}
+
+
+def test_company_ute_keys_are_separate():
+    item = company(2, "UTE Construcciones Pérez - Obras Gómez", None)
+    assert item.es_ute
+    assert "ute" not in item.tokens
+    assert all(key.startswith("ute:") for key in item.keys)
+
+
+def test_score_rules():
+    same_nif = score(company(1, "Construcciones Pérez SL", "B12345678"), company(2, "Otra cosa SA", "B12345678"))
+    other_nif = score(company(1, "Construcciones Pérez SL", "B12345678"), company(2, "Construcciones Pérez", "A87654321"))
+    control = score(company(1, "Construcciones Pérez SL", "B12345678"), company(2, "Construcciones Perez", "B1234567X"))
+    ute = score(company(1, "Construcciones Pérez SL", None), company(2, "UTE Construcciones Pérez", None))
+    assert (same_nif, other_nif, control, ute) == (1.0, 0.0, 1.0, 0.0)
+
+
+def test_union_find_root_is_smallest_id():
+    groups = UnionFind()
+    groups.union(5, 3)
+    groups.union(9, 7)
+    assert groups.find(5) == 3 and groups.find(9) == 7
+    groups.union(9, 5)
+    assert {item: groups.find(item) for item in (3, 5, 7, 9)} == {3: 3, 5: 3, 7: 3, 9: 3}
+    assert groups.find(42) == 42
+
+
+def test_union_find_compresses_paths():
+    groups = UnionFind()
+    for item in range(100, 0, -1):
+        groups.union(item, item - 1)
+    assert groups.find(100) == 0
+    assert groups.parent[100] == 0
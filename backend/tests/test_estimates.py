@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+import pytest
+
+from estimates import QUANTILES, Estimator
+
+ANCESTORS = [
+    ("45000000", "45000000", 0),
+    ("45200000", "45200000", 0), ("45200000", "45000000", 1),
+    ("45210000", "45210000", 0), ("45210000", "45200000", 1), ("45210000", "45000000", 2),
+]
+
+
+def _history(rng: random.Random, rows: int) -> list:
+    return [
+        (rng.choice(["45000000", "45200000", "45210000", ""]), rng.randint(1, 4), rng.choice(["abierto", "negociado"]),
+         round(rng.uniform(-20, 60), 2))
+        for _ in range(rows)
+    ]
+
+
+def test_quantiles_match_numpy_for_every_group():
+    estimator = Estimator(_history(random.Random(3), 500), ANCESTORS, min_samples=1)
+    groups = np.arange(len(estimator.keys))
+    result = estimator.quantiles(groups)
+    assert result.shape == (len(groups), 3)
+    for group in groups:
+        start, count = estimator.starts[group], estimator.counts[group]
+        values = estimator.values[start:start + count]
+        np.testing.assert_allclose(result[group], np.quantile(values, QUANTILES))
+
+
+def test_quantiles_of_single_sample_group():
+    estimator = Estimator([("45000000", 1, "abierto", 12.5)], ANCESTORS, min_samples=1)
+    np.testing.assert_allclose(estimator.quantiles(np.arange(len(estimator.keys))), 12.5)
+
+
+def test_quantiles_interpolate_linearly():
+    history = [("45000000", 1, "abierto", baja) for baja in (40.0, 10.0, 30.0, 20.0)]
+    estimator = Estimator(history, ANCESTORS, min_samples=1)
+    # Todas las claves tienen las mismas cuatro bajas
+    groups = np.arange(len(estimator.keys))
+    np.testing.assert_allclose(estimator.quantiles(groups), [[17.5, 25.0, 32.5]] * len(groups))
+
+
+def test_score_uses_most_specific_level_with_enough_samples():
+    history = [("45210000", 1, "abierto", 10.0)] * 3 + [("45200000", 2, "abierto", 30.0)] * 3
+    estimator = Estimator(history, ANCESTORS, min_samples=3)
+    estimates = {row[0]: row for row in estimator.score([
+        (1, "45210000", 1, "abierto", 1000.0),
+        # Sin historial en su CPV con este organismo: sube al CPV padre (organismo 2)
+        (2, "45210000", 2, "abierto", 1000.0),
+        # Organismo desconocido: salta a los niveles sin organismo ni CPV
+        (3, "45210000", 99, "abierto", 0.0),
+    ])}
+    assert estimates[1][1:4] == (10.0, 10.0, 10.0)
+    assert estimates[1][4:7] == (900.0, 900.0, 900.0)
+    assert estimates[1][8:10] == ("cpv_organo_procedimiento", "45210000")
+    assert estimates[2][8:10] == ("cpv_organo_procedimiento", "45200000")
+    assert estimates[2][3] == pytest.approx(30.0)
+    assert estimates[3][7:10] == (6, "procedimiento", None)
+    assert estimates[3][1:4] == (10.0, 20.0, 30.0)
+    # Sin presupuesto no hay importes, pero sí bajas
+    assert estimates[3][4:7] == (None, None, None)
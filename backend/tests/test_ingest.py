@@ -0,0 +1,77 @@
+import copy
+import xml.etree.ElementTree as ET
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+
+from ingest import NS, iter_feed, parse_entry
+
+FIXTURE = Path(__file__).resolve().parent.parent / "fixtures" / "placsp_ejemplo.atom"
+
+
+def _entries():
+    return ET.parse(FIXTURE).getroot().findall("atom:entry", NS)
+
+
+def test_fixture_documents():
+    adjudicada, en_plazo = list(iter_feed(str(FIXTURE)))
+
+    assert adjudicada.contract_folder_id == "EJ/2024/001"
+    assert adjudicada.estado == "Adjudicada"
+    assert adjudicada.fecha_publicacion == date(2024, 1, 10)
+    assert adjudicada.organo.cod_dir3 == "L01159999"
+    assert adjudicada.organo.nif == "P1599999A"
+    assert adjudicada.organo.provincia == "A Coruña"
+    assert adjudicada.tipo_contrato == "Servicios"
+    assert adjudicada.tipo_procedimiento == "Abierto"
+    assert adjudicada.valor_estimado == Decimal("240000")
+    assert adjudicada.presupuesto_base_sin_iva == Decimal("120000")
+    assert adjudicada.presupuesto_base_con_iva == Decimal("145200")
+    assert adjudicada.plazo_ejecucion_dias == 720
+    assert adjudicada.cpvs == ["90910000"]
+
+    assert en_plazo.contract_folder_id == "EJ/2024/002"
+    assert en_plazo.estado == "En plazo"
+    assert en_plazo.organo.nif is None
+    assert en_plazo.tipo_contrato == "Suministros"
+    assert en_plazo.tipo_procedimiento == "Abierto simplificado"
+    assert en_plazo.tramitacion == "Urgente"
+    assert en_plazo.fecha_limite_ofertas == date(2099, 12, 31)
+    assert en_plazo.cpvs == ["30200000"]
+    assert en_plazo.resultados == []
+
+
+def test_fixture_lots_and_results():
+    adjudicada, en_plazo = list(iter_feed(str(FIXTURE)))
+
+    # el lote sin CPV propio hereda los del contrato
+    assert [(lote.numero_lote, lote.cpvs, lote.importe_lote_sin_iva) for lote in adjudicada.lotes] == [
+        ("1", ["90911200"], Decimal("60000")),
+        ("2", ["90910000"], Decimal("60000")),
+    ]
+    primero, segundo = adjudicada.resultados
+    assert (primero.numero_lote, primero.es_exito, primero.numero_licitadores) == ("1", True, 4)
+    assert primero.fecha_adjudicacion == date(2024, 2, 20)
+    assert primero.importe_sin_iva == Decimal("51000")
+    assert [(empresa.nif, empresa.es_pyme) for empresa in primero.empresas] == [("B99999991", True)]
+    assert (segundo.numero_lote, segundo.numero_licitadores) == ("2", 3)
+    assert segundo.importe_con_iva == Decimal("65340")
+    assert [empresa.nif for empresa in segundo.empresas] == ["B99999992", "B99999991"]
+
+    # sin lotes en el feed se crea uno con los datos del contrato
+    assert [(lote.numero_lote, lote.cpvs, lote.importe_lote_con_iva) for lote in en_plazo.lotes] == [
+        ("1", ["30200000"], Decimal("36300")),
+    ]
+
+
+def test_document_hash_is_stable():
+    entries = _entries()
+    hashes = [parse_entry(entry).document_hash for entry in entries]
+    assert all(len(value) == 64 and set(value) <= set("0123456789abcdef") for value in hashes)
+    assert hashes[0] != hashes[1]
+    assert [parse_entry(copy.deepcopy(entry)).document_hash for entry in _entries()] == hashes
+    assert [documento.document_hash for documento in iter_feed(str(FIXTURE))] == hashes
+
+    changed = copy.deepcopy(entries[1])
+    changed.find(".//cbc-place-ext:ContractFolderStatusCode", NS).text = "EV"
+    assert parse_entry(changed).document_hash != hashes[1]
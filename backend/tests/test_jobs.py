@@ -0,0 +1,59 @@
+import os
+
+import pytest
+from fastapi import HTTPException
+
+import jobs
+from jobs import parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=990-5000", (990, 999)),   # el final se recorta al tamaño
+    ("bytes=-100", (900, 999)),       # últimos 100 bytes
+    ("bytes=-5000", (0, 999)),        # sufijo mayor que el fichero: entero
+    ("bytes=999-999", (999, 999)),
+    (" bytes=0-0 ", (0, 0)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "",
+    "bytes=-",
+    "bytes=0-99,200-299",  # varios rangos: se sirve el fichero entero
+    "items=0-99",
+    "bytes=a-b",
+])
+def test_unparsed_headers_mean_whole_file(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=1000-2000", 1000),
+    ("bytes=50-10", 1000),
+    ("bytes=-0", 1000),
+    ("bytes=0-", 0),
+])
+def test_unsatisfiable_ranges_are_416(header, size):
+    with pytest.raises(HTTPException) as error:
+        parse_range(header, size)
+    assert error.value.status_code == 416
+    assert error.value.headers == {"Content-Range": f"bytes */{size}"}
+
+
+def test_unsatisfiable_range_closes_result_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DIR", tmp_path)
+    (tmp_path / "abc.gz").write_bytes(b"x" * 10)
+    job = {"id": "abc", "report": "licitaciones", "format": "csv"}
+    open_files = len(os.listdir("/proc/self/fd"))
+    # Se conservan las excepciones (y con ellas sus frames) para que el recolector no cierre el fichero
+    errors = []
+    for _ in range(5):
+        with pytest.raises(HTTPException) as error:
+            jobs.result_response(job, "bytes=50-", None)
+        errors.append(error)
+    assert len(os.listdir("/proc/self/fd")) == open_files
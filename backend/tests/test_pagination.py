@@ -0,0 +1,58 @@
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+
+from pagination import MAX_PAGE_SIZE, decode_cursor, encode_cursor, next_cursor_headers, page_size
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(date(2024, 3, 1), 42, "abc")
+    assert decode_cursor(cursor, date, int, str) == (date(2024, 3, 1), 42, "abc")
+
+
+def test_cursor_is_url_safe_without_padding():
+    cursor = encode_cursor("ñandú?/+", 1)
+    assert "=" not in cursor
+    assert all(char.isalnum() or char in "-_" for char in cursor)
+    assert decode_cursor(cursor, str, int) == ("ñandú?/+", 1)
+
+
+def test_cursor_keeps_nulls():
+    assert decode_cursor(encode_cursor(None, 7), date, int) == (None, 7)
+
+
+def test_missing_cursor_decodes_to_nulls():
+    assert decode_cursor(None, date, int) == (None, None)
+    assert decode_cursor("", date, int) == (None, None)
+
+
+@pytest.mark.parametrize("cursor", [
+    "no es base64!",
+    encode_cursor(1),
+    encode_cursor("no-es-fecha", 1),
+    encode_cursor(date(2024, 1, 1), "x"),
+])
+def test_invalid_cursor_is_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, date, int)
+    assert error.value.status_code == 400
+
+
+def test_page_size_bounds():
+    assert page_size(0) == 1
+    assert page_size(50) == 50
+    assert page_size(MAX_PAGE_SIZE + 1) == MAX_PAGE_SIZE
+
+
+def test_next_cursor_only_for_full_pages():
+    rows = [{"fecha": date(2024, 1, day), "id": day} for day in (1, 2)]
+    assert next_cursor_headers(rows, 3, "fecha", "id") == {}
+    assert next_cursor_headers([], 0, "fecha", "id") == {}
+    headers = next_cursor_headers(rows, 2, "fecha", "id")
+    assert decode_cursor(headers["X-Next-Cursor"], date, int) == (date(2024, 1, 2), 2)
+
+
+def test_next_cursor_from_column_rows():
+    headers = next_cursor_headers([(5, "a"), (9, "b")], 2, "id", columns=["id", "nombre"])
+    assert decode_cursor(headers["X-Next-Cursor"], int) == (9,)
@@ -36,11 +36,8 @@ export const api = {
             await delay(1000);
             return { topCompetitors, network: networkData };
         }
-        const [comps, net] = await Promise.all([
-            fetchFromAPI<Competitor[]>('/competition/top'),
-            fetchFromAPI<GraphData>('/competition/network')
-        ]);
-        return { topCompetitors: comps, network: net };
+        // Un único viaje: el backend consulta ambos componentes en paralelo
+        return fetchFromAPI('/dashboard/competition');
     },
 
     async getReboundData(): Promise<DesertedTender[]> {
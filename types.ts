@@ -18,6 +18,15 @@ export interface Tender {
     organismSuccessRate: number; // 0-100
     cpv: string;
     status: 'Activa' | 'Adjudicada' | 'Desierta';
+    // Estimación de adjudicación (null si no hay histórico comparable)
+    estimatedAward?: number | null;
+    estimatedAwardMin?: number | null;
+    estimatedAwardMax?: number | null;
+    expectedDiscount?: number | null; // Baja mediana %
+    discountP25?: number | null;
+    discountP75?: number | null;
+    estimateSamples?: number | null;
+    estimateBasis?: string | null;
 }
 
 export interface OrganismKPI {